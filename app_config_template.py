@@ -26,10 +26,104 @@ db_config = {'database': 'tucker_sync_dev',
              'password': 'tuckersyncadmin',
              'host': '127.0.0.1'}
 
+# Database connection pool.
+# Number of idle connections each server process keeps open for reuse.
+# Connections beyond this size are opened on demand and closed after use.
+DB_POOL_SIZE = 5
+
+# Max connections each server process has open at once (0 for no limit).
+# Keep (server processes x DB_POOL_MAX_CONNECTIONS) below the MySQL
+# max_connections. A request finding the limit reached waits up to
+# DB_POOL_TIMEOUT seconds for a connection, then fails (internal server
+# error).
+DB_POOL_MAX_CONNECTIONS = 20
+DB_POOL_TIMEOUT = 5
+
+# Statements executed once on each new (or reconnected) pool connection.
+# e.g. DB_SESSION_STATEMENTS = ("SET SESSION time_zone = '+00:00'",)
+DB_SESSION_STATEMENTS = ()
+
+# Session sync count allocator.
+# 'sequence' - the original 5 statement sequence, which also deletes the
+#   trailing committed sessions of the object class on every sync upload.
+# 'insert' - INSERT and COMMIT the session, the sync count is the insert id.
+#   Trailing committed sessions are deleted out of the request path by the
+#   janitor (see JANITOR_INTERVAL). Intended for long running processes.
+SYNC_COUNT_ALLOCATOR = 'sequence'
+
+# Seconds between janitor sweeps of the SyncCount table, which mark expired
+# sessions committed and delete trailing committed sessions.
+# Run in a thread of each long running server process (prefork.py,
+# FastCGI, mod_wsgi), never started by CGI requests.
+# Processes without the thread (CGI: index.py, index_flup_cgi.py) sweep the
+# object class in the sync upload request instead, at most once per interval
+# per process, so on every sync upload of a CGI process. Run ./janitor.py
+# from cron to keep the sweep out of the CGI request path.
+# Set 0 to disable all sweeps, then ./janitor.py must run from cron,
+# otherwise an expired session stalls the committed sync count and (insert
+# allocator) the SyncCount table grows without limit.
+JANITOR_INTERVAL = 300
+
 # Min password length required from users.
 # Test suite requires the default of 14.
 USER_PASSWORD_MIN_LEN = 14
 
+# HTTP compression (gzip/deflate) negotiated by Accept-Encoding and
+# Content-Encoding.
+# Response compression level 1-9 (0 disables response compression).
+# Responses smaller than the min size (bytes) are sent uncompressed.
+# Max decompressed size (bytes) of a compressed request body.
+COMPRESSION_LEVEL = 6
+COMPRESSION_MIN_SIZE = 1024
+COMPRESSION_MAX_DECODED_SIZE = 16 * 1024 * 1024
+
+# Cache of verified credentials, avoids re-hashing the password of a user
+# authenticating repeatedly (e.g. a syncing device).
+# Max number of cached credentials (0 disables) and seconds to live.
+AUTH_CACHE_SIZE = 1000
+AUTH_CACHE_TTL = 300
+
+# Password hashing process pool. Keeps the CPU bound hashing and verifying
+# of passwords off the serving threads and spreads it across cores.
+# Number of worker processes, 0 hashes inline. Started by the long running
+# entry points before any thread, not supported under CGI (keep 0).
+# Max hashes pending in the pool, further requests get an internal server
+# error until a hash completes.
+HASH_POOL_SIZE = 0
+HASH_POOL_MAX_PENDING = 32
+
+# Session tokens, opened by sessionOpen and accepted instead of the email and
+# password by the test and sync requests. A token is signed with the secret
+# and expires after the seconds to live. It is also signed with the account
+# email and password hash, an account modify or close revokes the tokens.
+# The account is read by id once per AUTH_CACHE_TTL to verify a token.
+# Set a long random secret, the same for all server processes.
+# None disables session tokens. (./app_setup.py sets a random secret.)
+AUTH_TOKEN_SECRET = None
+AUTH_TOKEN_TTL = 3600
+
+# Cache of the committed sync count per object class, seconds to live.
+# Each use is re-validated against the highest sync count of the class, so
+# multiple server processes stay correct. Set 0 to disable.
+COMMITTED_SC_CACHE_TTL = 60
+
+# Base data, served by baseDataDown without authentication, is the objects
+# of the base data owner account (email), None for no base data.
+# Encoded base data responses are cached per object class, cursor and
+# committed sync count, max number of cached responses (0 disables) and
+# seconds to live. A commit replaces the cached responses of its class.
+BASE_DATA_OWNER_EMAIL = None
+BASE_DATA_CACHE_SIZE = 16
+BASE_DATA_CACHE_TTL = 60
+
+# Static base data, exported by ./app_setup.py --export-base-data into the
+# STATIC_BASE_DATA_DIR directory (relative to the server directory) and
+# served by the web server from STATIC_BASE_DATA_URL (e.g. '/base_data/').
+# baseDataDown requests are redirected to the exported files.
+# STATIC_BASE_DATA_URL = None disables the redirects.
+STATIC_BASE_DATA_DIR = 'base_data'
+STATIC_BASE_DATA_URL = None
+
 LOG_LEVEL = 'DEBUG'  # Default: LOG_LEVEL = 'DEBUG'
 LOG_FILE_NAME = 'tucker_sync_server.log'
 
@@ -1,5 +1,6 @@
+-- Generated from app_model.py by: ./app_setup.py --write-schema
 
-CREATE TABLE Setting (
+CREATE TABLE Product (
   id INT UNSIGNED NOT NULL AUTO_INCREMENT PRIMARY KEY,
   originClientId INT UNSIGNED NOT NULL,
   originClientObjectId INT UNSIGNED NOT NULL,
@@ -8,12 +9,12 @@ CREATE TABLE Setting (
   lastSync BIGINT UNSIGNED NOT NULL,
   deleted BOOL NOT NULL DEFAULT 0,
   name VARCHAR(255),
-  value VARCHAR(255),
   FOREIGN KEY (ownerUserId) REFERENCES User(id) ON DELETE CASCADE,
-  UNIQUE INDEX `uniqueObjectConstraint` (`originClientId`,`originClientObjectId`)
+  UNIQUE INDEX `uniqueObjectConstraint` (`originClientId`,`originClientObjectId`),
+  INDEX `syncDown` (`ownerUserId`,`lastSync`,`id`)
 ) ENGINE=INNODB;
 
-CREATE TABLE Product (
+CREATE TABLE Setting (
   id INT UNSIGNED NOT NULL AUTO_INCREMENT PRIMARY KEY,
   originClientId INT UNSIGNED NOT NULL,
   originClientObjectId INT UNSIGNED NOT NULL,
@@ -22,6 +23,8 @@ CREATE TABLE Product (
   lastSync BIGINT UNSIGNED NOT NULL,
   deleted BOOL NOT NULL DEFAULT 0,
   name VARCHAR(255),
+  value VARCHAR(255),
   FOREIGN KEY (ownerUserId) REFERENCES User(id) ON DELETE CASCADE,
-  UNIQUE INDEX `uniqueObjectConstraint` (`originClientId`,`originClientObjectId`)
+  UNIQUE INDEX `uniqueObjectConstraint` (`originClientId`,`originClientObjectId`),
+  INDEX `syncDown` (`ownerUserId`,`lastSync`,`id`)
 ) ENGINE=INNODB;
@@ -1,3 +1,4 @@
+-- Generated from app_model.py by: ./app_setup.py --write-schema
 
-DROP TABLE IF EXISTS Setting;
 DROP TABLE IF EXISTS Product;
+DROP TABLE IF EXISTS Setting;
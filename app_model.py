@@ -11,7 +11,8 @@ Application models are created using Schematics:
 Usage:
     Create model classes to define data objects for your application.
     Create a matching MySQL database, user, permissions and tables.
-    (See app_create.sql and app_drop.sql)
+    (See app_create.sql and app_drop.sql, generated from the models by
+    `./app_setup.py --write-schema`)
     Set the database connection properties.
     (See app_config.sql)
 
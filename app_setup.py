@@ -7,12 +7,21 @@ May be run from the command line (or as a CGI script? - untested).
 
 Usage:
     ./app_setup.py
-    app_setup.py [-h] [-v] [--only-tables]
+    app_setup.py [-h] [-v] [--only-tables] [--print-schema] [--write-schema]
+                 [--print-migrations] [--export-base-data]
 
 Optional arguments:
-    -h, --help     show this help message and exit
-    -v, --verbose  log debug messages
-    --only-tables  only drop-create database tables
+    -h, --help          show this help message and exit
+    -v, --verbose       log debug messages
+    --only-tables       only drop-create database tables
+    --print-schema      print the object class tables DDL generated from
+                        app_model
+    --write-schema      write the generated DDL to app_create.sql and
+                        app_drop.sql
+    --print-migrations  print the statements migrating the database tables
+                        to app_model
+    --export-base-data  export the base data of each object class to static
+                        files (see STATIC_BASE_DATA_DIR)
 
 License:
     The MIT License (MIT), see LICENSE.txt for more details.
@@ -21,6 +30,8 @@ Copyright:
     Copyright (c) 2014 Steven Tucker and Gavin Kromhout.
 """
 
+import os
+import re
 import sys
 import shutil
 import argparse
@@ -30,6 +41,9 @@ from os.path import basename, isfile
 # Constants
 CONFIG_FNAME = 'app_config.py'
 CONFIG_TEMPLATE_FNAME = 'app_config_template.py'
+APP_CREATE_FNAME = 'app_create.sql'
+APP_DROP_FNAME = 'app_drop.sql'
+SCHEMA_HEADER = '-- Generated from app_model.py by: ./app_setup.py --write-schema'
 
 # Module logger.
 log = logging.getLogger(basename(__file__).split('.')[0])
@@ -38,7 +52,7 @@ log = logging.getLogger(basename(__file__).split('.')[0])
 def check_connection():
     """Check the database connection."""
 
-    from server import open_db
+    from server import open_db, close_db
 
     cursor, cnx, errno = open_db()
 
@@ -49,6 +63,8 @@ def check_connection():
         log.error(' - then re-run ./app_setup.py')
         sys.exit()
 
+    close_db(cursor, cnx)
+
 
 def drop_create_tables():
     """Drop and create database tables helper function."""
@@ -93,19 +109,357 @@ def drop_create_tables():
             # error.
             assert -1 != result.rowcount
 
+    # Restore notes before the connection is returned to the pool.
+    stmt = """SET sql_notes = 1"""
+    cursor.execute(stmt)
+
     close_db(cursor, cnx)
 
 
+def get_object_classes():
+    """Return the object class registry entries sorted by name."""
+
+    import app_model
+    from base_model import object_class_registry
+
+    registry = object_class_registry(app_model)
+    return [registry[name] for name in sorted(registry)]
+
+
+def get_schema():
+    """Return the generated (create, drop) DDL of the object class tables."""
+
+    infos = get_object_classes()
+
+    create = '\n\n'.join(info.sql.create_table for info in infos)
+    drop = '\n'.join(info.sql.drop_table for info in infos)
+
+    return create, drop
+
+
+def write_schema():
+    """Write the generated DDL to the app create and drop sql files."""
+
+    create, drop = get_schema()
+
+    for fname, ddl in ((APP_CREATE_FNAME, create), (APP_DROP_FNAME, drop)):
+        log.info('writing %s', fname)
+        with open(fname, 'w') as f:
+            f.write(SCHEMA_HEADER + '\n\n' + ddl + '\n')
+
+
+# Indexes added to the base tables since their initial release.
+# (table, index name, columns)
+BASE_INDEXES = (
+    ('SyncCount', 'objectClass', ('objectClass',)),
+    ('SyncCount', 'objectClassCommitted',
+     ('objectClass', 'isCommitted', 'createAt')),
+)
+
+
+def get_indexes(cursor, table):
+    """Return the table indexes, a dict of index name to column list."""
+
+    cursor.execute("""SELECT INDEX_NAME AS name, COLUMN_NAME AS col
+        FROM information_schema.STATISTICS
+        WHERE TABLE_SCHEMA = DATABASE()
+          AND TABLE_NAME = %s
+        ORDER BY INDEX_NAME, SEQ_IN_INDEX""", (table,))
+    indexes = {}
+    for row in cursor:
+        indexes.setdefault(row['name'], []).append(row['col'])
+
+    return indexes
+
+
+# Converts the Client UUID from CHAR(36) to BINARY(16), keeping the unique
+# index name (duplicate key errors are matched by it).
+CLIENT_UUID_BINARY_MIGRATION = (
+    'ALTER TABLE Client ADD COLUMN UUIDBinary BINARY(16) AFTER UUID;',
+    "UPDATE Client SET UUIDBinary = UNHEX(REPLACE(UUID, '-', ''));",
+    'ALTER TABLE Client DROP COLUMN UUID;',
+    'ALTER TABLE Client CHANGE COLUMN UUIDBinary UUID BINARY(16) NOT NULL, '
+    'ADD UNIQUE INDEX UUID (UUID);',
+)
+
+
+def get_column_type(cursor, table, column):
+    """Return the column data type (e.g. 'char'), otherwise None."""
+
+    cursor.execute("""SELECT DATA_TYPE AS data_type
+        FROM information_schema.COLUMNS
+        WHERE TABLE_SCHEMA = DATABASE()
+          AND TABLE_NAME = %s
+          AND COLUMN_NAME = %s""", (table, column))
+    rows = cursor.fetchall()
+
+    return rows[0]['data_type'] if rows else None
+
+
+def get_base_migrations(cursor):
+    """Return the statements migrating the base tables.
+
+    Adds missing indexes and converts a CHAR Client UUID to BINARY(16)."""
+
+    statements = []
+
+    for table, name, columns in BASE_INDEXES:
+        if name not in get_indexes(cursor, table):
+            statements.append('ALTER TABLE %s ADD INDEX %s (%s);' % (
+                table, name, ', '.join(columns)))
+
+    if get_column_type(cursor, 'Client', 'UUID') == 'char':
+        statements.extend(CLIENT_UUID_BINARY_MIGRATION)
+
+    return statements
+
+
+def get_table_migrations(cursor, info):
+    """Return the statements migrating the object class table to the model.
+
+    Adds missing tables, columns and indexes. Columns not in the model are
+    only reported (commented out DROP). Column type changes are not detected.
+    """
+
+    sql = info.sql
+    table = info.table
+
+    cursor.execute("""SELECT COLUMN_NAME AS name
+        FROM information_schema.COLUMNS
+        WHERE TABLE_SCHEMA = DATABASE()
+          AND TABLE_NAME = %s
+        ORDER BY ORDINAL_POSITION""", (table,))
+    columns = [row['name'] for row in cursor]
+
+    if not columns:
+        return [sql.create_table]
+
+    indexes = get_indexes(cursor, table)
+
+    from base_model import index_definition
+
+    statements = []
+
+    previous = None
+    for name, definition in sql.column_definitions:
+        if name not in columns:
+            position = ' AFTER %s' % previous if previous else ' FIRST'
+            statements.append('ALTER TABLE %s ADD COLUMN %s %s%s;' % (
+                table, name, definition, position))
+        previous = name
+
+    model_columns = [name for name, _ in sql.column_definitions]
+    for name in columns:
+        if name not in model_columns:
+            statements.append('-- ALTER TABLE %s DROP COLUMN %s;'
+                              '  -- not in model' % (table, name))
+
+    for index in sql.indexes:
+        name, unique, index_columns = index
+        existing = indexes.get(name)
+        if existing == list(index_columns):
+            continue
+        drop = 'DROP INDEX `%s`, ' % name if existing else ''
+        statements.append('ALTER TABLE %s %sADD %s;' % (
+            table, drop, index_definition(index)))
+
+    return statements
+
+
+def get_migrations():
+    """Return the statements migrating the database tables to app_model.
+
+    Includes the base table migrations."""
+
+    from server import open_db, close_db
+
+    cursor, cnx, errno = open_db()
+    assert None == errno
+
+    statements = get_base_migrations(cursor)
+    for info in get_object_classes():
+        statements.extend(get_table_migrations(cursor, info))
+
+    close_db(cursor, cnx)
+
+    return statements
+
+
+def check_object_tables():
+    """Check each application object class has a matching database table."""
+
+    log.info('checking object class tables')
+
+    statements = get_migrations()
+
+    if statements:
+        log.error('database tables do not match app_model, migrations:')
+        for stmt in statements:
+            log.error(stmt)
+    else:
+        log.info('object class tables ok')
+
+
+def get_base_data(holder):
+    """Return the encoded base data download response of holder.object_class.
+
+    All the base data objects are in the one response (no moreObjects).
+    Return None on error."""
+
+    import server
+    from base_model import ValidatedObject
+    from common import ResponseBody
+
+    holder.response_body = ResponseBody()
+
+    if not server.set_committed_sc(holder):
+        return
+
+    if not server.set_base_data_owner(holder):
+        return
+
+    res_body = holder.response_body
+    objects = []
+
+    # Select the owner's objects page by page, from the start.
+    holder.request_body = ValidatedObject(lastSync=0, lastObjectId=None)
+    while holder.auth_user is not None:
+        if not server.set_sync_down_rows(holder):
+            return
+
+        last = None
+        for primitive, data in server.iter_sync_down_objects(holder):
+            objects.append(data)
+            last = primitive
+
+        if not res_body.moreObjects:
+            break
+
+        if last is None:
+            log.error('%s base data select failed',
+                      holder.object_class_info.name)
+            return
+
+        holder.request_body = ValidatedObject(lastSync=last['lastSync'],
+                                              lastObjectId=last['rowid'])
+
+    res_body.moreObjects = False
+    return holder.codec.dumps_objects(res_body.to_primitive(), objects)
+
+
+def write_file(path, data):
+    """Write data to path, replacing any existing file atomically."""
+
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.rename(tmp_path, path)
+
+
+def export_base_data():
+    """Export the base data of each object class to static files.
+
+    Writes <class>.<committedSyncCount>.json and a precompressed .json.gz of
+    each object class and the manifest of the current files. The files of
+    the previous export are kept for clients that have just read the old
+    manifest, older files are deleted."""
+
+    import server
+    from common import JSON, ContentEncoding
+
+    export_dir = server.static_base_data_path()
+    log.info('exporting base data to %s', export_dir)
+
+    if not os.path.isdir(export_dir):
+        os.makedirs(export_dir)
+
+    previous = server.get_static_base_data_manifest()
+    manifest = {}
+
+    holder = server.Holder()
+    holder.response = server.Response()
+    holder.codec = JSON
+    holder.cursor, holder.cnx, errno = server.open_db()
+    assert None == errno
+
+    try:
+        for info in get_object_classes():
+            holder.object_class = info.model_class
+            holder.object_class_info = info
+
+            data = get_base_data(holder)
+            if data is None:
+                log.error('%s base data export failed', info.name)
+                sys.exit(1)
+
+            committed_sc = holder.response_body.committedSyncCount
+            file_name = '%s.%s.json' % (info.name, committed_sc)
+            write_file(server.static_base_data_path(file_name), data)
+            write_file(server.static_base_data_path(file_name + '.gz'),
+                       ContentEncoding.compress(data, ContentEncoding.GZIP, 9))
+
+            log.info('%s -> %s (%s bytes)', info.name, file_name, len(data))
+            manifest[info.name] = {'file': file_name,
+                                   'committedSyncCount': committed_sc}
+    finally:
+        server.close_db(holder.cursor, holder.cnx)
+
+    write_file(server.static_base_data_path(server.STATIC_BASE_DATA_MANIFEST),
+               JSON.dumps(manifest))
+
+    # Keep the current and previous export files.
+    keep = set()
+    for entries in (manifest, previous):
+        for entry in entries.values():
+            keep.add(entry['file'])
+            keep.add(entry['file'] + '.gz')
+
+    for file_name in os.listdir(export_dir):
+        if file_name.endswith(('.json', '.json.gz')) and \
+                file_name not in keep and \
+                file_name != server.STATIC_BASE_DATA_MANIFEST:
+            log.debug('deleting %s', file_name)
+            os.remove(server.static_base_data_path(file_name))
+
+
+def check_config_settings():
+    """Warn of the template settings missing from the existing config file.
+
+    The server reads a missing setting with its template default."""
+
+    import app_config
+
+    with open(CONFIG_TEMPLATE_FNAME) as f:
+        names = re.findall(r'^([A-Z][A-Z0-9_]*) =', f.read(), re.MULTILINE)
+
+    for name in names:
+        if not hasattr(app_config, name):
+            log.warn('config file is missing %s, using the default '
+                     '(see %s)', name, CONFIG_TEMPLATE_FNAME)
+
+
 def config_file():
     """Setup config file from template."""
 
     if isfile(CONFIG_FNAME):
         log.info('found existing config file')
+        check_config_settings()
         return
 
     log.info('copying %s -> %s', CONFIG_TEMPLATE_FNAME, CONFIG_FNAME)
     shutil.copy2(CONFIG_TEMPLATE_FNAME, CONFIG_FNAME)
 
+    # Enable session tokens with a random secret.
+    with open(CONFIG_FNAME) as f:
+        config = f.read()
+
+    config = config.replace(
+        'AUTH_TOKEN_SECRET = None',
+        "AUTH_TOKEN_SECRET = '%s'" % os.urandom(32).encode('hex'), 1)
+
+    with open(CONFIG_FNAME, 'w') as f:
+        f.write(config)
+
 
 def init_logging(cmd_args):
     """Init logging."""
@@ -131,6 +485,22 @@ def get_cmd_args():
     parser.add_argument('--only-tables',
                         help='only drop-create database tables',
                         action='store_true')
+    parser.add_argument('--print-schema',
+                        help='print the object class tables DDL generated '
+                             'from app_model',
+                        action='store_true')
+    parser.add_argument('--write-schema',
+                        help='write the generated DDL to %s and %s' % (
+                            APP_CREATE_FNAME, APP_DROP_FNAME),
+                        action='store_true')
+    parser.add_argument('--print-migrations',
+                        help='print the statements migrating the database '
+                             'tables to app_model',
+                        action='store_true')
+    parser.add_argument('--export-base-data',
+                        help='export the base data of each object class to '
+                             'static files',
+                        action='store_true')
 
     return parser.parse_args()
 
@@ -138,15 +508,39 @@ def get_cmd_args():
 def run_setup(cmd_args):
     """Run the setup functions."""
 
+    if cmd_args.print_schema:
+        create, drop = get_schema()
+        print drop
+        print
+        print create
+        return
+
+    if cmd_args.write_schema:
+        write_schema()
+        return
+
+    if cmd_args.print_migrations:
+        check_connection()
+        for stmt in get_migrations():
+            print stmt
+        return
+
+    if cmd_args.export_base_data:
+        check_connection()
+        export_base_data()
+        return
+
     if cmd_args.only_tables:
         log.info('only running drop-create database tables')
         check_connection()
         drop_create_tables()
+        check_object_tables()
         return
 
     config_file()
     check_connection()
     drop_create_tables()
+    check_object_tables()
 
 
 def main():
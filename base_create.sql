@@ -5,6 +5,7 @@ CREATE TABLE SyncCount (
   isCommitted BOOL NOT NULL DEFAULT 0,
   createAt TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
   INDEX(objectClass),
+  INDEX objectClassCommitted (objectClass, isCommitted, createAt),
   INDEX(isCommitted)
 ) ENGINE=INNODB;
 
@@ -17,6 +18,6 @@ CREATE TABLE User (
 CREATE TABLE Client (
   id INT UNSIGNED NOT NULL AUTO_INCREMENT PRIMARY KEY,
   userId INT UNSIGNED NOT NULL,
-  UUID CHAR(36) UNIQUE NOT NULL,
+  UUID BINARY(16) UNIQUE NOT NULL,
   FOREIGN KEY (userId) REFERENCES User(id) ON DELETE CASCADE
 ) ENGINE=INNODB;
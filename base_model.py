@@ -14,10 +14,18 @@ Copyright:
     Copyright (c) 2014 Steven Tucker and Gavin Kromhout.
 """
 
-from six import iterkeys
+import inspect
+from copy import deepcopy
+from functools import partial
+from operator import attrgetter, itemgetter
 
+from schematics.exceptions import BaseError, ConversionError, \
+    ValidationError
 from schematics.models import Model
-from schematics.types import LongType, BooleanType
+from schematics.types import BaseType, LongType, BooleanType, UUIDType, \
+    IPv4Type, StringType, IntType, FloatType, DecimalType, MD5Type, \
+    SHA1Type, DateType, DateTimeType
+from schematics.types.compound import ListType
 
 SELECT = 'SELECT'
 INSERT = 'INSERT'
@@ -27,6 +35,566 @@ FROM = 'FROM'
 WHERE = 'WHERE'
 SEP = ',\n  '
 
+# Columns set by the server, not by the uploading client.
+SERVER_COLUMNS = ('originClientId', 'lastUpdatedByClientId', 'ownerUserId')
+
+# Max rows per multi row statement.
+# Larger batches are split to stay well below max_allowed_packet.
+MAX_STATEMENT_ROWS = 500
+
+# Max (JSON) bytes of the objects of a multi class sync response (syncBatch).
+# Each object class section is also limited by its SYNC_MAX_BYTES.
+SYNC_BATCH_MAX_BYTES = 5 * 1024 * 1024
+
+# Column definitions of the required fields.
+BASE_COLUMN_DEFINITIONS = (
+    ('id', 'INT UNSIGNED NOT NULL AUTO_INCREMENT PRIMARY KEY'),
+    ('originClientId', 'INT UNSIGNED NOT NULL'),
+    ('originClientObjectId', 'INT UNSIGNED NOT NULL'),
+    ('lastUpdatedByClientId', 'INT UNSIGNED NOT NULL'),
+    ('ownerUserId', 'INT UNSIGNED NOT NULL'),
+    ('lastSync', 'BIGINT UNSIGNED NOT NULL'),
+    ('deleted', 'BOOL NOT NULL DEFAULT 0'))
+
+# Column types of application fields by schematics type.
+# Subclasses are listed before their base types.
+COLUMN_TYPES = (
+    (UUIDType, 'CHAR(36)'),
+    (IPv4Type, 'VARCHAR(15)'),
+    (StringType, 'VARCHAR(%(max_length)s)'),
+    (IntType, 'INT'),
+    (LongType, 'BIGINT'),
+    (FloatType, 'DOUBLE'),
+    (DecimalType, 'DECIMAL(30,10)'),
+    (MD5Type, 'CHAR(32)'),
+    (SHA1Type, 'CHAR(40)'),
+    (BooleanType, 'BOOL'),
+    (DateType, 'DATE'),
+    (DateTimeType, 'DATETIME'))
+
+# Field types with database values that are already primitive (JSON) values.
+PRIMITIVE_TYPES = (StringType, IntType, LongType, FloatType)
+
+# Default VARCHAR length when a StringType has no max_length.
+DEFAULT_STRING_LENGTH = 255
+
+# Indexes of object class tables: (name, unique, columns).
+# syncDown serves the sync download keyset range and ORDER BY
+# (ownerUserId, lastSync, id) without a filesort. Also covers the
+# ownerUserId foreign key and MAX(lastSync) per owner.
+INDEXES = (
+    ('uniqueObjectConstraint', True, ('originClientId',
+                                      'originClientObjectId')),
+    ('syncDown', False, ('ownerUserId', 'lastSync', 'id')))
+
+
+def column_definition(model_class, name, field):
+    """Return the column definition (DDL) of an application field."""
+
+    if name in model_class.COLUMN_DEFINITIONS:
+        return model_class.COLUMN_DEFINITIONS[name]
+
+    for type_class, column_type in COLUMN_TYPES:
+        if isinstance(field, type_class):
+            break
+    else:
+        raise ValueError('%s.%s: no column type for %s, set it in '
+                         'COLUMN_DEFINITIONS' % (model_class.__name__, name,
+                                                 type(field).__name__))
+
+    max_length = getattr(field, 'max_length', None) or DEFAULT_STRING_LENGTH
+    column_type %= {'max_length': max_length}
+
+    if field.required:
+        column_type += ' NOT NULL'
+
+    return column_type
+
+
+def getter(names):
+    """Return a getter for names that always returns a tuple."""
+
+    if len(names) == 1:
+        get = names[0]
+        return lambda obj: (getattr(obj, get),)
+    return attrgetter(*names)
+
+
+def item_getter(names):
+    """Return an item getter for names that always returns a tuple."""
+
+    if len(names) == 1:
+        get = names[0]
+        return lambda d: (d.get(get),)
+    return itemgetter(*names)
+
+
+##############
+# Validators #
+##############
+
+# Error key of a value that is not an object (dict).
+NOT_AN_OBJECT = '_object'
+
+# Python types of decoded number values, excludes bool.
+INTEGER_TYPES = (int, long)
+NUMBER_TYPES = (int, long, float)
+
+
+def check_number(field):
+    """Return the value check of an IntType, LongType or FloatType field."""
+
+    is_float = field.number_class is float
+    types = NUMBER_TYPES if is_float else INTEGER_TYPES
+    min_value = field.min_value
+    max_value = field.max_value
+    messages = field.messages
+    number_type = field.number_type
+
+    def check(value):
+        if type(value) not in types:
+            raise ConversionError(
+                messages['number_coerce'].format(number_type.lower()))
+        if min_value is not None and value < min_value:
+            raise ValidationError(
+                messages['number_min'].format(number_type, min_value))
+        if max_value is not None and value > max_value:
+            raise ValidationError(
+                messages['number_max'].format(number_type, max_value))
+        return float(value) if is_float else value
+
+    return check
+
+
+def check_boolean(field):
+    """Return the value check of a BooleanType field, also accepts 0 and 1."""
+
+    def check(value):
+        if type(value) is bool:
+            return value
+        if type(value) in INTEGER_TYPES and value in (0, 1):
+            return bool(value)
+        raise ConversionError(u'Must be either true or false.')
+
+    return check
+
+
+def check_string(field):
+    """Return the value check of a StringType field."""
+
+    min_length = field.min_length
+    max_length = field.max_length
+    regex = field.regex
+    messages = field.messages
+
+    def check(value):
+        if type(value) is str:
+            try:
+                value = value.decode('utf-8')
+            except UnicodeDecodeError:
+                raise ConversionError(messages['convert'])
+        elif type(value) is not unicode:
+            raise ConversionError(messages['convert'])
+        if max_length is not None and len(value) > max_length:
+            raise ValidationError(messages['max_length'])
+        if min_length is not None and len(value) < min_length:
+            raise ValidationError(messages['min_length'])
+        if regex is not None and regex.match(value) is None:
+            raise ValidationError(messages['regex'])
+        return value
+
+    return check
+
+
+def check_list(field):
+    """Return the value check of a ListType field of untyped (plain) items.
+
+    The items are not copied or converted."""
+
+    def check(value):
+        if type(value) is not list:
+            raise ConversionError(u'Could not interpret the value as a list')
+        field.check_length(value)
+        return value
+
+    return check
+
+
+def check_native(field):
+    """Return the value check of any field, by its own conversion and
+    validation."""
+
+    def check(value):
+        value = field.to_native(value)
+        field.validate(value)
+        return value
+
+    return check
+
+
+# Fast value checks by exact field type.
+FAST_CHECKS = {
+    IntType: check_number,
+    LongType: check_number,
+    FloatType: check_number,
+    BooleanType: check_boolean,
+    StringType: check_string}
+
+
+def field_check(field):
+    """Return the value check of a field.
+
+    The fast checks accept only the decoded (JSON or MessagePack) value types
+    of a field. Fields with choices or additional validators are checked by
+    the field itself."""
+
+    own_validators = len(field._validators)
+    if type(field) is ListType:
+        # Length and items validators.
+        own_validators += 2
+
+    if field.choices is not None or len(field.validators) != own_validators:
+        return check_native(field)
+
+    if type(field) is ListType and type(field.field) is BaseType:
+        return check_list(field)
+
+    return FAST_CHECKS.get(type(field), check_native)(field)
+
+
+class CompiledValidator(object):
+    """Validator of plain objects (dicts) of a model class.
+
+    Compiled once per class, see compiled_validator().
+    Checks the keys and values of an object in a single loop, without
+    creating a model instance. Like a strict model, unknown keys and missing
+    required values are errors.
+
+    Usage:
+        obj, errors = validator(jo)
+    """
+
+    def __init__(self, model_class):
+        self.name = model_class.__name__
+        self.checks = {}
+        self.defaults = {}
+        self.default_factories = []
+        self.required = {}
+
+        for name, field in model_class._fields.items():
+            key = field.serialized_name or name
+            self.checks[key] = name, field_check(field)
+            if callable(field._default):
+                self.default_factories.append((name, field._default))
+            elif isinstance(field._default, (list, dict)):
+                # Mutable, a new copy for each object.
+                self.default_factories.append(
+                    (name, partial(deepcopy, field._default)))
+            self.defaults[name] = field.default
+            if field.required:
+                self.required[name] = [field.messages['required']]
+
+    def __call__(self, jo):
+        """Return (obj, errors) of the plain object jo.
+
+        obj is a new dict of every field, the converted values or defaults.
+        errors is None or a dict of key to the list of error messages."""
+
+        if type(jo) is not dict:
+            return None, {NOT_AN_OBJECT: [u'Value is not an object.']}
+
+        obj = self.defaults.copy()
+        for name, factory in self.default_factories:
+            obj[name] = factory()
+        checks = self.checks
+        errors = None
+
+        for key, value in jo.iteritems():
+            try:
+                name, check = checks[key]
+            except KeyError:
+                errors = errors or {}
+                errors[key] = [u'Rogue field']
+                continue
+
+            if value is None:
+                obj[name] = None
+                continue
+
+            try:
+                obj[name] = check(value)
+            except BaseError as e:
+                errors = errors or {}
+                errors[key] = e.messages
+
+        for name, messages in self.required.iteritems():
+            if obj[name] is None:
+                errors = errors or {}
+                errors[name] = messages
+
+        return obj, errors
+
+
+def compiled_validator(model_class):
+    """Return the CompiledValidator of a model class, compiled on first use.
+
+    :rtype: CompiledValidator
+    """
+
+    # Look in the class dict, a subclass must not use its parent's.
+    validator = model_class.__dict__.get('_compiled_validator')
+    if validator is None:
+        validator = CompiledValidator(model_class)
+        model_class._compiled_validator = validator
+    return validator
+
+
+class ValidatedObject(dict):
+    """Validated plain object with attribute access to its values.
+
+    A lightweight stand in for a model instance, e.g. of a request body."""
+
+    __slots__ = ()
+
+    def __getattr__(self, name):
+        try:
+            return self[name]
+        except KeyError:
+            raise AttributeError(name)
+
+
+def index_definition(index):
+    """Return the index definition (DDL) of a (name, unique, columns)."""
+
+    name, unique, columns = index
+    return '%sINDEX `%s` (%s)' % ('UNIQUE ' if unique else '', name,
+                                  ','.join('`%s`' % c for c in columns))
+
+
+class CompiledSQL(object):
+    """SQL statements and params accessors of a model class.
+
+    Compiled once per class, see BaseAppModel.compiled().
+    Multi row statements are compiled once per row count and cached.
+
+    Statements:
+        select_by_id - select a single object by id.
+        insert - insert a single object.
+        upsert(n) - insert n objects, on duplicate uniqueObjectConstraint
+            refresh the existing object only if it was last updated by the
+            same client.
+        update_by_id(n) - conditionally update n existing objects by id.
+            Only objects owned by the user whose lastSync has not moved past
+            the client's lastSync are updated.
+        select_sync_down - keyset paginated range over
+            (ownerUserId, lastSync, id) of objects not last updated by the
+            requesting client.
+        select_by_ids(n) - select n objects of an owner by id.
+        select_by_origin(n) - select n objects of an owner by origin client
+            and origin client object id.
+        select_max_last_sync - the highest lastSync of an owner's objects
+            up to a sync count, not last updated by a client.
+
+    Schema (DDL), column_definitions and create_table are built on first
+    use (app_setup.py), a field without a column type does not fail import:
+        column_definitions - (column, definition) of each table column.
+        indexes - (name, unique, columns) of each table index.
+        create_table - create the object class table.
+        drop_table - drop the object class table if it exists.
+    """
+
+    def __init__(self, model_class):
+        table = model_class.__name__
+        fields = tuple(model_class._fields)
+        insert_fields = tuple(f for f in fields if f != 'rowid')
+
+        # Fields the client may change on an existing object.
+        update_fields = tuple(f for f in insert_fields
+                              if f not in SERVER_COLUMNS
+                              and f not in ('originClientObjectId',
+                                            'lastSync'))
+
+        self.model_class = model_class
+        self.table = table
+        self.fields = fields
+        self.columns = ('id',) + insert_fields
+        self.insert_fields = insert_fields
+        self.update_fields = update_fields
+
+        self.insert_params = getter(insert_fields)
+        self.insert_item_params = item_getter(insert_fields)
+        # Fields with database values requiring conversion to primitive.
+        self.row_converters = tuple(
+            (name, field) for name, field in model_class._fields.items()
+            if not isinstance(field, PRIMITIVE_TYPES))
+
+        self.update_params = getter(('rowid', 'lastSync') + update_fields)
+        self.update_item_params = item_getter(
+            ('rowid', 'lastSync') + update_fields)
+
+        select_columns = ('id AS rowid',) + insert_fields
+
+        self.select = '\n'.join([SELECT,
+                                 '  ' + SEP.join(select_columns),
+                                 FROM,
+                                 '  ' + table])
+
+        self.select_by_id = '\n'.join([self.select,
+                                       WHERE,
+                                       '  id = %s'])
+
+        self.select_sync_down = '\n'.join([
+            self.select,
+            WHERE,
+            '  ownerUserId = %s',
+            '  AND (lastSync > %s OR (lastSync = %s AND id > %s))',
+            '  AND lastSync <= %s',
+            '  AND lastUpdatedByClientId != %s',
+            'ORDER BY lastSync, id',
+            'LIMIT %s'])
+
+        self.select_max_last_sync = '\n'.join([
+            'SELECT COALESCE(MAX(lastSync), 0) AS lastSync',
+            FROM,
+            '  ' + table,
+            WHERE,
+            '  ownerUserId = %s',
+            '  AND lastSync <= %s',
+            '  AND lastUpdatedByClientId != %s'])
+
+        self.values_row = '(' + ', '.join(['%s'] * len(insert_fields)) + ')'
+
+        self.insert_prefix = '\n'.join([
+            INSERT + ' ' + INTO + ' ' + table + ' (',
+            '  ' + SEP.join(insert_fields),
+            ')',
+            VALUES])
+
+        self.insert = self.insert_prefix + ' ' + self.values_row
+
+        # MySQL evaluates the assignments left to right.
+        # lastSync must be assigned last.
+        refresh_fields = update_fields + ('lastSync',)
+        self.upsert_suffix = '\n'.join([
+            'ON DUPLICATE KEY UPDATE',
+            '  ' + SEP.join(
+                '%s = IF(lastUpdatedByClientId = '
+                'VALUES(lastUpdatedByClientId), VALUES(%s), %s)' % (f, f, f)
+                for f in refresh_fields)])
+
+        first_row = ', '.join(
+            '%s AS ' + f for f in ('id', 'lastSync') + update_fields)
+        self.update_first_row = 'SELECT ' + first_row
+        self.update_row = 'SELECT ' + ', '.join(
+            ['%s'] * (2 + len(update_fields)))
+
+        self.update_suffix = '\n'.join([
+            ') AS v ON t.id = v.id',
+            'SET',
+            '  ' + SEP.join(['t.lastUpdatedByClientId = %s',
+                             't.lastSync = %s'] +
+                            ['t.%s = v.%s' % (f, f) for f in update_fields]),
+            WHERE,
+            '  t.ownerUserId = %s',
+            '  AND t.lastSync <= v.lastSync'])
+
+        self.indexes = INDEXES
+        self.drop_table = 'DROP TABLE IF EXISTS ' + table + ';'
+        self._column_definitions = None
+
+        self._upsert = {}
+        self._update_by_id = {}
+        self._select_by_ids = {}
+        self._select_by_origin = {}
+
+    @property
+    def column_definitions(self):
+        if self._column_definitions is None:
+            model_class = self.model_class
+            base_columns = tuple(c for c, _ in BASE_COLUMN_DEFINITIONS)
+            self._column_definitions = BASE_COLUMN_DEFINITIONS + tuple(
+                (f, column_definition(model_class, f, model_class._fields[f]))
+                for f in self.insert_fields if f not in base_columns)
+
+        return self._column_definitions
+
+    @property
+    def create_table(self):
+        return '\n'.join([
+            'CREATE TABLE ' + self.table + ' (',
+            '  ' + SEP.join(
+                ['%s %s' % c for c in self.column_definitions] +
+                ['FOREIGN KEY (ownerUserId) REFERENCES User(id) '
+                 'ON DELETE CASCADE'] +
+                [index_definition(i) for i in self.indexes]),
+            ') ENGINE=INNODB;'])
+
+    def row_primitive(self, row):
+        """Convert a database row (dict) in place to a primitive object.
+
+        Equivalent to the model's to_primitive() for trusted database output,
+        without creating a model instance."""
+
+        for name, field in self.row_converters:
+            value = row[name]
+            if value is not None:
+                row[name] = field.to_primitive(field.to_native(value))
+        return row
+
+    def upsert(self, n):
+        """Return the upsert statement for n rows."""
+
+        try:
+            return self._upsert[n]
+        except KeyError:
+            stmt = '\n'.join([self.insert_prefix,
+                              '  ' + SEP.join([self.values_row] * n),
+                              self.upsert_suffix])
+            self._upsert[n] = stmt
+            return stmt
+
+    def update_by_id(self, n):
+        """Return the conditional update by id statement for n rows."""
+
+        try:
+            return self._update_by_id[n]
+        except KeyError:
+            rows = [self.update_first_row] + [self.update_row] * (n - 1)
+            stmt = '\n'.join(['UPDATE ' + self.table + ' AS t',
+                              'JOIN (',
+                              '  ' + '\n  UNION ALL '.join(rows),
+                              self.update_suffix])
+            self._update_by_id[n] = stmt
+            return stmt
+
+    def select_by_ids(self, n):
+        """Return the select by owner and ids statement for n ids."""
+
+        try:
+            return self._select_by_ids[n]
+        except KeyError:
+            stmt = '\n'.join([self.select,
+                              WHERE,
+                              '  ownerUserId = %s',
+                              '  AND id IN (' + ', '.join(['%s'] * n) + ')'])
+            self._select_by_ids[n] = stmt
+            return stmt
+
+    def select_by_origin(self, n):
+        """Return the select by owner and origin statement for n ids."""
+
+        try:
+            return self._select_by_origin[n]
+        except KeyError:
+            stmt = '\n'.join([self.select,
+                              WHERE,
+                              '  ownerUserId = %s',
+                              '  AND originClientId = %s',
+                              '  AND originClientObjectId IN (' +
+                              ', '.join(['%s'] * n) + ')'])
+            self._select_by_origin[n] = stmt
+            return stmt
+
 
 class BaseAppModel(Model):
     """Base application model class.
@@ -43,36 +611,77 @@ class BaseAppModel(Model):
     lastSync = LongType()
     deleted = BooleanType(default=0)
 
+    # Sync batch limits, objects and (JSON) bytes per batch.
+    # May be overridden in subclasses.
+    SYNC_MAX_OBJECTS = 1000
+    SYNC_MAX_BYTES = 5 * 1024 * 1024
+
+    # Column definitions (DDL) by field name.
+    # Overrides the definition derived from the field type.
+    # e.g. COLUMN_DEFINITIONS = {'notes': 'TEXT'}
+    COLUMN_DEFINITIONS = {}
+
+    @classmethod
+    def compiled(cls):
+        """Return the CompiledSQL of this class, compiled on first use.
+
+        :rtype: CompiledSQL
+        """
+
+        # Look in the class dict, a subclass must not use its parent's.
+        compiled = cls.__dict__.get('_compiled_sql')
+        if compiled is None:
+            compiled = CompiledSQL(cls)
+            cls._compiled_sql = compiled
+        return compiled
+
     def columns(self):
-        columns = self.keys()
-        columns.remove('rowid')
-        columns.insert(0, 'id')
-        return columns
+        return list(self.compiled().columns)
 
     def select_by_id(self):
-        return '\n'.join([SELECT,
-                          '  ' + SEP.join(self.columns()),
-                          FROM,
-                          '  ' + self.__class__.__name__,
-                          WHERE,
-                          '  ' + 'id = %s'])
+        return self.compiled().select_by_id
 
     def select_by_id_params(self):
         return self.rowid,
 
     def insert(self):
-        table = self.__class__.__name__
-        columns = self.keys()
-        columns.remove('rowid')
-        values = ('%s' for _ in xrange(len(columns)))
-
-        return '\n'.join([INSERT + ' ' + INTO + ' ' + table + ' (',
-                          '  ' + SEP.join(columns),
-                          ')',
-                          VALUES + ' ( ',
-                          '  ' + ', '.join(values),
-                          ')'])
+        return self.compiled().insert
 
     def insert_params(self):
-        return tuple(
-            self.get(k) for k in iterkeys(self._fields) if k is not 'rowid')
+        return self.compiled().insert_params(self)
+
+
+class ObjectClassInfo(object):
+    """Object class metadata, computed once per class.
+
+    Provides the table name, column list, compiled SQL statements, compiled
+    validator and sync batch limits of an application model class."""
+
+    def __init__(self, model_class):
+        self.model_class = model_class
+        self.name = model_class.__name__
+        self.sql = model_class.compiled()
+        self.table = self.sql.table
+        self.columns = self.sql.columns
+        self.max_objects = model_class.SYNC_MAX_OBJECTS
+        self.max_bytes = model_class.SYNC_MAX_BYTES
+        self.validator = compiled_validator(model_class)
+
+
+def object_class_registry(module):
+    """Build the object class registry of an application model module.
+
+    :param module: module defining the BaseAppModel subclasses (app_model).
+    :return: dict of object class name to ObjectClassInfo.
+    """
+
+    registry = {}
+
+    for name, obj in vars(module).items():
+        if ('_' not in name
+                and inspect.isclass(obj)
+                and issubclass(obj, BaseAppModel)
+                and obj.__module__ == module.__name__):
+            registry[name] = ObjectClassInfo(obj)
+
+    return registry
@@ -0,0 +1,445 @@
+#!env/bin/python
+
+"""Tucker Sync benchmarks module.
+
+Micro benchmarks comparing implementation alternatives.
+Benchmarks requiring a database use the configured database.
+
+Usage:
+    ./benchmarks.py <benchmark> [options]
+    benchmarks.py [-h] {sync-count,json,client-uuid} ...
+
+Benchmarks:
+    sync-count   contention of the session sync count allocators, parallel
+                 processes each allocating and committing sessions
+    json         installed JSON backends encoding and decoding a sync
+                 download response (no database required)
+    client-uuid  Client UUID unique index size and lookup latency of the
+                 previous CHAR(36) and the BINARY(16) columns
+
+Usage examples:
+    ./benchmarks.py sync-count
+    ./benchmarks.py sync-count --processes 8 --sessions 500
+    ./benchmarks.py json --objects 5000
+    ./benchmarks.py client-uuid --clients 1000000
+
+License:
+    The MIT License (MIT), see LICENSE.txt for more details.
+
+Copyright:
+    Copyright (c) 2014 Steven Tucker and Gavin Kromhout.
+"""
+
+import argparse
+import random
+import uuid
+from multiprocessing import Process, Queue
+from time import time
+
+from common import SyncCount, JSON_BACKENDS, JSON_DUMPS_BACKEND, \
+    JSON_LOADS_BACKEND, json_backend_functions, json_dumps_compatible, \
+    json_loads_compatible
+
+# SyncCount object class used by the benchmark sessions.
+# Not an app_model class, other object classes are left untouched.
+BENCHMARK_OBJECT_CLASS = 'Benchmark'
+
+
+def percentile(values, p):
+    """Return the p (0.0 to 1.0) percentile of values."""
+
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def print_result(name, count, elapsed, timings):
+    """Print a result row, timings are in seconds."""
+
+    print '%-12s %8d %10.1f/s %9.2f ms %9.2f ms' % (
+        name,
+        count,
+        count / elapsed,
+        sum(timings) / len(timings) * 1000,
+        percentile(timings, 0.95) * 1000)
+
+
+def print_header(label):
+    """Print the result header."""
+
+    print '%-12s %8s %12s %12s %12s' % (label, 'count', 'rate',
+                                        'mean', 'p95')
+
+
+########################
+# Sync Count Allocator #
+########################
+
+
+def allocate_sequence(cursor, sc):
+    """Allocate a session sync count with the SELECT_SESSION_SC sequence."""
+
+    for stmt, params in zip(SyncCount.SELECT_SESSION_SC,
+                            sc.select_session_sc_params()):
+        cursor.execute(stmt, params)
+
+    return cursor.fetchall()[0]['sync_count']
+
+
+def allocate_insert(cursor, sc):
+    """Allocate a session sync count with the insert allocator."""
+
+    cursor.execute(SyncCount.INSERT, sc.insert_params())
+    sync_count = cursor.lastrowid
+    cursor.execute('COMMIT')
+
+    return sync_count
+
+
+ALLOCATORS = (('sequence', allocate_sequence),
+              ('insert', allocate_insert))
+
+
+def run_sessions(allocate, sessions, queue):
+    """Allocate and commit sessions, put the allocation timings on queue."""
+
+    from server import open_db, close_db
+
+    cursor, cnx, errno = open_db()
+    if errno:
+        queue.put(None)
+        return
+
+    sc = SyncCount()
+    sc.object_class = BENCHMARK_OBJECT_CLASS
+    timings = []
+
+    for i in xrange(sessions):
+        start = time()
+        sc.sync_count = allocate(cursor, sc)
+        timings.append(time() - start)
+
+        # Data transaction statements would be here.
+        cursor.execute(SyncCount.UPDATE_SET_IS_COMMITTED,
+                       sc.update_set_is_committed_params())
+        cnx.commit()
+
+    close_db(cursor, cnx)
+    queue.put(timings)
+
+
+def delete_benchmark_sessions():
+    """Delete all the benchmark sessions."""
+
+    from server import execute_statement
+
+    sql_result = execute_statement(
+        statement="""DELETE FROM SyncCount WHERE objectClass = %s""",
+        params=(BENCHMARK_OBJECT_CLASS,),
+        is_select=False)
+
+    assert not sql_result.errno, sql_result.err_msg
+
+
+def delete_trailing_committed():
+    """Delete the trailing committed benchmark sessions (janitor).
+
+    Return the elapsed seconds."""
+
+    from server import execute_statement
+
+    sc = SyncCount()
+    sc.object_class = BENCHMARK_OBJECT_CLASS
+
+    start = time()
+    sql_result = execute_statement(
+        statement=SyncCount.DELETE_TRAILING_COMMITTED_BELOW_MAX,
+        params=sc.delete_trailing_committed_below_max_params(),
+        is_select=False)
+    elapsed = time() - start
+
+    assert not sql_result.errno, sql_result.err_msg
+
+    return elapsed
+
+
+def bench_sync_count(cmd_args):
+    """Compare the session sync count allocators under contention."""
+
+    print 'processes = %s, sessions per process = %s\n' % (
+        cmd_args.processes, cmd_args.sessions)
+    print_header('allocator')
+
+    for name, allocate in ALLOCATORS:
+        delete_benchmark_sessions()
+
+        queue = Queue()
+        processes = [Process(target=run_sessions,
+                             args=(allocate, cmd_args.sessions, queue))
+                     for i in xrange(cmd_args.processes)]
+
+        start = time()
+        for p in processes:
+            p.start()
+        results = [queue.get() for p in processes]
+        elapsed = time() - start
+        for p in processes:
+            p.join()
+
+        assert None not in results, 'database connection failed'
+
+        timings = []
+        for result in results:
+            timings.extend(result)
+
+        print_result(name, len(timings), elapsed, timings)
+
+        if name == 'insert':
+            print '%-12s %8s %10.2f ms (out of the request path)' % (
+                'janitor', '', delete_trailing_committed() * 1000)
+
+    delete_benchmark_sessions()
+
+
+################
+# JSON Backend #
+################
+
+
+def sync_down_response(objects):
+    """Return a sync download response primitive of Product objects."""
+
+    from app_model import Product
+
+    primitives = []
+    for i in xrange(objects):
+        primitive = {}
+        for name in Product.compiled().fields:
+            primitive[name] = 1000000 + i
+        primitive['deleted'] = False
+        primitive['name'] = u'Product name %s, caf\xe9 / 100g' % i
+        primitives.append(primitive)
+
+    return {'error': 0,
+            'committedSyncCount': 1000000 + objects,
+            'moreObjects': False,
+            'objects': primitives}
+
+
+def best_time(func, arg, repeat):
+    """Return the best elapsed seconds of repeat calls of func(arg)."""
+
+    best = None
+    for i in xrange(repeat):
+        start = time()
+        func(arg)
+        elapsed = time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+
+    return best
+
+
+def bench_json(cmd_args):
+    """Compare the installed JSON backends on a sync download response."""
+
+    response = sync_down_response(cmd_args.objects)
+
+    print 'objects = %s, repeat = %s' % (cmd_args.objects, cmd_args.repeat)
+    print 'selected dumps = %s, loads = %s\n' % (JSON_DUMPS_BACKEND,
+                                                 JSON_LOADS_BACKEND)
+    print '%-12s %12s %12s %10s' % ('backend', 'dumps', 'loads', 'size')
+
+    for name in JSON_BACKENDS:
+        try:
+            dumps, loads = json_backend_functions(name)
+        except ImportError:
+            print '%-12s not installed' % name
+            continue
+
+        # Incompatible results are marked with a *.
+        js = dumps(response)
+        print '%-12s %9.2f ms%s %9.2f ms%s %10d' % (
+            name,
+            best_time(dumps, response, cmd_args.repeat) * 1000,
+            json_dumps_compatible(dumps) and ' ' or '*',
+            best_time(loads, js, cmd_args.repeat) * 1000,
+            json_loads_compatible(loads) and ' ' or '*',
+            len(js))
+
+    print '\n* results differ from the stdlib json module, not selected'
+
+
+###############
+# Client UUID #
+###############
+
+
+# Benchmark tables, (name, UUID column type, UUID parameter format).
+# Not the Client table, it is left untouched.
+CLIENT_UUID_TABLES = (
+    ('BenchmarkClientChar', 'CHAR(36)', '%s'),
+    ('BenchmarkClientBinary', 'BINARY(16)', 'UNHEX(%s)'),
+)
+
+# Rows per multi row INSERT.
+CLIENT_UUID_INSERT_ROWS = 1000
+
+
+def create_client_uuid_tables(cursor, clients):
+    """Create and fill the benchmark tables with clients random UUIDs.
+
+    Return a sample of the inserted UUIDs."""
+
+    char_table = CLIENT_UUID_TABLES[0][0]
+
+    drop_client_uuid_tables(cursor)
+    for table, column_type, param in CLIENT_UUID_TABLES:
+        cursor.execute("""CREATE TABLE %s (
+              id INT UNSIGNED NOT NULL AUTO_INCREMENT PRIMARY KEY,
+              userId INT UNSIGNED NOT NULL,
+              UUID %s UNIQUE NOT NULL
+            ) ENGINE=INNODB""" % (table, column_type))
+
+    sample = []
+    for start in xrange(0, clients, CLIENT_UUID_INSERT_ROWS):
+        uuids = [uuid.uuid4() for i in xrange(
+            min(CLIENT_UUID_INSERT_ROWS, clients - start))]
+        sample.append(random.choice(uuids))
+        cursor.execute(
+            'INSERT INTO %s (userId, UUID) VALUES %s' % (
+                char_table, ', '.join(['(1, %s)'] * len(uuids))),
+            [str(u) for u in uuids])
+        cursor.execute('COMMIT')
+
+    # The same UUIDs, converted as by the app_setup migration.
+    cursor.execute("""INSERT INTO %s (userId, UUID)
+        SELECT userId, UNHEX(REPLACE(UUID, '-', '')) FROM %s""" % (
+        CLIENT_UUID_TABLES[1][0], char_table))
+    cursor.execute('COMMIT')
+
+    return sample
+
+
+def drop_client_uuid_tables(cursor):
+    """Drop the benchmark tables, if existing."""
+
+    # No notes (warnings) for nonexistent tables, see app_setup.py.
+    cursor.execute('SET sql_notes = 0')
+    for table, column_type, param in CLIENT_UUID_TABLES:
+        cursor.execute('DROP TABLE IF EXISTS %s' % table)
+    cursor.execute('SET sql_notes = 1')
+
+
+def index_length(cursor, table):
+    """Return the secondary indexes (UUID) size in bytes of table."""
+
+    cursor.execute('ANALYZE TABLE %s' % table)
+    cursor.fetchall()
+    cursor.execute("""SELECT INDEX_LENGTH AS length
+        FROM information_schema.TABLES
+        WHERE TABLE_SCHEMA = DATABASE()
+          AND TABLE_NAME = %s""", (table,))
+
+    return cursor.fetchall()[0]['length']
+
+
+def bench_client_uuid(cmd_args):
+    """Compare the CHAR(36) and BINARY(16) Client UUID columns."""
+
+    from server import open_db, close_db
+
+    cursor, cnx, errno = open_db()
+    assert not errno, 'database connection failed'
+
+    print 'clients = %s, lookups = %s\n' % (cmd_args.clients,
+                                           cmd_args.lookups)
+
+    try:
+        sample = create_client_uuid_tables(cursor, cmd_args.clients)
+        lookups = [random.choice(sample) for i in xrange(cmd_args.lookups)]
+
+        print_header('column')
+        sizes = []
+        for table, column_type, param in CLIENT_UUID_TABLES:
+            statement = 'SELECT id FROM %s WHERE UUID = %s' % (table, param)
+            to_param = str if param == '%s' else lambda u: u.hex
+
+            timings = []
+            start = time()
+            for u in lookups:
+                lookup_start = time()
+                cursor.execute(statement, (to_param(u),))
+                assert 1 == len(cursor.fetchall())
+                timings.append(time() - lookup_start)
+            elapsed = time() - start
+
+            print_result(column_type, len(timings), elapsed, timings)
+            sizes.append((column_type, index_length(cursor, table)))
+
+        print '\n%-12s %12s' % ('column', 'index size')
+        for column_type, size in sizes:
+            print '%-12s %9.1f MB' % (column_type, size / 1048576.0)
+    finally:
+        drop_client_uuid_tables(cursor)
+        close_db(cursor, cnx)
+
+
+def get_cmd_args():
+    """Get the command line arguments."""
+
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(title='benchmarks')
+
+    sync_count = subparsers.add_parser(
+        'sync-count',
+        help='contention of the session sync count allocators')
+    sync_count.add_argument('--processes',
+                            help='parallel processes (default: 4)',
+                            type=int,
+                            default=4)
+    sync_count.add_argument('--sessions',
+                            help='sessions per process (default: 200)',
+                            type=int,
+                            default=200)
+    sync_count.set_defaults(func=bench_sync_count)
+
+    json_backend = subparsers.add_parser(
+        'json',
+        help='installed JSON backends on a sync download response')
+    json_backend.add_argument('--objects',
+                              help='objects in the response (default: 1000)',
+                              type=int,
+                              default=1000)
+    json_backend.add_argument('--repeat',
+                              help='best of repeat runs (default: 10)',
+                              type=int,
+                              default=10)
+    json_backend.set_defaults(func=bench_json)
+
+    client_uuid = subparsers.add_parser(
+        'client-uuid',
+        help='Client UUID CHAR(36) and BINARY(16) index size and lookups')
+    client_uuid.add_argument('--clients',
+                             help='clients in each table (default: 1000000)',
+                             type=int,
+                             default=1000000)
+    client_uuid.add_argument('--lookups',
+                             help='UUID lookups (default: 10000)',
+                             type=int,
+                             default=10000)
+    client_uuid.set_defaults(func=bench_client_uuid)
+
+    return parser.parse_args()
+
+
+def main():
+    """Main function."""
+
+    cmd_args = get_cmd_args()
+    cmd_args.func(cmd_args)
+
+
+# Run main when commands read either from standard input,
+# from a script file, or from an interactive prompt.
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+"""Tucker Sync cache module.
+
+Small in-process caches used by the server.
+
+License:
+    The MIT License (MIT), see LICENSE.txt for more details.
+
+Copyright:
+    Copyright (c) 2014 Steven Tucker and Gavin Kromhout.
+"""
+
+import threading
+from time import time
+
+try:
+    from collections import OrderedDict
+except ImportError:
+    # Python 2.6
+    from ordereddict import OrderedDict
+
+
+class TTLCache(object):
+    """Bounded least recently used cache with a time to live.
+
+    Entries expire ttl seconds after being set. When the cache is full the
+    least recently used entry is evicted. A max_size of 0 disables the cache.
+    Thread safe.
+    """
+
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        """Return the unexpired value for key, otherwise default."""
+
+        with self._lock:
+            try:
+                value, expires = self._data.pop(key)
+            except KeyError:
+                return default
+
+            if expires < time():
+                return default
+
+            # Re-insert as the most recently used.
+            self._data[key] = value, expires
+            return value
+
+    def set(self, key, value):
+        """Set the value for key, evicting the least recently used if full."""
+
+        if self.max_size <= 0:
+            return
+
+        with self._lock:
+            self._data.pop(key, None)
+            while len(self._data) >= self.max_size:
+                self._data.popitem(last=False)
+            self._data[key] = value, time() + self.ttl
+
+    def pop(self, key, default=None):
+        """Remove key and return its unexpired value, otherwise default."""
+
+        with self._lock:
+            try:
+                value, expires = self._data.pop(key)
+            except KeyError:
+                return default
+
+        if expires < time():
+            return default
+
+        return value
+
+    def clear(self):
+        """Remove all entries."""
+
+        with self._lock:
+            self._data.clear()
@@ -16,7 +16,8 @@ import requests
 import uuid
 
 from common import APIRequestType, JSONKey, APIErrorCode, HTTP, JSON, Logger, \
-    APIRequest, AccountOpenRequestBody, AccountModifyRequestBody
+    APIRequest, AccountOpenRequestBody, AccountModifyRequestBody, \
+    SessionOpenRequestBody, ContentEncoding, CODECS
 
 LOG = Logger(__file__)
 
@@ -24,15 +25,41 @@ LOG = Logger(__file__)
 class Client(object):
     """A Tucker Sync Client Implementation."""
 
-    def __init__(self, base_url, key, email, password):
+    def __init__(self, base_url, key, email, password, codec=JSON):
         self.request = APIRequest()
+        # Session token, cleared when the server or credentials change.
+        self.token = None
+        # A session open failed (e.g. no such account or wrong password),
+        # not retried until the server or credentials change.
+        self.session_open_failed = False
+        # Authenticate the test and sync requests with a session token,
+        # opened with the email and password on first use.
+        self.session_tokens = True
+        self.codec = codec
         self.base_url = base_url
         self.key = key
         self.email = email
         self.password = password
         self.UUID = uuid.uuid4()
+        # Request bodies of at least this size are sent gzip compressed.
+        # None disables compression.
+        self.compress_min_size = ContentEncoding.MIN_SIZE
         # TODO init storage.
 
+    @property
+    def codec(self):
+        """The wire format codec of request and response bodies.
+
+        JSON by default, or MsgPack (see common.CODECS)."""
+
+        return self._codec
+
+    @codec.setter
+    def codec(self, codec):
+        self._codec = codec
+        self.request.accept = codec.CONTENT_TYPE
+        self.request.content_type = codec.CONTENT_TYPE
+
     @property
     def base_url(self):
         return self.request.base_url
@@ -40,6 +67,7 @@ class Client(object):
     @base_url.setter
     def base_url(self, base_url):
         self.request.base_url = base_url
+        self.reset_session()
 
     @property
     def key(self):
@@ -48,6 +76,7 @@ class Client(object):
     @key.setter
     def key(self, key):
         self.request.key = key
+        self.reset_session()
 
     @property
     def email(self):
@@ -56,6 +85,7 @@ class Client(object):
     @email.setter
     def email(self, email):
         self.request.email = email
+        self.reset_session()
 
     @property
     def password(self):
@@ -64,6 +94,13 @@ class Client(object):
     @password.setter
     def password(self, password):
         self.request.password = password
+        self.reset_session()
+
+    def reset_session(self):
+        """Clear the session token and allow a new session open."""
+
+        self.token = None
+        self.session_open_failed = False
 
     def check_connection(self):
         """Check the connection to the server.
@@ -102,13 +139,50 @@ class Client(object):
         # Success
         return True
 
+    def session_open(self):
+        """Open a session on the server, setting the session token.
+
+        Session tokens are disabled if the server does not support them.
+        After an API error no session is opened (see post_request) until
+        the server or credentials change."""
+
+        self.token = None
+
+        rb = SessionOpenRequestBody()
+        rb.clientUUID = self.UUID
+
+        try:
+            js = self.get_json_request_string(rb)
+            jo = self.send_request(APIRequestType.SESSION_OPEN, js)
+        except ClientException:
+            LOG.debug(self, 'Session open failed with an exception.')
+            return False
+
+        error_code = jo[JSONKey.ERROR]
+
+        if error_code == APIErrorCode.REQUEST_TYPE_UNSUPPORTED:
+            LOG.debug(self, 'Session tokens are not supported by the server.')
+            self.session_tokens = False
+
+        if error_code != APIErrorCode.SUCCESS:
+            self.session_open_failed = True
+            LOG.debug(self, 'Session open failed with API error code = %s',
+                      error_code)
+            LOG.debug(self, 'Session open failed with API error name = %s',
+                      APIErrorCode.name(error_code))
+            return False
+
+        # Success
+        self.token = jo.get('token')
+        return self.token is not None
+
     def account_open(self):
         """Open a new account on the server."""
 
         rb = AccountOpenRequestBody()
         rb.clientUUID = self.UUID
 
-        js = JSON.dumps(rb.to_primitive())
+        js = self.codec.dumps(rb.to_primitive())
 
         try:
             jo = self.post_request(APIRequestType.ACCOUNT_OPEN, js)
@@ -125,7 +199,8 @@ class Client(object):
                       APIErrorCode.name(error_code))
             return False
 
-        # Success
+        # Success, a session may now be opened.
+        self.reset_session()
         return True
 
     def account_close(self):
@@ -146,7 +221,8 @@ class Client(object):
                       APIErrorCode.name(error_code))
             return False
 
-        # Success
+        # Success, the token is revoked with the account on the server.
+        self.reset_session()
         return True
 
     def account_modify(self, new_email, new_password):
@@ -177,11 +253,15 @@ class Client(object):
                       APIErrorCode.name(error_code))
             return False
 
-        # Success
+        # Success, the token is revoked with the old credentials on the server.
+        self.reset_session()
         return True
 
     def get_json_request_string(self, model):
-        """Get json request string from model or raise a ClientException."""
+        """Get the encoded request string from model.
+
+        Encoded by the client codec (JSON by default).
+        Return the string or raise a ClientException."""
 
         # Validate before conversion.
         try:
@@ -191,9 +271,9 @@ class Client(object):
             raise ClientException
 
         try:
-            js = JSON.dumps(model.to_primitive())
+            js = self.codec.dumps(model.to_primitive())
         except Exception as e:
-            LOG.debug(self, 'JSON dumps exception = %s' % e)
+            LOG.debug(self, 'dumps exception = %s' % e)
             raise ClientException
 
         return js
@@ -201,21 +281,67 @@ class Client(object):
     def post_request(self, api_request_type, data=None):
         """Post the request.
 
+        Test and sync requests are authenticated by the session token.
+        The session is opened on first use and re-opened once the token has
+        expired, otherwise (session open failed) the email and password are
+        sent.
+        Return the response json object (Python dictionary) or
+        raise an exception."""
+
+        if not self.session_tokens or \
+                api_request_type not in APIRequestType.TOKEN_AUTH:
+            return self.send_request(api_request_type, data)
+
+        if self.token is None and not self.session_open_failed:
+            self.session_open()
+
+        if self.token is None:
+            return self.send_request(api_request_type, data)
+
+        jo = self.send_request(api_request_type, data, self.token)
+        if jo[JSONKey.ERROR] != APIErrorCode.AUTH_FAIL:
+            return jo
+
+        LOG.debug(self, 'Session token auth fail, re-opening the session.')
+        if not self.session_open():
+            return jo
+
+        return self.send_request(api_request_type, data, self.token)
+
+    def send_request(self, api_request_type, data=None, token=None):
+        """Send the request, authenticated by token if given.
+
         Return the response json object (Python dictionary) or
         raise an exception."""
 
         self.request.type = api_request_type
         self.request.body = data
+        self.request.content_encoding = None
+
+        body = self.request.body
+        if body and self.compress_min_size is not None and \
+                len(body) >= self.compress_min_size:
+            if isinstance(body, unicode):
+                body = body.encode('utf-8')
+            body = ContentEncoding.compress(body, ContentEncoding.GZIP)
+            self.request.content_encoding = ContentEncoding.GZIP
+
+        params = self.request.params
+        if token:
+            params.pop('email', None)
+            params.pop('password', None)
+            params['token'] = token
 
         LOG.debug(self, 'base_url = %s', self.request.base_url)
-        LOG.debug(self, 'params = %s', self.request.params)
+        LOG.debug(self, 'params = %s', params)
         LOG.debug(self, 'headers= %s', self.request.headers)
-        LOG.debug(self, 'body = %s', self.request.body)
+        LOG.debug(self, 'body = %r', self.request.body)
 
+        # The response body is decompressed by requests (Content-Encoding).
         try:
             response = requests.post(self.request.base_url,
-                                     self.request.body,
-                                     params=self.request.params,
+                                     body,
+                                     params=params,
                                      headers=self.request.headers)
         except Exception as e:
             LOG.debug(self, 'Request post failed with exception = %s', e)
@@ -233,19 +359,23 @@ class Client(object):
     def get_json_object(response):
         """Get the json object (Python dictionary) from the response.
 
+         Decoded by the codec of the response Content-Type, otherwise JSON.
          Return jo or raise an exception."""
 
         LOG.debug(Client, 'status_code = %s', response.status_code)
-        LOG.debug(Client, 'content = %s', response.content)
+        LOG.debug(Client, 'content = %r', response.content)
 
         if response.status_code != HTTP.OK:
             LOG.debug(Client, 'HTTP status code != HTTP.OK')
             raise ClientException
 
+        headers = getattr(response, 'headers', None) or {}
+        codec = CODECS.get(headers.get('Content-Type'), JSON)
+
         try:
-            jo = JSON.loads(response.content)
+            jo = codec.loads(response.content)
         except Exception as e:
-            LOG.debug(Client, 'JSON.loads exception = %s', e)
+            LOG.debug(Client, 'loads exception = %s', e)
             raise ClientException
 
         if not type(jo) is dict:
@@ -13,6 +13,8 @@ import inspect
 import json
 import logging
 import os
+import timeit
+import zlib
 from schematics.models import Model
 from schematics.types import StringType, IntType, BaseType, LongType, \
     EmailType, UUIDType, URLType, BooleanType
@@ -21,6 +23,12 @@ from schematics.transforms import whitelist
 
 from app_config import USER_PASSWORD_MIN_LEN
 
+try:
+    import msgpack
+except ImportError:
+    # MessagePack support is optional.
+    msgpack = None
+
 
 class Logger(object):
     """Custom logger wrapper.
@@ -119,10 +127,16 @@ class APIRequestType(object):
     BASE_DATA_DOWN = 'baseDataDown'
     SYNC_DOWN = 'syncDown'
     SYNC_UP = 'syncUp'
+    SYNC_BATCH = 'syncBatch'
+    SYNC_PROBE = 'syncProbe'
+    SESSION_OPEN = 'sessionOpen'
     ACCOUNT_OPEN = 'accountOpen'
     ACCOUNT_CLOSE = 'accountClose'
     ACCOUNT_MODIFY = 'accountModify'
 
+    # Request types accepting a session token instead of email and password.
+    TOKEN_AUTH = (TEST, SYNC_DOWN, SYNC_UP, SYNC_BATCH, SYNC_PROBE)
+
 
 class JSONKey(object):
     """The JSON key constants."""
@@ -146,6 +160,7 @@ class APIErrorCode(object):
     EMAIL_NOT_UNIQUE = 8
     CLIENT_UUID_NOT_UNIQUE = 9
     FULL_SYNC_REQUIRED = 10
+    REQUEST_TYPE_UNSUPPORTED = 11
 
     @classmethod
     def name(cls, error_code):
@@ -183,33 +198,230 @@ class APIErrorResponse(object):
         JSONKey.ERROR, APIErrorCode.CLIENT_UUID_NOT_UNIQUE)
     FULL_SYNC_REQUIRED = '{"%s":%s}' % (
         JSONKey.ERROR, APIErrorCode.FULL_SYNC_REQUIRED)
+    REQUEST_TYPE_UNSUPPORTED = '{"%s":%s}' % (
+        JSONKey.ERROR, APIErrorCode.REQUEST_TYPE_UNSUPPORTED)
 
 
 class HTTP(object):
     """HTTP constants."""
 
     OK = 200
+    SEE_OTHER = 303
+    NOT_MODIFIED = 304
 
 
 CONTENT_TYPE_APP_JSON = 'application/json'
+CONTENT_TYPE_APP_MSGPACK = 'application/x-msgpack'
+
+
+class ContentEncoding(object):
+    """HTTP content (compression) encodings.
+
+    deflate is the zlib format (RFC 1950) as specified by HTTP, a raw deflate
+    stream is also accepted when decompressing."""
+
+    IDENTITY = 'identity'
+    GZIP = 'gzip'
+    DEFLATE = 'deflate'
+
+    # In order of preference.
+    SUPPORTED = (GZIP, DEFLATE)
+
+    # Accept-Encoding header value.
+    ACCEPT = 'gzip, deflate'
+
+    # Bodies smaller than this are not worth compressing.
+    MIN_SIZE = 1024
+
+    DEFAULT_LEVEL = 6
+
+    # zlib window bits by encoding.
+    WBITS = {GZIP: 16 + zlib.MAX_WBITS,
+             DEFLATE: zlib.MAX_WBITS}
+
+    @staticmethod
+    def compressobj(encoding, level=DEFAULT_LEVEL):
+        """Return a compression object for the encoding."""
+
+        return zlib.compressobj(level, zlib.DEFLATED,
+                                ContentEncoding.WBITS[encoding])
+
+    @staticmethod
+    def compress(data, encoding, level=DEFAULT_LEVEL):
+        """Compress data with the encoding."""
+
+        c = ContentEncoding.compressobj(encoding, level)
+        return c.compress(data) + c.flush()
+
+    @staticmethod
+    def compress_iter(chunks, encoding, level=DEFAULT_LEVEL):
+        """Compress an iterable of data chunks with the encoding.
+
+        Yield the compressed chunks."""
+
+        c = ContentEncoding.compressobj(encoding, level)
+        for chunk in chunks:
+            data = c.compress(chunk)
+            if data:
+                yield data
+        yield c.flush()
+
+    @staticmethod
+    def decompress(data, encoding, max_size):
+        """Decompress data with the encoding.
+
+        Raise ValueError if the decompressed size exceeds max_size,
+        guarding against decompression bombs. Raise zlib.error if the data
+        is invalid."""
+
+        wbits = ContentEncoding.WBITS[encoding]
+        try:
+            d = zlib.decompressobj(wbits)
+            decoded = d.decompress(data, max_size + 1)
+        except zlib.error:
+            if encoding != ContentEncoding.DEFLATE:
+                raise
+            # Raw deflate stream (without the zlib header).
+            d = zlib.decompressobj(-zlib.MAX_WBITS)
+            decoded = d.decompress(data, max_size + 1)
+
+        if len(decoded) > max_size or d.unconsumed_tail:
+            raise ValueError('decompressed size exceeds %s' % max_size)
+
+        return decoded
+
+
+# JSON backend module candidates, the fastest compatible one is selected.
+# The stdlib json module is the reference and the fallback.
+JSON_BACKENDS = ('ujson', 'simplejson', 'json')
+
+# Timing of the candidates at import, calls per repeat and repeats (best of).
+JSON_TIMING_NUMBER = 10
+JSON_TIMING_REPEAT = 3
+
+JSON_COMPACT_SEPARATORS = (',', ':')
+
+# Probe of a JSON backend for output identical to the stdlib json module
+# (compact separators, ASCII only). Covers the differences seen between
+# backends: float formatting, escaping of '/', non ASCII and control
+# characters and large integers.
+JSON_PROBE = {u'floats': [0.1, 1.0 / 3, 1e-07, 1e16, 123456789.123456789,
+                          -0.0, 2.5],
+              u'strings': [u'a/b', u'\xe9\u20ac\U0001f600',
+                           u'\x00\x1f"\\\n\t', 'str'],
+              u'integers': [0, -1, 2 ** 63 - 1, 2 ** 64 - 1],
+              u'constants': [True, False, None],
+              u'objects': {u'empty': {}, u'list': []}}
+
+
+def json_backend_functions(name):
+    """Return the (dumps, loads) functions of the named JSON backend module.
+
+    Raise ImportError if the module is not installed."""
+
+    module = __import__(name)
+
+    if name == 'ujson':
+        def dumps(obj):
+            return module.dumps(obj, ensure_ascii=True,
+                                escape_forward_slashes=False)
+    else:
+        def dumps(obj):
+            return module.dumps(obj, separators=JSON_COMPACT_SEPARATORS)
+
+    return dumps, module.loads
+
+
+def json_dumps_compatible(dumps):
+    """Return True if dumps output matches the stdlib json module."""
+
+    reference = json.dumps(JSON_PROBE, separators=JSON_COMPACT_SEPARATORS)
+
+    try:
+        return dumps(JSON_PROBE) == reference
+    except Exception:
+        return False
+
+
+def json_loads_compatible(loads):
+    """Return True if loads results match the stdlib json module."""
+
+    reference = json.dumps(JSON_PROBE, separators=JSON_COMPACT_SEPARATORS)
+
+    try:
+        return loads(reference) == json.loads(reference)
+    except Exception:
+        return False
+
+
+def json_time(func, arg):
+    """Return the best time (seconds) of JSON_TIMING_NUMBER func(arg) calls."""
+
+    timer = timeit.Timer(lambda: func(arg))
+    return min(timer.repeat(JSON_TIMING_REPEAT, JSON_TIMING_NUMBER))
+
+
+def select_json_backend(names=JSON_BACKENDS):
+    """Select the fastest installed compatible backend for dumps and loads.
+
+    Selected separately, e.g. a backend may parse identically but format
+    floats differently. Each compatible backend is timed on a list of probes,
+    the stdlib json module is selected unless another is faster.
+    Return (dumps name, dumps, loads name, loads)."""
+
+    sample = [JSON_PROBE] * 10
+    encoded = json.dumps(sample, separators=JSON_COMPACT_SEPARATORS)
+
+    dumps, loads = json_backend_functions('json')
+    selected = {'dumps': (json_time(dumps, sample), 'json', dumps),
+                'loads': (json_time(loads, encoded), 'json', loads)}
+
+    for name in names:
+        if name == 'json':
+            continue
+        try:
+            dumps, loads = json_backend_functions(name)
+        except ImportError:
+            continue
+        if json_dumps_compatible(dumps):
+            seconds = json_time(dumps, sample)
+            if seconds < selected['dumps'][0]:
+                selected['dumps'] = seconds, name, dumps
+        if json_loads_compatible(loads):
+            seconds = json_time(loads, encoded)
+            if seconds < selected['loads'][0]:
+                selected['loads'] = seconds, name, loads
+
+    return selected['dumps'][1:] + selected['loads'][1:]
+
+
+# Selected once at import.
+JSON_DUMPS_BACKEND, _json_dumps, JSON_LOADS_BACKEND, _json_loads = \
+    select_json_backend()
 
 
 class JSON(object):
-    """Custom json wrapper."""
+    """Custom json wrapper.
+
+    Uses the fastest installed backends with results identical to the stdlib
+    json module (see select_json_backend). Also the default wire format
+    codec, see CODECS."""
+
+    CONTENT_TYPE = CONTENT_TYPE_APP_JSON
 
-    COMPACT_SEPARATORS = (',', ':')
+    COMPACT_SEPARATORS = JSON_COMPACT_SEPARATORS
 
     @staticmethod
     def dumps(obj):
         """Dump an object to a compact json string."""
 
-        return json.dumps(obj, separators=JSON.COMPACT_SEPARATORS)
+        return _json_dumps(obj)
 
     @staticmethod
     def loads(s):
         """Load a string and return a Python native json object."""
 
-        return json.loads(s)
+        return _json_loads(s)
 
     @staticmethod
     def load(fp):
@@ -217,7 +429,70 @@ class JSON(object):
 
         Return a Python native json object."""
 
-        return json.load(fp)
+        return _json_loads(fp.read())
+
+    @staticmethod
+    def dumps_objects(envelope, encoded_objects):
+        """Dump the envelope object with the already encoded objects list."""
+
+        return '%s,"%s":[%s]}' % (JSON.dumps(envelope)[:-1],
+                                  JSONKey.OBJECTS,
+                                  ','.join(encoded_objects))
+
+
+class MsgPack(object):
+    """MessagePack wire format codec (requires msgpack-python).
+
+    Strings are packed as the raw type and unpacked as utf-8."""
+
+    CONTENT_TYPE = CONTENT_TYPE_APP_MSGPACK
+
+    @staticmethod
+    def dumps(obj):
+        """Dump an object to a MessagePack string."""
+
+        return msgpack.packb(obj)
+
+    @staticmethod
+    def loads(s):
+        """Load a MessagePack string and return a Python native object."""
+
+        return msgpack.unpackb(s, encoding='utf-8')
+
+    @staticmethod
+    def dumps_objects(envelope, encoded_objects):
+        """Dump the envelope object with the already encoded objects list."""
+
+        packer = msgpack.Packer()
+        parts = [packer.pack_map_header(len(envelope) + 1)]
+        for key, value in envelope.items():
+            parts.append(packer.pack(key))
+            parts.append(packer.pack(value))
+        parts.append(packer.pack(JSONKey.OBJECTS))
+        parts.append(packer.pack_array_header(len(encoded_objects)))
+        parts.extend(encoded_objects)
+        return ''.join(parts)
+
+
+# Wire format codecs by content type, negotiated by Content-Type (request)
+# and Accept (response).
+# A codec provides CONTENT_TYPE, dumps, loads and dumps_objects.
+CODECS = {JSON.CONTENT_TYPE: JSON}
+if msgpack:
+    CODECS[MsgPack.CONTENT_TYPE] = MsgPack
+
+
+def error_responses(codec):
+    """Return the APIErrorResponse constants encoded by the codec.
+
+    A dict of the (JSON) constant to the codec encoded response."""
+
+    responses = {}
+    for name, value in vars(APIErrorResponse).items():
+        if name.isupper():
+            responses[value] = codec.dumps(JSON.loads(value))
+
+    return responses
 
 
 class APIRequest(Model):
@@ -233,18 +508,27 @@ class APIRequest(Model):
                             default='TuckerSync')
     accept = StringType(serialized_name='Accept',
                         default=CONTENT_TYPE_APP_JSON)
+    accept_encoding = StringType(serialized_name='Accept-Encoding',
+                                 default=ContentEncoding.ACCEPT)
     content_type = StringType(serialized_name='Content-Type',
                               default=CONTENT_TYPE_APP_JSON)
+    content_encoding = StringType(serialized_name='Content-Encoding',
+                                  serialize_when_none=False)
 
-    body = StringType()
+    # JSON str or MessagePack bytes.
+    body = BaseType()
 
     class Options(object):
         roles = {'params': whitelist('type', 'key', 'email', 'password'),
                  'base_headers': whitelist('user_agent'),
-                 'accept_headers': whitelist('user_agent', 'accept'),
+                 'accept_headers': whitelist('user_agent',
+                                             'accept',
+                                             'accept_encoding'),
                  'content_headers': whitelist('user_agent',
                                               'accept',
-                                              'content_type')}
+                                              'accept_encoding',
+                                              'content_type',
+                                              'content_encoding')}
 
     @property
     def params(self):
@@ -263,11 +547,16 @@ class APIRequest(Model):
 
 
 class SyncDownRequestBody(Model):
-    """Sync download request body model."""
+    """Sync download request body model.
+
+    lastObjectId is only sent when continuing a download (moreObjects), it is
+    the id of the last object received. Together with lastSync it forms the
+    keyset pagination cursor."""
 
     objectClass = StringType(required=True)
     clientUUID = UUIDType(required=True)
     lastSync = LongType(required=True)
+    lastObjectId = LongType()
 
 
 class BaseDataDownRequestBody(SyncDownRequestBody):
@@ -281,7 +570,47 @@ class SyncUpRequestBody(Model):
 
     objectClass = StringType(required=True)
     clientUUID = UUIDType(required=True)
-    objects = ListType(ModelType(Model), required=True)
+    # Plain objects, validated against the object class by the server.
+    objects = ListType(BaseType(), required=True)
+
+
+class SyncUpSection(Model):
+    """Sync batch upload section model, of one object class."""
+
+    objectClass = StringType(required=True)
+    objects = ListType(BaseType(), required=True)
+
+
+class SyncDownSection(Model):
+    """Sync batch download section model, of one object class."""
+
+    objectClass = StringType(required=True)
+    lastSync = LongType(required=True)
+    lastObjectId = LongType()
+
+
+class SyncBatchRequestBody(Model):
+    """Sync batch request body model.
+
+    Upload and download sections of several object classes.
+    Plain sections, validated as SyncUpSection and SyncDownSection."""
+
+    clientUUID = UUIDType(required=True)
+    syncUp = ListType(BaseType(), default=[])
+    syncDown = ListType(BaseType(), default=[])
+
+
+class SyncProbeRequestBody(Model):
+    """Sync probe request body model."""
+
+    clientUUID = UUIDType(required=True)
+    objectClasses = ListType(StringType(), required=True)
+
+
+class SessionOpenRequestBody(Model):
+    """Session open request body model."""
+
+    clientUUID = UUIDType(required=True)
 
 
 class AccountOpenRequestBody(Model):
@@ -304,6 +633,41 @@ class ResponseBody(Model):
     committedSyncCount = LongType(serialize_when_none=False)
     moreObjects = BooleanType(serialize_when_none=False)
     objects = BaseType(serialize_when_none=False)
+    # Error details, e.g. the errors of invalid sync up objects.
+    data = BaseType(serialize_when_none=False)
+    # The user's highest object lastSync (syncProbe).
+    lastSync = LongType(serialize_when_none=False)
+
+
+class SyncBatchResponseBody(Model):
+    """Sync batch response body model.
+
+    The sections are the (primitive) response bodies of each object class,
+    with an objectClass key."""
+
+    error = IntType(default=0)
+    syncUp = BaseType(serialize_when_none=False)
+    syncDown = BaseType(serialize_when_none=False)
+
+
+class SyncProbeResponseBody(Model):
+    """Sync probe response body model.
+
+    The (primitive) probe result of each object class, with an objectClass
+    key."""
+
+    error = IntType(default=0)
+    objectClasses = BaseType(serialize_when_none=False)
+
+
+class SessionOpenResponseBody(Model):
+    """Session open response body model.
+
+    expires is the token expiry in seconds since the epoch (UTC)."""
+
+    error = IntType(default=0)
+    token = StringType(serialize_when_none=False)
+    expires = LongType(serialize_when_none=False)
 
 
 class SQLResult(Model):
@@ -346,6 +710,21 @@ class SyncCount(Model):
     def select_committed_sc_params(self):
         return self.object_class, self.object_class
 
+    # Select the highest sync count by object class, otherwise 0.
+    # The version stamp of a cached committed sync count.
+    # A single index dive on INDEX(objectClass), which holds the primary key.
+    # Sync counts are only ever issued above the highest (auto_increment) and
+    # the highest session of a class is never deleted.
+    # Therefore if the committed sync count equalled the highest sync count
+    # (no uncommitted sessions) and the highest is unchanged, then no session
+    # has been issued since and the committed sync count is unchanged.
+    SELECT_MAX_SC = """SELECT COALESCE(MAX(syncCount), 0) AS sync_count
+        FROM SyncCount
+        WHERE objectClass = %s"""
+
+    def select_max_sc_params(self):
+        return self.object_class,
+
     # Insert uncommitted session for object class.
     INSERT = """INSERT INTO SyncCount (objectClass) VALUES (%s)"""
 
@@ -387,6 +766,35 @@ class SyncCount(Model):
                 None,
                 None)
 
+    # Insert allocator, the alternative to the SELECT_SESSION_SC sequence.
+    # Operation:
+    # The new uncommitted session is inserted and committed (INSERT, COMMIT).
+    # The session sync count is the insert id returned with the INSERT
+    # result (cursor.lastrowid), no further statements are required.
+    # Trailing committed sessions are not deleted in the request path, see
+    # DELETE_TRAILING_COMMITTED_BELOW_MAX and janitor.py.
+
+    # Delete committed sessions prior to the highest session of the class.
+    # Used by the janitor outside of the request path.
+    # The highest session is always kept since it provides the committed sync
+    # count when there are no uncommitted sessions. It also preserves the
+    # auto_increment value across a database restart.
+    # Committed sessions are only ever deleted below the highest session.
+    # Therefore the lowest uncommitted session and the committed sync count
+    # are unchanged.
+    # The derived table (with aggregate) is materialised before the delete.
+    DELETE_TRAILING_COMMITTED_BELOW_MAX = """DELETE SyncCount
+        FROM SyncCount
+        JOIN (SELECT MAX(syncCount) AS maxSyncCount
+              FROM SyncCount
+              WHERE objectClass = %s) AS head
+        WHERE SyncCount.objectClass = %s
+            AND SyncCount.isCommitted = 1
+            AND SyncCount.syncCount < head.maxSyncCount"""
+
+    def delete_trailing_committed_below_max_params(self):
+        return self.object_class, self.object_class
+
     # Mark session sync count as committed.
     # Marking the session committed must be atomic with the data commit.
     # However the session must still be marked as committed after a data
@@ -410,7 +818,7 @@ class SyncCount(Model):
     # The normal case of time jitter and drift/update should be handled by the
     # expiry time.
     # The committed rows will be deleted when the next session sync count is
-    # issued.
+    # issued (sequence allocator) or by the janitor (insert allocator).
     # If any rows are affected a warning should be logged:
     WARN_EXPIRED_SESSIONS_COMMITTED = (
         'There were uncommitted sessions over 1 hour 20 min in the'
@@ -435,23 +843,24 @@ class Client(Model):
     userId = LongType()
     UUID = UUIDType(serialized_name='clientUUID', required=True)
 
-    SELECT_BY_UUID = """SELECT id as rowid, userId, UUID
+    # The UUID is stored as BINARY(16), passed and selected as hex.
+    SELECT_BY_UUID = """SELECT id as rowid, userId, HEX(UUID) AS UUID
         FROM Client
-        WHERE UUID = %s"""
+        WHERE UUID = UNHEX(%s)"""
 
     def select_by_uuid_params(self):
-        return self.uuid,
+        return self.UUID.hex,
 
-    INSERT = """INSERT INTO Client (userId, UUID) VALUES (%s, %s)"""
+    INSERT = """INSERT INTO Client (userId, UUID) VALUES (%s, UNHEX(%s))"""
 
     def insert_params(self):
-        return self.userId, str(self.UUID)
+        return self.userId, self.UUID.hex
 
     INSERT_BY_LAST_INSERT_ID = """INSERT INTO Client (userId, UUID)
-        VALUES (LAST_INSERT_ID(), %s)"""
+        VALUES (LAST_INSERT_ID(), UNHEX(%s))"""
 
     def insert_by_last_insert_id_params(self):
-        return str(self.UUID),
+        return self.UUID.hex,
 
 
 class User(Model):
@@ -469,6 +878,13 @@ class User(Model):
     def select_by_email_params(self):
         return self.email,
 
+    SELECT_BY_ID = """SELECT id as rowid, email, password
+        FROM User
+        WHERE id = %s"""
+
+    def select_by_id_params(self):
+        return self.rowid,
+
     INSERT = """INSERT INTO User (email, password) VALUES (%s, %s)"""
 
     def insert_params(self):
@@ -493,12 +909,12 @@ class UserClient(User):
     client_rowid = LongType()
     UUID = UUIDType()
 
-    SELECT_BY_EMAIL = """SELECT u.id AS rowid, u.email, u.password,
-          c.id AS client_rowid, c.UUID
+    # One row, the client columns are NULL if the user has no such client.
+    SELECT_BY_EMAIL_CLIENT_UUID = """SELECT u.id AS rowid, u.email,
+          u.password, c.id AS client_rowid, HEX(c.UUID) AS UUID
         FROM User AS u
-        LEFT JOIN Client AS c ON c.userId = u.id
-        WHERE u.email = %s
-        LIMIT 100"""
+        LEFT JOIN Client AS c ON c.userId = u.id AND c.UUID = UNHEX(%s)
+        WHERE u.email = %s"""
 
-    def select_by_email_params(self):
-        return self.email,
+    def select_by_email_client_uuid_params(self):
+        return self.UUID and self.UUID.hex, self.email
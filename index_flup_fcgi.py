@@ -1,6 +1,8 @@
 #!env/bin/python
 
 from flup.server.fcgi import WSGIServer
-from server import application
+from server import application, start_hash_pool, start_janitor
 
+start_hash_pool()
+start_janitor()
 WSGIServer(application).run()
@@ -0,0 +1,225 @@
+#!env/bin/python
+
+"""Tucker Sync janitor module.
+
+Housekeeping of the SyncCount table, out of the request path.
+For each object class:
+ - Expired uncommitted sessions are marked as committed (self healing).
+ - Trailing committed sessions are deleted. The insert sync count allocator
+   (see SYNC_COUNT_ALLOCATOR) does not delete them in the request path.
+
+The janitor runs in a timer thread of each long running server process (see
+JANITOR_INTERVAL) or periodically from this CLI (e.g. cron for CGI).
+A database named lock ensures only one janitor sweeps at a time, across
+processes and hosts. A janitor finding the lock taken skips its sweep.
+
+Usage:
+    ./janitor.py
+    janitor.py [-h] [-v]
+
+Optional arguments:
+    -h, --help     show this help message and exit
+    -v, --verbose  log debug messages
+
+Cron example (every 5 minutes):
+    */5 * * * * cd /path/to/TuckerSync && ./janitor.py
+
+License:
+    The MIT License (MIT), see LICENSE.txt for more details.
+
+Copyright:
+    Copyright (c) 2014 Steven Tucker and Gavin Kromhout.
+"""
+
+import argparse
+import logging
+import threading
+from os.path import basename
+
+# Module logger.
+log = logging.getLogger(basename(__file__).split('.')[0])
+
+# Database named lock held while sweeping.
+LOCK_NAME = 'TuckerSync.janitor'
+
+
+def get_object_class_names():
+    """Return the sorted object class names."""
+
+    import app_model
+    from base_model import object_class_registry
+
+    return sorted(object_class_registry(app_model))
+
+
+def mark_expired_sessions_committed(holder, object_class_name):
+    """Mark the expired sessions of the object class as committed.
+
+    Return the number of marked sessions, otherwise None."""
+
+    from server import execute_statement
+    from common import SyncCount
+
+    sc = SyncCount()
+    sc.object_class = object_class_name
+
+    sql_result = execute_statement(
+        statement=SyncCount.UPDATE_SET_IS_COMMITTED_EXPIRED,
+        params=sc.update_set_is_committed_expired_params(),
+        holder=holder,
+        is_select=False)
+
+    if sql_result.errno:
+        log.error('%s mark expired sessions failed, %s',
+                  object_class_name, sql_result.err_msg)
+        return
+
+    if sql_result.rowcount:
+        log.warn(SyncCount.WARN_EXPIRED_SESSIONS_COMMITTED,
+                 sql_result.rowcount)
+
+    return sql_result.rowcount
+
+
+def delete_trailing_committed(holder, object_class_name):
+    """Delete the trailing committed sessions of the object class.
+
+    Return the number of deleted sessions, otherwise None."""
+
+    from server import execute_statement
+    from common import SyncCount
+
+    sc = SyncCount()
+    sc.object_class = object_class_name
+
+    sql_result = execute_statement(
+        statement=SyncCount.DELETE_TRAILING_COMMITTED_BELOW_MAX,
+        params=sc.delete_trailing_committed_below_max_params(),
+        holder=holder,
+        is_select=False)
+
+    if sql_result.errno:
+        log.error('%s delete trailing committed failed, %s',
+                  object_class_name, sql_result.err_msg)
+        return
+
+    log.debug('%s deleted sessions = %s', object_class_name,
+              sql_result.rowcount)
+
+    return sql_result.rowcount
+
+
+def get_lock(cursor):
+    """Try to get the janitor lock without waiting. Return True if locked."""
+
+    cursor.execute('SELECT GET_LOCK(%s, 0) AS locked', (LOCK_NAME,))
+    return 1 == cursor.fetchone()['locked']
+
+
+def release_lock(cursor):
+    """Release the janitor lock."""
+
+    cursor.execute('SELECT RELEASE_LOCK(%s) AS released', (LOCK_NAME,))
+    cursor.fetchone()
+
+
+def run_janitor():
+    """Run the housekeeping for all object classes.
+
+    Return the total number of deleted sessions, otherwise None if skipped
+    (lock taken or database error)."""
+
+    from mysql.connector import Error
+    from server import Holder, open_db, close_db
+
+    holder = Holder()
+    holder.cursor, holder.cnx, errno = open_db()
+    if errno:
+        log.error('could not connect to database, errno = %s', errno)
+        return
+
+    try:
+        if not get_lock(holder.cursor):
+            log.debug('janitor lock taken, skipping')
+            return
+
+        try:
+            total = 0
+            for name in get_object_class_names():
+                mark_expired_sessions_committed(holder, name)
+                total += delete_trailing_committed(holder, name) or 0
+        finally:
+            release_lock(holder.cursor)
+
+    except Error as e:
+        log.error('MySQL error no = %s', e.errno)
+        log.error('MySQL error msg = %s', e.msg)
+        return
+    finally:
+        close_db(holder.cursor, holder.cnx)
+
+    log.info('deleted trailing committed sessions = %s', total)
+
+    return total
+
+
+class JanitorThread(threading.Thread):
+    """Daemon thread running the janitor every interval seconds."""
+
+    def __init__(self, interval):
+        threading.Thread.__init__(self, name='janitor')
+        self.daemon = True
+        self.interval = interval
+        self.stopped = threading.Event()
+
+    def run(self):
+        while True:
+            self.stopped.wait(self.interval)
+            if self.stopped.is_set():
+                return
+            try:
+                run_janitor()
+            except Exception:
+                log.exception('janitor exception')
+
+    def stop(self):
+        self.stopped.set()
+
+
+def init_logging(cmd_args):
+    """Init logging."""
+
+    from sys import stderr
+
+    if cmd_args.verbose:
+        log_level = logging.DEBUG
+    else:
+        log_level = logging.INFO
+
+    logging.basicConfig(stream=stderr, level=log_level)
+
+
+def get_cmd_args():
+    """Get the command line arguments."""
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-v',
+                        '--verbose',
+                        help='log debug messages',
+                        action='store_true')
+
+    return parser.parse_args()
+
+
+def main():
+    """Main function."""
+
+    cmd_args = get_cmd_args()
+    init_logging(cmd_args)
+    run_janitor()
+
+
+# Run main when commands read either from standard input,
+# from a script file, or from an interactive prompt.
+if __name__ == "__main__":
+    main()
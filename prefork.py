@@ -0,0 +1,327 @@
+#!env/bin/python
+
+"""Tucker Sync pre-fork server module.
+
+Production HTTP server, an alternative to CGI and FastCGI deployments.
+The master process imports and warms up the server once (object class
+registry, compiled SQL and validators, password context), binds the
+listening socket and forks the workers. Each worker serves requests from
+the shared socket with a Werkzeug WSGI server, one request at a time, and
+reuses its pooled database connections across requests.
+
+Workers that exit unexpectedly are replaced. A graceful restart re-executes
+the master, reloading the code and app_config.py, with the listening socket
+kept open. The new workers are started before the old workers are stopped,
+each old worker finishing its current request.
+
+Signals (master):
+    HUP         graceful restart
+    TERM, INT   graceful stop
+
+Usage:
+    ./prefork.py
+    prefork.py [-h] [--host HOST] [--port PORT] [--workers WORKERS]
+
+Optional arguments:
+    -h, --help         show this help message and exit
+    --host HOST        listen host (default: localhost)
+    --port PORT        listen port (default: 8080)
+    --workers WORKERS  worker processes (default: 4)
+
+Graceful restart example:
+    kill -HUP <master pid>
+
+License:
+    The MIT License (MIT), see LICENSE.txt for more details.
+
+Copyright:
+    Copyright (c) 2014 Steven Tucker and Gavin Kromhout.
+"""
+
+import argparse
+import errno
+import logging
+import os
+import select
+import signal
+import socket
+import sys
+from os.path import basename
+from time import time, sleep
+
+from werkzeug.serving import BaseWSGIServer, select_ip_version
+
+# Module logger.
+log = logging.getLogger(basename(__file__).split('.')[0])
+
+# Environment of a re-executed master, the listening socket file descriptor
+# and the process ids of the old workers to stop.
+LISTEN_FD_ENV = 'TUCKER_SYNC_LISTEN_FD'
+OLD_WORKERS_ENV = 'TUCKER_SYNC_OLD_WORKERS'
+
+# Seconds an idle worker waits for a request before checking it should stop.
+WORKER_POLL_INTERVAL = 1
+
+# Seconds between the master's checks of its workers and signals.
+MASTER_POLL_INTERVAL = 1
+
+# Workers exiting within this many seconds of starting are replaced after
+# the same delay (e.g. the database is down), instead of immediately.
+WORKER_RESPAWN_DELAY = 1
+
+
+class PreforkWSGIServer(BaseWSGIServer):
+    """WSGI server of a worker, serving the master's listening socket."""
+
+    multiprocess = True
+
+    def __init__(self, listen_socket, app):
+        self.listen_socket = listen_socket
+        host, port = listen_socket.getsockname()[:2]
+        BaseWSGIServer.__init__(self, host, port, app)
+
+    def server_bind(self):
+        # Bound by the master, replaces the socket created by TCPServer.
+        self.socket.close()
+        self.socket = self.listen_socket
+        self.server_address = self.socket.getsockname()
+        self.server_name = socket.getfqdn(self.server_address[0])
+        self.server_port = self.server_address[1]
+
+    def server_activate(self):
+        # Listening already.
+        pass
+
+
+def get_listen_socket(cmd_args):
+    """Return the listening socket, inherited when re-executed."""
+
+    family = select_ip_version(cmd_args.host, cmd_args.port)
+
+    fd = os.environ.pop(LISTEN_FD_ENV, None)
+    if fd is not None:
+        log.info('inherited listening socket, fd = %s', fd)
+        listen_socket = socket.fromfd(int(fd), family, socket.SOCK_STREAM)
+        # fromfd() duplicates, close the inherited descriptor.
+        os.close(int(fd))
+        return listen_socket
+
+    listen_socket = socket.socket(family, socket.SOCK_STREAM)
+    listen_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listen_socket.bind((cmd_args.host, cmd_args.port))
+    listen_socket.listen(BaseWSGIServer.request_queue_size)
+    log.info('listening on %s:%s', cmd_args.host, cmd_args.port)
+
+    return listen_socket
+
+
+def warm_up_connection(server):
+    """Open and pool a database connection of this (forked) process."""
+
+    cursor, cnx, db_errno = server.open_db()
+    if db_errno:
+        log.error('could not connect to database, errno = %s', db_errno)
+        return
+
+    server.close_db(cursor, cnx)
+
+
+def run_worker(listen_socket, master_pid):
+    """Serve requests until stopped (SIGTERM or SIGINT) or orphaned."""
+
+    import server
+
+    stopped = []
+
+    def stop(signum, frame):
+        stopped.append(signum)
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+
+    # Per worker, before any thread is started.
+    server.start_hash_pool()
+    warm_up_connection(server)
+    server.start_janitor()
+
+    httpd = PreforkWSGIServer(listen_socket, server.application)
+    httpd.timeout = WORKER_POLL_INTERVAL
+
+    while not stopped and os.getppid() == master_pid:
+        try:
+            httpd.handle_request()
+        except (select.error, socket.error, OSError) as e:
+            if e.args[0] != errno.EINTR:
+                raise
+
+
+class Master(object):
+    """Forks and supervises the workers."""
+
+    def __init__(self, listen_socket, workers):
+        self.listen_socket = listen_socket
+        self.size = workers
+        # Process id to start time of the current workers.
+        self.workers = {}
+        self.old_workers = set()
+        self.signals = []
+        self.stopping = False
+
+    def spawn_worker(self):
+        """Fork a worker."""
+
+        pid = os.fork()
+        if pid:
+            self.workers[pid] = time()
+            return
+
+        status = 0
+        try:
+            run_worker(self.listen_socket, os.getppid())
+        except Exception:
+            log.exception('worker exception')
+            status = 1
+        finally:
+            # Skip the master's exit handlers and buffered output.
+            os._exit(status)
+
+    def spawn_workers(self):
+        """Fork workers up to the configured number."""
+
+        while len(self.workers) < self.size:
+            self.spawn_worker()
+
+    def stop_workers(self, pids):
+        """Signal the workers to stop after their current request."""
+
+        for pid in pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError as e:
+                if e.errno != errno.ESRCH:
+                    raise
+
+    def on_signal(self, signum, frame):
+        self.signals.append(signum)
+
+    def restart(self):
+        """Re-execute the master, keeping the socket and the old workers."""
+
+        log.info('graceful restart')
+
+        os.environ[LISTEN_FD_ENV] = str(self.listen_socket.fileno())
+        os.environ[OLD_WORKERS_ENV] = ','.join(
+            str(pid) for pid in list(self.workers) + list(self.old_workers))
+
+        # Restore the default handlers for the new process image.
+        for signum in (signal.SIGHUP, signal.SIGTERM, signal.SIGINT):
+            signal.signal(signum, signal.SIG_DFL)
+
+        os.execv(sys.executable, [sys.executable] + sys.argv)
+
+    def reap(self):
+        """Reap the exited workers. Return False when no workers are left."""
+
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except OSError as e:
+                if e.errno == errno.EINTR:
+                    continue
+                if e.errno == errno.ECHILD:
+                    return False
+                raise
+
+            if not pid:
+                return True
+
+            if pid in self.old_workers:
+                self.old_workers.discard(pid)
+                log.debug('old worker %s stopped', pid)
+                continue
+
+            started = self.workers.pop(pid, None)
+            if started is None or self.stopping:
+                continue
+
+            log.error('worker %s exited, status = %s', pid, status)
+            if time() - started < WORKER_RESPAWN_DELAY:
+                sleep(WORKER_RESPAWN_DELAY)
+
+    def handle_signals(self):
+        """Restart or stop on the received signals."""
+
+        while self.signals:
+            signum = self.signals.pop(0)
+            if signum != signal.SIGHUP:
+                if not self.stopping:
+                    log.info('graceful stop')
+                    self.stopping = True
+                self.stop_workers(self.workers)
+            elif not self.stopping:
+                self.restart()
+
+    def run(self):
+        """Run until stopped."""
+
+        for signum in (signal.SIGHUP, signal.SIGTERM, signal.SIGINT):
+            signal.signal(signum, self.on_signal)
+
+        self.spawn_workers()
+        log.info('master %s started workers %s', os.getpid(),
+                 sorted(self.workers))
+
+        # Stop the workers of the previous master, now replaced.
+        old_workers = os.environ.pop(OLD_WORKERS_ENV, '')
+        self.old_workers = set(int(pid) for pid in old_workers.split(',')
+                               if pid)
+        self.stop_workers(self.old_workers)
+
+        while self.reap():
+            self.handle_signals()
+            if not self.stopping:
+                self.spawn_workers()
+
+            # Returns early when a signal is received.
+            sleep(MASTER_POLL_INTERVAL)
+
+        log.info('master %s stopped', os.getpid())
+
+
+def get_cmd_args():
+    """Get the command line arguments."""
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host',
+                        help='listen host (default: localhost)',
+                        default='localhost')
+    parser.add_argument('--port',
+                        help='listen port (default: 8080)',
+                        type=int,
+                        default=8080)
+    parser.add_argument('--workers',
+                        help='worker processes (default: 4)',
+                        type=int,
+                        default=4)
+
+    return parser.parse_args()
+
+
+def main():
+    """Main function."""
+
+    cmd_args = get_cmd_args()
+
+    # Import (configuring logging) and warm up once, before forking.
+    import server
+    server.warm_up()
+
+    listen_socket = get_listen_socket(cmd_args)
+    Master(listen_socket, cmd_args.workers).run()
+
+
+# Run main when commands read either from standard input,
+# from a script file, or from an interactive prompt.
+if __name__ == "__main__":
+    main()
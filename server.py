@@ -23,24 +23,68 @@ Copyright:
     Copyright (c) 2014 Steven Tucker and Gavin Kromhout.
 """
 
+import hashlib
+import hmac
 import logging
+import os
+import threading
+import uuid
+import zlib
+from collections import deque
 from os.path import basename
+from time import time
 import mysql.connector
 from mysql.connector import errorcode
 from werkzeug.exceptions import MethodNotAllowed
 from werkzeug.wrappers import BaseRequest, CommonRequestDescriptorsMixin, \
-    BaseResponse, CommonResponseDescriptorsMixin
+    AcceptMixin, ETagRequestMixin, BaseResponse, CommonResponseDescriptorsMixin
 from schematics.exceptions import ValidationError
 from passlib.context import CryptContext
+from passlib.utils import consteq
 
+import app_config
 from app_config import LOG_FILE_NAME, LOG_LEVEL, PRODUCTION, \
     APP_KEYS, db_config
 import app_model
-from base_model import BaseAppModel
-from common import CONTENT_TYPE_APP_JSON, APIErrorResponse, APIRequestType, \
+from base_model import object_class_registry, compiled_validator, \
+    ValidatedObject, MAX_STATEMENT_ROWS, SYNC_BATCH_MAX_BYTES
+from cache import TTLCache
+from common import APIErrorCode, APIErrorResponse, APIRequestType, \
     UserClient, User, SQLResult, Client, JSON, AccountOpenRequestBody, \
     SyncDownRequestBody, ResponseBody, SyncUpRequestBody, \
-    AccountModifyRequestBody, BaseDataDownRequestBody, SyncCount
+    AccountModifyRequestBody, BaseDataDownRequestBody, SyncCount, \
+    ContentEncoding, CODECS, error_responses, HTTP, SyncUpSection, \
+    SyncDownSection, SyncBatchRequestBody, SyncBatchResponseBody, \
+    SyncProbeRequestBody, SyncProbeResponseBody, SessionOpenRequestBody, \
+    SessionOpenResponseBody
+
+# Settings added since the first release, read with the defaults of
+# app_config_template.py when missing from an existing app_config.py.
+DB_POOL_SIZE = getattr(app_config, 'DB_POOL_SIZE', 5)
+DB_POOL_MAX_CONNECTIONS = getattr(app_config, 'DB_POOL_MAX_CONNECTIONS', 20)
+DB_POOL_TIMEOUT = getattr(app_config, 'DB_POOL_TIMEOUT', 5)
+DB_SESSION_STATEMENTS = getattr(app_config, 'DB_SESSION_STATEMENTS', ())
+SYNC_COUNT_ALLOCATOR = getattr(app_config, 'SYNC_COUNT_ALLOCATOR',
+                               'sequence')
+JANITOR_INTERVAL = getattr(app_config, 'JANITOR_INTERVAL', 300)
+COMPRESSION_LEVEL = getattr(app_config, 'COMPRESSION_LEVEL', 6)
+COMPRESSION_MIN_SIZE = getattr(app_config, 'COMPRESSION_MIN_SIZE', 1024)
+COMPRESSION_MAX_DECODED_SIZE = getattr(app_config,
+                                       'COMPRESSION_MAX_DECODED_SIZE',
+                                       16 * 1024 * 1024)
+AUTH_CACHE_SIZE = getattr(app_config, 'AUTH_CACHE_SIZE', 1000)
+AUTH_CACHE_TTL = getattr(app_config, 'AUTH_CACHE_TTL', 300)
+HASH_POOL_SIZE = getattr(app_config, 'HASH_POOL_SIZE', 0)
+HASH_POOL_MAX_PENDING = getattr(app_config, 'HASH_POOL_MAX_PENDING', 32)
+AUTH_TOKEN_SECRET = getattr(app_config, 'AUTH_TOKEN_SECRET', None)
+AUTH_TOKEN_TTL = getattr(app_config, 'AUTH_TOKEN_TTL', 3600)
+COMMITTED_SC_CACHE_TTL = getattr(app_config, 'COMMITTED_SC_CACHE_TTL', 60)
+BASE_DATA_OWNER_EMAIL = getattr(app_config, 'BASE_DATA_OWNER_EMAIL', None)
+BASE_DATA_CACHE_SIZE = getattr(app_config, 'BASE_DATA_CACHE_SIZE', 16)
+BASE_DATA_CACHE_TTL = getattr(app_config, 'BASE_DATA_CACHE_TTL', 60)
+STATIC_BASE_DATA_DIR = getattr(app_config, 'STATIC_BASE_DATA_DIR',
+                               'base_data')
+STATIC_BASE_DATA_URL = getattr(app_config, 'STATIC_BASE_DATA_URL', None)
 
 
 def logging_init():
@@ -72,7 +116,8 @@ logging_init()
 log = logging.getLogger(basename(__file__).split('.')[0])
 
 
-class Request(BaseRequest, CommonRequestDescriptorsMixin):
+class Request(BaseRequest, CommonRequestDescriptorsMixin, AcceptMixin,
+              ETagRequestMixin):
     pass
 
 
@@ -88,22 +133,202 @@ class Holder(object):
         self.response = None
         self.cnx = None
         self.cursor = None
-        self.password_context = None
+        self.auth_cache_key = None
+        self.auth_token = None
         self.auth_user = None
         self.auth_client = None
         self.object_class = None
+        self.object_class_info = None
         self.session_sc = None
+        self.new_objects = None
+        self.changed_objects = None
         self.request_body = None
         self.response_body = None
+        self.codec = JSON
+        self.rows = None
+        self.streaming = False
+        # Byte limit of the response objects, None for the object class limit.
+        self.max_bytes = None
+        # Bytes of the objects in the response.
+        self.sync_bytes = 0
+
+
+class ConnectionPool(object):
+    """Pool of open database connections reused across requests.
+
+    Avoids the connection handshake on every request. Connections are
+    checked (pinged) on checkout and transparently reconnected when stale.
+    Session statements are executed once per new or reconnected connection.
+
+    At most max_connections (0 for no limit) are open at once, a checkout
+    beyond waits up to timeout seconds for a connection to be returned and
+    then fails with ER_CON_COUNT_ERROR. At most size returned connections
+    are kept idle, the others are closed.
+
+    The pool belongs to the process that created the connections. After a
+    fork the child discards the inherited idle connections (without closing
+    the shared sockets) and opens its own.
+    """
 
+    def __init__(self, size, config, session_statements=(),
+                 max_connections=0, timeout=0):
+        self.size = size
+        self.config = dict(config, raise_on_warnings=True)
+        self.session_statements = session_statements
+        self.max_connections = max_connections
+        self.timeout = timeout
+        self._idle = deque()
+        self._open = 0
+        self._lock = threading.Condition(threading.Lock())
+        self._pid = os.getpid()
+
+    def connect(self):
+        """Open a new connection and set up the session."""
+
+        cnx = mysql.connector.connect(**self.config)
+        self.setup_session(cnx)
+        return cnx
+
+    def setup_session(self, cnx):
+        """Execute the session statements on the connection."""
+
+        if not self.session_statements:
+            return
 
-def open_db():
-    """Open the connection and cursor. Return cursor, cnx, errno."""
+        cursor = cnx.cursor()
+        try:
+            for stmt in self.session_statements:
+                cursor.execute(stmt)
+        finally:
+            cursor.close()
+
+    def _check_pid(self):
+        """Drop idle connections inherited from a parent process."""
+
+        if self._pid != os.getpid():
+            self._idle.clear()
+            self._open = 0
+            self._pid = os.getpid()
+
+    def _checkout(self):
+        """Return an idle connection, or None to open a new connection.
+
+        Waits while max_connections are open. Caller holds the lock."""
+
+        deadline = time() + self.timeout
+
+        while True:
+            self._check_pid()
+            if self._idle:
+                return self._idle.pop()
+
+            if not self.max_connections or \
+                    self._open < self.max_connections:
+                self._open += 1
+                return
+
+            remaining = deadline - time()
+            if remaining <= 0:
+                raise mysql.connector.errors.PoolError(
+                    msg='connection pool exhausted, max connections = %s' %
+                        self.max_connections,
+                    errno=errorcode.ER_CON_COUNT_ERROR)
+
+            self._lock.wait(remaining)
+
+    def _discard(self):
+        """Account for a closed connection, waking a waiting checkout."""
+
+        with self._lock:
+            self._check_pid()
+            self._open = max(self._open - 1, 0)
+            self._lock.notify()
+
+    def get(self):
+        """Checkout a connection, reuse an idle one when available."""
+
+        with self._lock:
+            cnx = self._checkout()
+
+        try:
+            if cnx is None:
+                return self.connect()
+
+            # Pre-ping, reconnect if the server has gone away.
+            if not cnx.is_connected():
+                log.debug('pooled connection lost, reconnecting')
+                cnx.reconnect()
+                self.setup_session(cnx)
+        except Exception:
+            if cnx is not None:
+                self.close(cnx)
+            self._discard()
+            raise
+
+        return cnx
+
+    def put(self, cnx):
+        """Return a connection to the pool, close it if the pool is full."""
+
+        try:
+            # End any transaction left open, including the consistent read
+            # snapshot of a SELECT, before the connection is reused.
+            cnx.rollback()
+        except mysql.connector.Error as e:
+            log.debug('pooled connection rollback exception = %s', e)
+            self.close(cnx)
+            self._discard()
+            return
+
+        with self._lock:
+            self._check_pid()
+            if len(self._idle) < self.size:
+                self._idle.append(cnx)
+                self._lock.notify()
+                return
+
+        self.close(cnx)
+        self._discard()
+
+    @staticmethod
+    def close(cnx):
+        """Close the connection."""
+
+        try:
+            cnx.close()
+        except Exception as e:
+            log.debug('connection close exception = %s', e)
+
+
+# Process wide connection pool, created on demand.
+_db_pool = None
+_db_pool_lock = threading.Lock()
+
+
+def db_pool():
+    """Create the database connection pool on demand.
+
+    :rtype: ConnectionPool
+    """
+
+    global _db_pool
+
+    if not _db_pool:
+        with _db_pool_lock:
+            if not _db_pool:
+                _db_pool = ConnectionPool(DB_POOL_SIZE, db_config,
+                                          DB_SESSION_STATEMENTS,
+                                          DB_POOL_MAX_CONNECTIONS,
+                                          DB_POOL_TIMEOUT)
 
-    db_config['raise_on_warnings'] = True
+    return _db_pool
+
+
+def open_db():
+    """Open the cursor on a pooled connection. Return cursor, cnx, errno."""
 
     try:
-        cnx = mysql.connector.connect(**db_config)
+        cnx = db_pool().get()
     except mysql.connector.Error as e:
         log.debug('MySQL error no = %s', e.errno)
         log.debug('MySQL error msg = %s', e.msg)
@@ -122,23 +347,22 @@ def open_db():
 
 
 def close_db(cursor, cnx):
-    """Close the cursor and connection."""
+    """Close the cursor and return the connection to the pool."""
 
     try:
         cursor.close()
     except Exception as e:
         log.debug('cursor close exception = %s', e)
 
-    try:
-        cnx.close()
-    except Exception as e:
-        log.debug('connection close exception = %s', e)
+    if cnx:
+        db_pool().put(cnx)
 
 
 def execute_statement(statement, params,
                       object_class=None,
                       holder=None,
-                      is_select=True):
+                      is_select=True,
+                      commit=True):
     """Convenience wrapper for execute_statements.
 
     Wraps single statement and params in tuples."""
@@ -146,13 +370,15 @@ def execute_statement(statement, params,
     return execute_statements((statement,), (params,),
                               object_class=object_class,
                               holder=holder,
-                              is_select=is_select)
+                              is_select=is_select,
+                              commit=commit)
 
 
 def execute_statements(statements, params,
                        object_class=None,
                        holder=None,
-                       is_select=True):
+                       is_select=True,
+                       commit=True):
     """Execute the provided SQL statements.
 
     :param tuple[str] statements: SQL statements to execute.
@@ -162,6 +388,8 @@ def execute_statements(statements, params,
     If None a connection is opened and then closed.
     :param bool is_select: MUST be set to False for
     Data Manipulation Statements (INSERT/DELETE/UPDATE/CREATE).
+    :param bool commit: commit after the DML statements. Set False to leave
+    the transaction open for further statements (holder required).
     :rtype: SQLResult
     """
 
@@ -182,7 +410,7 @@ def execute_statements(statements, params,
     try:
         for i, stmt in enumerate(statements):
             cursor.execute(stmt, params[i])
-        if not is_select:
+        if not is_select and commit:
             cnx.commit()  # Commit after a sequence of DML statements.
     except mysql.connector.Error as e:
         log.debug('MySQL error no = %s', e.errno)
@@ -216,6 +444,71 @@ def execute_statements(statements, params,
     return sql_result
 
 
+def execute_statement_iter(statement, params, holder,
+                           object_class=None,
+                           validate=False):
+    """Execute the provided SQL select statement, streaming the results.
+
+    Generator variant of execute_statement for large results.
+    Rows are read lazily from an unbuffered cursor on the holder connection.
+    No other statement may be executed on the connection until the rows
+    iterator is exhausted or closed.
+
+    :param str statement: SQL select statement to execute.
+    :param tuple params: params to apply to statement.
+    :param Holder holder: provides the database cnx.
+    :param object_class: schematics.models.Model class of the yielded items.
+    If None the row dictionaries are yielded.
+    :param bool validate: validate each object_class instance.
+    Leave False for trusted database output.
+    :return: SQLResult (errors) and the rows iterator.
+    The rows iterator raises mysql.connector.Error on read errors.
+    """
+
+    log.debug('execute_statement_iter()')
+    log.debug('statement = %s', statement)
+    log.debug('params = %s', params)
+
+    sql_result = SQLResult()
+
+    try:
+        cursor = holder.cnx.cursor(dictionary=True, buffered=False)
+        cursor.execute(statement, params)
+    except mysql.connector.Error as e:
+        log.debug('MySQL error no = %s', e.errno)
+        log.debug('MySQL error msg = %s', e.msg)
+        sql_result.errno = e.errno
+        sql_result.err_msg = e.msg
+        return sql_result, iter(())
+
+    return sql_result, iter_rows(cursor, object_class, validate)
+
+
+def iter_rows(cursor, object_class=None, validate=False):
+    """Yield the rows of an executed cursor, then close the cursor.
+
+    Unread rows are consumed on close so the connection can be reused."""
+
+    exhausted = False
+
+    try:
+        for row in cursor:
+            if object_class:
+                row = object_class(row)
+                if validate:
+                    row.validate()
+            yield row
+        exhausted = True
+    finally:
+        try:
+            if not exhausted:
+                for _ in cursor:
+                    pass
+            cursor.close()
+        except mysql.connector.Error as e:
+            log.debug('cursor close exception = %s', e)
+
+
 def handle_user_sql_result_error(sql_result):
     """Handle the sql_result errors, if any, from a User insert or update.
 
@@ -261,13 +554,70 @@ def application_key_fails(request, response):
 def content_type_fails(request, response):
     """Content-Type check. Return True if the check fails."""
 
-    if request.content_type != CONTENT_TYPE_APP_JSON:
+    if request.content_type not in CODECS:
         log.debug('Content-Type = %s', request.content_type)
-        log.debug('Check Fail, Content-Type != %s', CONTENT_TYPE_APP_JSON)
+        log.debug('Check Fail, Content-Type not in %s', CODECS.keys())
         response.set_data(APIErrorResponse.MALFORMED_REQUEST)
         return True
 
 
+# Response content types, JSON preferred.
+RESPONSE_CONTENT_TYPES = sorted(CODECS, key=lambda t: t != JSON.CONTENT_TYPE)
+
+# APIErrorResponse constants encoded by each codec.
+ERROR_RESPONSES = dict((codec, error_responses(codec))
+                       for codec in CODECS.values())
+
+
+def response_codec(request):
+    """Return the response codec negotiated by the Accept header.
+
+    JSON when not specified."""
+
+    content_type = request.accept_mimetypes.best_match(
+        RESPONSE_CONTENT_TYPES, default=JSON.CONTENT_TYPE)
+
+    return CODECS[content_type]
+
+
+def encode_error_response(response, codec):
+    """Encode an APIErrorResponse (JSON constant) body with the codec."""
+
+    if codec is JSON or response.is_streamed:
+        return
+
+    encoded = ERROR_RESPONSES[codec].get(response.get_data())
+    if encoded is not None:
+        response.set_data(encoded)
+
+
+def get_request_data(request, response):
+    """Get the request body data, decoded as per the Content-Encoding.
+
+    Return data, otherwise None."""
+
+    data = request.get_data()
+
+    encoding = request.content_encoding
+    if not encoding or encoding == ContentEncoding.IDENTITY:
+        return data
+
+    if encoding not in ContentEncoding.SUPPORTED:
+        log.debug('Content-Encoding = %s not supported', encoding)
+        log.debug('response = malformed request')
+        response.set_data(APIErrorResponse.MALFORMED_REQUEST)
+        return
+
+    try:
+        return ContentEncoding.decompress(data, encoding,
+                                          COMPRESSION_MAX_DECODED_SIZE)
+    except (zlib.error, ValueError) as e:
+        log.debug('decompress exception = %s', e)
+        log.debug('response = malformed request')
+        response.set_data(APIErrorResponse.MALFORMED_REQUEST)
+        return
+
+
 def get_json_object(request, response):
     """Get the json object (Python dictionary) from the request.
 
@@ -276,14 +626,18 @@ def get_json_object(request, response):
     if content_type_fails(request, response):
         return
 
-    js = request.get_data()
+    js = get_request_data(request, response)
+    if js is None:
+        return
+
     if not PRODUCTION:
-        log.debug('js = %s' % js)
+        log.debug('js = %r' % js)
 
+    # Decoded by the codec of the request Content-Type.
     try:
-        jo = JSON.loads(js)
+        jo = CODECS[request.content_type].loads(js)
     except Exception as e:
-        log.debug('JSON loads exception = %s', e)
+        log.debug('loads exception = %s', e)
         log.debug('response = invalid json object')
         response.set_data(APIErrorResponse.INVALID_JSON_OBJECT)
         return
@@ -302,8 +656,10 @@ def get_json_object(request, response):
 
 
 def set_request_body(req_body_cls, holder):
-    """Set holder.request_body as an instance of req_body_cls.
+    """Set holder.request_body as a validated object of req_body_cls.
 
+    Validated by the compiled validator of req_body_cls, values are accessed
+    as attributes as on a req_body_cls instance.
     Return True, otherwise None."""
 
     log.debug('set_request_body()')
@@ -312,60 +668,42 @@ def set_request_body(req_body_cls, holder):
     if not jo:
         return
 
-    try:
-        # jo must have exact keys (strict=True)
-        holder.request_body = req_body_cls(jo)
-    except Exception as e:
-        log.debug('instance creation exception = %s', e)
-        log.debug('response = invalid json object')
-        holder.response.set_data(APIErrorResponse.INVALID_JSON_OBJECT)
-        return
-
-    try:
-        holder.request_body.validate()
-    except ValidationError as e:
-        log.debug('request_body validation error = %s', e)
+    # jo must have exact keys (strict).
+    body, errors = compiled_validator(req_body_cls)(jo)
+    if errors:
+        log.debug('request_body validation errors = %s', errors)
         log.debug('response = invalid json object')
         holder.response.set_data(APIErrorResponse.INVALID_JSON_OBJECT)
         return
 
+    holder.request_body = ValidatedObject(body)
     return True
 
 
+# Object class registry, built once at import.
+OBJECT_CLASSES = object_class_registry(app_model)
+
+
 def set_object_class(holder):
     """Set holder.object_class from object class name supplied in request_body.
 
+    Also sets holder.object_class_info from the object class registry.
     Return True, otherwise None."""
 
     log.debug('set_object_class()')
 
     obj_cls_name = holder.request_body.objectClass
 
-    obj_cls = None
-    for name in dir(app_model):
-        if '_' not in name:
-            a = getattr(app_model, name)
-            if a.__module__ == app_model.__name__ and name == obj_cls_name:
-                obj_cls = a
-                break
+    info = OBJECT_CLASSES.get(obj_cls_name)
 
-    if not obj_cls:
+    if not info:
         log.debug('app_model has no object class called: %s', obj_cls_name)
         log.debug('response = malformed request')
         holder.response.set_data(APIErrorResponse.MALFORMED_REQUEST)
         return
 
-    try:
-        assert issubclass(obj_cls, BaseAppModel)
-    except Exception as e:
-        log.warn('assert issubclass exception: %s', e)
-        log.warn('"%s" is not a subclass of: %s',
-                 obj_cls_name, BaseAppModel)
-        log.warn('response = malformed request')
-        holder.response.set_data(APIErrorResponse.MALFORMED_REQUEST)
-        return
-
-    holder.object_class = obj_cls
+    holder.object_class = info.model_class
+    holder.object_class_info = info
     return True
 
 
@@ -382,9 +720,9 @@ def pack_response(holder):
         return
 
     try:
-        js = JSON.dumps(holder.response_body.to_primitive())
+        js = holder.codec.dumps(holder.response_body.to_primitive())
     except Exception as e:
-        log.error('JSON dumps exception = %s' % e)
+        log.error('dumps exception = %s' % e)
         log.error('response = internal server error')
         holder.response.set_data(APIErrorResponse.INTERNAL_SERVER_ERROR)
         return
@@ -393,337 +731,1706 @@ def pack_response(holder):
     holder.response.set_data(js)
 
 
-def password_context(holder):
-    """Create the password context on demand.
+# Streamed response bodies are yielded in chunks of about this many bytes.
+STREAM_CHUNK_SIZE = 64 * 1024
+
+
+def pack_response_stream(holder, objects):
+    """Pack response_body and objects into a streamed response body.
+
+    The envelope is sent first, then the objects as they are read from the
+    (row) generator and finally the moreObjects flag, which is only known
+    once the objects are exhausted. The holder database resources are
+    released when the response is closed.
+
+    Only JSON is streamed. Other codecs are packed from the already encoded
+    objects once they are exhausted."""
+
+    res_body = holder.response_body
+
+    if holder.codec is not JSON:
+        encoded_objects = [data for primitive, data in objects]
+        try:
+            res_body.validate()
+            data = holder.codec.dumps_objects(res_body.to_primitive(),
+                                              encoded_objects)
+        except Exception as e:
+            log.error('response body exception = %s' % e)
+            log.error('response = internal server error')
+            holder.response.set_data(APIErrorResponse.INTERNAL_SERVER_ERROR)
+            return
+        log.debug('response = success + objects')
+        holder.response.set_data(data)
+        return
+
+    # Validate the envelope before streaming.
+    try:
+        res_body.validate()
+        head = JSON.dumps(res_body.to_primitive())
+    except Exception as e:
+        log.error('response body exception = %s' % e)
+        log.error('response = internal server error')
+        holder.response.set_data(APIErrorResponse.INTERNAL_SERVER_ERROR)
+        return
+
+    def generate():
+        parts = [head[:-1], ',"objects":[']
+        size = 0
+        sep = ''
+        for primitive, js in objects:
+            parts.append(sep)
+            parts.append(js)
+            sep = ','
+            size += len(js) + 1
+            if size >= STREAM_CHUNK_SIZE:
+                yield ''.join(parts)
+                parts = []
+                size = 0
+        parts.append('],"moreObjects":')
+        parts.append(JSON.dumps(bool(res_body.moreObjects)))
+        parts.append('}')
+        yield ''.join(parts)
+
+    log.debug('response = success + streamed objects')
+    holder.response.response = generate()
+    holder.streaming = True
+
+
+def response_encoding(holder):
+    """Return the response Content-Encoding negotiated by Accept-Encoding.
+
+    None if compression is disabled or not accepted."""
+
+    if not COMPRESSION_LEVEL:
+        return
+
+    return holder.request.accept_encodings.best_match(
+        ContentEncoding.SUPPORTED)
+
+
+def compress_response(holder):
+    """Compress the response body as negotiated by Accept-Encoding.
+
+    Streamed bodies are compressed as they are sent. Other bodies are only
+    compressed from COMPRESSION_MIN_SIZE. Bodies already compressed (with a
+    Content-Encoding) are left as is."""
+
+    if not COMPRESSION_LEVEL:
+        return
+
+    response = holder.response
+    response.vary.add('Accept-Encoding')
+
+    encoding = response_encoding(holder)
+    if not encoding or response.content_encoding:
+        return
+
+    if holder.streaming:
+        response.response = ContentEncoding.compress_iter(
+            response.response, encoding, COMPRESSION_LEVEL)
+    else:
+        data = response.get_data()
+        if len(data) < COMPRESSION_MIN_SIZE:
+            return
+        response.set_data(ContentEncoding.compress(data, encoding,
+                                                   COMPRESSION_LEVEL))
+
+    log.debug('response Content-Encoding = %s', encoding)
+    response.content_encoding = encoding
+
+
+def close_holder(holder):
+    """Close the holder rows and return the database connection."""
+
+    if holder.rows is not None:
+        holder.rows.close()
+        holder.rows = None
+
+    close_db(holder.cursor, holder.cnx)
+
+
+# Process wide password context, created on demand.
+_password_context = None
+
+
+def password_context():
+    """Create the password context on demand.
+
+    :rtype: CryptContext
+    """
+
+    global _password_context
+
+    if _password_context:
+        return _password_context
+
+    _password_context = CryptContext(
+        # Supported schemes.
+        schemes=["sha256_crypt"],
+        default="sha256_crypt",
+
+        # Vary rounds parameter randomly when creating new hashes.
+        all__vary_rounds=0.1,
+
+        # Set a good starting point for rounds selection
+        sha512_crypt__min_rounds=60000,
+        sha256_crypt__min_rounds=80000,
+
+        # If the admin user category is selected, make a much stronger hash,
+        admin__sha512_crypt__min_rounds=120000,
+        admin__sha256_crypt__min_rounds=160000)
+
+    return _password_context
+
+
+def hash_password(password):
+    """Return the hash of password. Run by the hash pool."""
+
+    return password_context().encrypt(password)
+
+
+def check_password(password, password_hash):
+    """Return True if password matches the hash. Run by the hash pool."""
+
+    return password_context().verify(password, password_hash)
+
+
+class HashPoolBusy(Exception):
+    """The hash pool has HASH_POOL_MAX_PENDING hashes pending."""
+
+    pass
+
+
+# Password hash process pool, created on demand per (forked) process.
+_hash_pool = None
+_hash_pool_pid = None
+_hash_pool_lock = threading.Lock()
+_hash_pool_slots = threading.BoundedSemaphore(max(HASH_POOL_MAX_PENDING, 1))
+
+
+def start_hash_pool():
+    """Start the hash pool of this (forked) process, if HASH_POOL_SIZE.
+
+    Called by the long running entry points before any thread is started
+    (janitor, server threads), the pool forks its worker processes.
+    Not supported by CGI, a process without a started pool hashes inline."""
+
+    global _hash_pool, _hash_pool_pid
+
+    if not HASH_POOL_SIZE:
+        return
+
+    with _hash_pool_lock:
+        if _hash_pool_pid == os.getpid():
+            return
+
+        from multiprocessing import Pool
+        log.debug('starting hash pool, size = %s', HASH_POOL_SIZE)
+        _hash_pool = Pool(HASH_POOL_SIZE)
+        _hash_pool_pid = os.getpid()
+
+
+def run_hash(func, *args):
+    """Return func(*args) run by the hash pool, or inline without a pool.
+
+    The pool is never created here, see start_hash_pool.
+    The calling thread waits without holding the GIL.
+    Raise HashPoolBusy if too many hashes are pending."""
+
+    if not HASH_POOL_SIZE or _hash_pool_pid != os.getpid():
+        return func(*args)
+
+    if not _hash_pool_slots.acquire(False):
+        raise HashPoolBusy
+
+    try:
+        return _hash_pool.apply(func, args)
+    finally:
+        _hash_pool_slots.release()
+
+
+def set_password_hash(holder, user):
+    """Replace user.password with its hash. Return True, otherwise None."""
+
+    try:
+        user.password = run_hash(hash_password, user.password)
+    except HashPoolBusy:
+        log.error('hash pool busy')
+        log.error('response = internal server error')
+        holder.response.set_data(APIErrorResponse.INTERNAL_SERVER_ERROR)
+        return
+
+    return True
+
+
+# Verified credentials cache.
+# Keys are a keyed digest, the password is never held in the cache.
+# The digest key is random per process.
+_auth_cache = TTLCache(AUTH_CACHE_SIZE, AUTH_CACHE_TTL)
+_auth_cache_secret = os.urandom(32)
+
+
+def auth_cache_key(email, password, password_hash):
+    """Return the verified credentials cache key.
+
+    The stored password hash is part of the key so that a changed password
+    can never match an entry cached for the previous one."""
+
+    msg = u'\0'.join((email, password, password_hash)).encode('utf-8')
+    return hmac.new(_auth_cache_secret, msg, hashlib.sha256).digest()
+
+
+def verify_password(password, password_hash, cache_key):
+    """Verify password against the hash, consulting the cache first.
+
+    Return True if verified, otherwise False.
+    Raise HashPoolBusy if too many hashes are pending."""
+
+    if _auth_cache.get(cache_key):
+        log.debug('verified credentials cache hit')
+        return True
+
+    if not run_hash(check_password, password, password_hash):
+        return False
+
+    _auth_cache.set(cache_key, True)
+    return True
+
+
+def token_user_cache_key(user_id):
+    """Return the cache key of a session token user (email, password hash)."""
+
+    return 'token user', user_id
+
+
+def invalidate_auth_cache(holder):
+    """Remove the authenticated user's credentials from the cache.
+
+    Also the user read for session tokens, revoking the tokens in this
+    process. Other processes revoke them once their entry expires."""
+
+    if holder.auth_cache_key:
+        _auth_cache.pop(holder.auth_cache_key)
+
+    if holder.auth_user is not None:
+        _auth_cache.pop(token_user_cache_key(holder.auth_user.rowid))
+
+
+def session_token_signature(msg, user):
+    """Return the signature (hex) of a session token message of the user.
+
+    Signed with the user's email and password hash, an account modify or
+    close revokes the token."""
+
+    secret = AUTH_TOKEN_SECRET
+    if isinstance(secret, unicode):
+        secret = secret.encode('utf-8')
+
+    signed = '\n'.join((msg, user.email.encode('utf-8'), str(user.password)))
+    return hmac.new(secret, signed, hashlib.sha256).hexdigest()
+
+
+def get_session_token(user, client, expires):
+    """Return a session token of the user's client, valid until expires.
+
+    The token is userId.clientId.clientUUID(hex).expires.signature"""
+
+    msg = '%d.%d.%s.%d' % (user.rowid, client.rowid, client.UUID.hex, expires)
+    return '%s.%s' % (msg, session_token_signature(msg, user))
+
+
+def parse_session_token(token):
+    """Parse a session token and check its expiry.
+
+    The signature is verified with the user (see verify_session_token).
+    Return the token (msg, signature, client), otherwise None."""
+
+    try:
+        msg, signature = str(token).rsplit('.', 1)
+        user_id, client_id, client_uuid, expires = msg.split('.')
+        user_id = long(user_id)
+        client_id = long(client_id)
+        client_uuid = uuid.UUID(hex=client_uuid)
+        expires = long(expires)
+    except (UnicodeError, ValueError):
+        return
+
+    if expires < time():
+        log.debug('session token expired')
+        return
+
+    client = Client()
+    client.rowid = client_id
+    client.userId = user_id
+    client.UUID = client_uuid
+    return msg, signature, client
+
+
+def verify_session_token(msg, signature, user):
+    """Verify the signature of a session token of the user.
+
+    Return True, otherwise None."""
+
+    if not consteq(signature, session_token_signature(msg, user)):
+        log.debug('session token signature mismatch')
+        return
+
+    return True
+
+
+def set_token_auth_user(holder, token):
+    """Set holder.auth_user from a session token.
+
+    The token is verified by its expiry and by its signature with the user's
+    email and password hash, without hashing the password. A token of a
+    closed account or of changed credentials fails.
+    Revocation costs a User table read by id, the user is then cached (see
+    AUTH_CACHE_TTL). A revocation by another server process takes effect
+    once the cached user expires.
+    The user has only the token's client.
+    Return True, otherwise None."""
+
+    log.debug('set_token_auth_user()')
+
+    parsed = parse_session_token(token)
+    if not parsed:
+        log.debug('response = auth fail')
+        holder.response.set_data(APIErrorResponse.AUTH_FAIL)
+        return
+
+    msg, signature, client = parsed
+
+    auth_user = get_token_user(holder, client.userId)
+    if not auth_user:
+        return
+
+    if not verify_session_token(msg, signature, auth_user):
+        log.debug('response = auth fail')
+        holder.response.set_data(APIErrorResponse.AUTH_FAIL)
+        return
+
+    auth_user.clients.append(client)
+
+    log.debug('user authenticated by session token')
+    holder.auth_token = token
+    holder.auth_user = auth_user
+    return True
+
+
+def get_token_user(holder, user_id):
+    """Return the user of a session token, from the cache or by id.
+
+    Return the User, otherwise None."""
+
+    cache_key = token_user_cache_key(user_id)
+
+    cached = _auth_cache.get(cache_key)
+    if cached:
+        log.debug('session token user cache hit')
+        user = User()
+        user.rowid = user_id
+        user.email, user.password = cached
+        return user
+
+    query_user = User()
+    query_user.rowid = user_id
+
+    sql_result = execute_statement(
+        statement=User.SELECT_BY_ID,
+        params=query_user.select_by_id_params(),
+        object_class=User,
+        holder=holder)
+
+    log.debug('sql_result = %s', sql_result.to_native())
+
+    if sql_result.errno:
+        log.error('response = internal server error')
+        holder.response.set_data(APIErrorResponse.INTERNAL_SERVER_ERROR)
+        return
+
+    if not sql_result.objects:
+        log.debug('session token user not found')
+        log.debug('response = auth fail')
+        holder.response.set_data(APIErrorResponse.AUTH_FAIL)
+        return
+
+    user = sql_result.objects[0]
+    _auth_cache.set(cache_key, (user.email, user.password))
+    return user
+
+
+def set_auth_user(holder):
+    """Set holder.auth_user by authenticating against an existing account.
+
+    By session token (token query argument) for the request types accepting
+    it (APIRequestType.TOKEN_AUTH), otherwise by email and password.
+    The user has at most the client of the request body clientUUID, when
+    already parsed (see set_auth_client).
+    Return True, otherwise None."""
+
+    log.debug('set_auth_user()')
+
+    req_args = holder.request.args
+
+    token = req_args.get('token')
+    if token and AUTH_TOKEN_SECRET and \
+            req_args.get('type') in APIRequestType.TOKEN_AUTH:
+        return set_token_auth_user(holder, token)
+
+    query_user = UserClient()
+    query_user.email = req_args.get('email')
+    query_user.password = req_args.get('password')
+    query_user.UUID = getattr(holder.request_body, 'clientUUID', None)
+
+    try:
+        query_user.validate()
+    except ValidationError as e:
+        log.debug('query_user validation error = %s', e)
+        log.debug('response = auth fail')
+        holder.response.set_data(APIErrorResponse.AUTH_FAIL)
+        return
+
+    sql_result = execute_statement(
+        statement=UserClient.SELECT_BY_EMAIL_CLIENT_UUID,
+        params=query_user.select_by_email_client_uuid_params(),
+        object_class=UserClient,
+        holder=holder)
+
+    log.debug('sql_result = %s', sql_result.to_native())
+
+    if sql_result.errno:
+        log.error('response = internal server error')
+        holder.response.set_data(APIErrorResponse.INTERNAL_SERVER_ERROR)
+        return
+
+    if not sql_result.objects:
+        log.debug('response = auth fail')
+        holder.response.set_data(APIErrorResponse.AUTH_FAIL)
+        return
+
+    user_client = sql_result.objects[0]
+
+    auth_user = User()
+    auth_user.rowid = user_client.rowid
+    auth_user.email = user_client.email
+    auth_user.password = user_client.password
+
+    log.debug('auth_user.email = %s', auth_user.email)
+    log.debug('auth_user.password = %s', auth_user.password)
+
+    cache_key = auth_cache_key(query_user.email, query_user.password,
+                               auth_user.password)
+
+    try:
+        verified = verify_password(query_user.password, auth_user.password,
+                                   cache_key)
+    except HashPoolBusy:
+        log.error('hash pool busy')
+        log.error('response = internal server error')
+        holder.response.set_data(APIErrorResponse.INTERNAL_SERVER_ERROR)
+        return
+
+    if not verified:
+        log.debug('response = auth fail')
+        holder.response.set_data(APIErrorResponse.AUTH_FAIL)
+        return
+
+    # Append Client, if existing.
+    if user_client.client_rowid is not None:
+        client = Client()
+        client.rowid = user_client.client_rowid
+        client.userId = auth_user.rowid
+        client.UUID = user_client.UUID
+        auth_user.clients.append(client)
+
+    # Success.
+    log.debug('user authenticated')
+    holder.auth_cache_key = cache_key
+    holder.auth_user = auth_user
+    return True
+
+
+def set_auth_user_request_body(req_body_cls, holder):
+    """Set holder.request_body (see set_request_body) and holder.auth_user.
+
+    The request body is parsed first, its clientUUID keys the auth user
+    client lookup. A request body error is responded only once the user is
+    authenticated, an unauthenticated request gets the auth fail error.
+    Return True, otherwise None."""
+
+    log.debug('set_auth_user_request_body()')
+
+    body_ok = set_request_body(req_body_cls, holder)
+    body_error = holder.response.get_data()
+
+    if not set_auth_user(holder):
+        return
+
+    if not body_ok:
+        log.debug('response = request body error')
+        holder.response.set_data(body_error)
+        return
+
+    return True
+
+
+def set_auth_client(holder):
+    """Set holder.auth_client from existing or by inserting a new client.
+
+    The existing client was selected with the user (see set_auth_user).
+    Return True, otherwise None."""
+
+    log.debug('set_auth_client()')
+
+    for c in holder.auth_user.clients:
+        if c.UUID == holder.request_body.clientUUID:
+            holder.auth_client = c
+            return True
+
+    # A session token is bound to its client.
+    if holder.auth_token:
+        log.debug('clientUUID is not the session token client')
+        log.debug('response = auth fail')
+        holder.response.set_data(APIErrorResponse.AUTH_FAIL)
+        return
+
+    # Otherwise insert new client.
+    new_client = Client()
+    new_client.UUID = holder.request_body.clientUUID
+    new_client.userId = holder.auth_user.rowid
+
+    try:
+        new_client.validate()
+    except ValidationError as e:
+        log.debug('new_client validation error = %s' % e)
+        log.debug('response = malformed request')
+        holder.response.set_data(APIErrorResponse.MALFORMED_REQUEST)
+
+    sql_result = execute_statement(
+        statement=Client.INSERT,
+        params=new_client.insert_params(),
+        holder=holder,
+        is_select=False)
+
+    error_response = handle_user_sql_result_error(sql_result)
+    if error_response:
+        holder.response.set_data(error_response)
+        return
+
+    new_client.rowid = sql_result.lastrowid
+    holder.auth_client = new_client
+    return True
+
+
+# Time of the last request path sweep by object class name.
+_sweep_times = {}
+
+
+def sweep_sessions(holder):
+    """Sweep the SyncCount table of the object class in the request path.
+
+    Only when no janitor thread runs in this process (e.g. CGI), at most once
+    per JANITOR_INTERVAL per object class and process. Expired sessions are
+    marked committed and, for the insert allocator, trailing committed
+    sessions are deleted. A failed sweep does not fail the request."""
+
+    if not JANITOR_INTERVAL or _janitor_pid == os.getpid():
+        return
+
+    name = holder.object_class.__name__
+    now = time()
+    if now - _sweep_times.get(name, 0) < JANITOR_INTERVAL:
+        return
+    _sweep_times[name] = now
+
+    log.debug('sweep_sessions()')
+
+    import janitor
+    janitor.mark_expired_sessions_committed(holder, name)
+    if SYNC_COUNT_ALLOCATOR == 'insert':
+        janitor.delete_trailing_committed(holder, name)
+
+
+def set_session_sc(holder):
+    """Set session sync count. Return True, otherwise None.
+
+    Allocated by the configured SYNC_COUNT_ALLOCATOR."""
+
+    log.debug('set_session_sc()')
+
+    sweep_sessions(holder)
+
+    sc = SyncCount()
+    sc.object_class = holder.object_class.__name__
+
+    if SYNC_COUNT_ALLOCATOR == 'sequence':
+        sql_result = execute_statements(
+            statements=SyncCount.SELECT_SESSION_SC,
+            params=sc.select_session_sc_params(),
+            object_class=SyncCount,
+            holder=holder)
+    else:
+        # INSERT and COMMIT, the sync count is the insert id.
+        sql_result = execute_statement(
+            statement=SyncCount.INSERT,
+            params=sc.insert_params(),
+            holder=holder,
+            is_select=False)
+        if sql_result.lastrowid:
+            sc.sync_count = sql_result.lastrowid
+            sql_result.objects.append(sc)
+
+    log.debug('sql_result = %s', sql_result.to_native())
+
+    if sql_result.errno:
+        log.error('response = internal server error')
+        holder.response.set_data(APIErrorResponse.INTERNAL_SERVER_ERROR)
+        return
+
+    if not sql_result.objects:
+        log.error('response = internal server error')
+        holder.response.set_data(APIErrorResponse.INTERNAL_SERVER_ERROR)
+        return
+
+    holder.session_sc = sql_result.objects[0]
+    return True
+
+
+def mark_session_committed(holder):
+    """Mark session as committed. Return True, otherwise None."""
+
+    log.debug('mark_session_committed()')
+
+    sql_result = execute_statement(
+        statement=SyncCount.UPDATE_SET_IS_COMMITTED,
+        params=holder.session_sc.update_set_is_committed_params(),
+        holder=holder,
+        is_select=False)
+
+    log.debug('sql_result = %s', sql_result.to_native())
+
+    # Local invalidation, the cached committed sync count has moved on.
+    _committed_sc_cache.pop(holder.object_class.__name__)
+
+    if sql_result.errno:
+        log.error('response = internal server error')
+        holder.response.set_data(APIErrorResponse.INTERNAL_SERVER_ERROR)
+        return
+
+    return True
+
+
+# Committed sync count cache, by object class name.
+# Only holds a committed sync count equal to the highest sync count of the
+# class, re-validated against the highest (see SyncCount.SELECT_MAX_SC).
+_committed_sc_cache = TTLCache(
+    len(OBJECT_CLASSES) if COMMITTED_SC_CACHE_TTL else 0,
+    COMMITTED_SC_CACHE_TTL)
+
+
+def select_max_sc(holder, sc):
+    """Return the highest sync count of the object class, otherwise None."""
+
+    sql_result = execute_statement(
+        statement=SyncCount.SELECT_MAX_SC,
+        params=sc.select_max_sc_params(),
+        object_class=SyncCount,
+        holder=holder)
+
+    log.debug('sql_result = %s', sql_result.to_native())
+
+    if sql_result.errno or not sql_result.objects:
+        return
+
+    return sql_result.objects[0].sync_count
+
+
+def set_committed_sc(holder):
+    """Set committed sync count. Return True, otherwise None.
+
+    Served from the committed sync count cache while the highest sync count
+    of the class is unchanged."""
+
+    log.debug('set_committed_sc()')
+
+    sc = SyncCount()
+    sc.object_class = holder.object_class.__name__
+
+    max_sc = None
+    if _committed_sc_cache.max_size:
+        max_sc = select_max_sc(holder, sc)
+        if max_sc is not None and \
+                max_sc == _committed_sc_cache.get(sc.object_class):
+            log.debug('committed sync count cache hit')
+            holder.response_body.committedSyncCount = max_sc
+            return True
+
+    sql_result = execute_statement(
+        statement=SyncCount.SELECT_COMMITTED_SC,
+        params=sc.select_committed_sc_params(),
+        object_class=SyncCount,
+        holder=holder)
+
+    log.debug('sql_result = %s', sql_result.to_native())
+
+    if sql_result.errno:
+        log.error('response = internal server error')
+        holder.response.set_data(APIErrorResponse.INTERNAL_SERVER_ERROR)
+        return
+
+    if not sql_result.objects:
+        log.error('response = internal server error')
+        holder.response.set_data(APIErrorResponse.INTERNAL_SERVER_ERROR)
+        return
+
+    committed_sc = sql_result.objects[0].sync_count
+
+    # Cacheable when there were no uncommitted sessions.
+    if max_sc is not None and committed_sc == max_sc:
+        _committed_sc_cache.set(sc.object_class, committed_sc)
+
+    holder.response_body.committedSyncCount = committed_sc
+    return True
+
+
+def full_sync_required(holder):
+    """Check the client's last sync against the committed sync count.
+
+    Return True and set the error response if a full sync is required."""
+
+    if holder.request_body.lastSync > holder.response_body.committedSyncCount:
+        log.debug('lastSync > committedSyncCount')
+        log.debug('response = full sync required')
+        holder.response.set_data(APIErrorResponse.FULL_SYNC_REQUIRED)
+        return True
+
+
+# Keyset cursor id when no lastObjectId is given.
+# Cursor (lastSync, MAX_OBJECT_ID) selects objects after lastSync.
+MAX_OBJECT_ID = 2 ** 63 - 1
+
+
+def set_sync_down_rows(holder):
+    """Set the unbuffered result rows of a sync download select.
+
+    Objects are selected in (lastSync, id) order after the keyset cursor
+    (request lastSync, lastObjectId), without OFFSET scans.
+    Return True, otherwise None."""
+
+    log.debug('set_sync_down_rows()')
+
+    info = holder.object_class_info
+    req_body = holder.request_body
+    res_body = holder.response_body
+
+    last_object_id = req_body.lastObjectId
+    if last_object_id is None:
+        last_object_id = MAX_OBJECT_ID
+
+    # Select one more than the limit to detect more objects.
+    params = (holder.auth_user.rowid,
+              req_body.lastSync,
+              req_body.lastSync,
+              last_object_id,
+              res_body.committedSyncCount,
+              holder.auth_client.rowid,
+              info.max_objects + 1)
+
+    sql_result, rows = execute_statement_iter(
+        statement=info.sql.select_sync_down,
+        params=params,
+        holder=holder)
+
+    if sql_result.errno:
+        log.error('sql_result = %s', sql_result.to_native())
+        log.error('response = internal server error')
+        holder.response.set_data(APIErrorResponse.INTERNAL_SERVER_ERROR)
+        return
+
+    holder.rows = rows
+    return True
+
+
+def iter_sync_down_objects(holder):
+    """Yield (primitive, data) for each object of a sync download.
+
+    Where data is the object encoded by the response codec.
+    The batch is limited by the object class max objects and max bytes,
+    and by the bytes left of holder.max_bytes (sync batch) when set.
+    The response moreObjects flag is set once the rows are exhausted.
+    A database error while reading ends the batch early with moreObjects,
+    the client continues from the last object received."""
+
+    info = holder.object_class_info
+    res_body = holder.response_body
+
+    max_bytes = info.max_bytes
+    if holder.max_bytes is not None:
+        max_bytes = min(max_bytes, holder.max_bytes - holder.sync_bytes)
+
+    more_objects = False
+    count = 0
+    size = 0
+
+    try:
+        for row in holder.rows:
+            if count == info.max_objects:
+                more_objects = True
+                break
+            primitive = info.sql.row_primitive(row)
+            data = holder.codec.dumps(primitive)
+            # Encoded size including a separator.
+            data_size = len(data) + 1
+            # A first object over the limit is sent when the response has
+            # no other objects, the client progresses.
+            if size + data_size > max_bytes and (count or holder.sync_bytes):
+                more_objects = True
+                break
+            size += data_size
+            count += 1
+            yield primitive, data
+    except mysql.connector.Error as e:
+        log.error('MySQL error no = %s', e.errno)
+        log.error('MySQL error msg = %s', e.msg)
+        more_objects = True
+    finally:
+        holder.rows.close()
+
+    log.debug('objects = %s, moreObjects = %s', count, more_objects)
+
+    holder.sync_bytes += size
+    res_body.moreObjects = more_objects
+
+
+def set_sync_down_objects(holder):
+    """Set the response objects and moreObjects flag of a sync download.
+
+    Return True, otherwise None."""
+
+    log.debug('set_sync_down_objects()')
+
+    if not set_sync_down_rows(holder):
+        return
+
+    holder.response_body.objects = [primitive for primitive, data in
+                                    iter_sync_down_objects(holder)]
+    return True
+
+
+def chunks(items, size):
+    """Yield successive chunks of items of at most size."""
+
+    for i in xrange(0, len(items), size):
+        yield items[i:i + size]
+
+
+def set_sync_up_objects(holder):
+    """Set holder.new_objects and holder.changed_objects from request_body.
+
+    The plain objects are validated by the compiled validator of the object
+    class and kept as plain (converted) dicts.
+    Objects without a server object id (rowid) are new.
+    On invalid objects the response lists the errors of each invalid object
+    in data, by object index.
+    Return True, otherwise None."""
+
+    log.debug('set_sync_up_objects()')
+
+    objects = holder.request_body.objects
+
+    if len(objects) > holder.object_class_info.max_objects:
+        log.debug('objects = %s > max objects', len(objects))
+        log.debug('response = malformed request')
+        holder.response.set_data(APIErrorResponse.MALFORMED_REQUEST)
+        return
+
+    validator = holder.object_class_info.validator
+    new_objects = []
+    changed_objects = []
+    invalid_objects = []
+
+    for i, jo in enumerate(objects):
+        obj, errors = validator(jo)
+
+        if errors:
+            invalid_objects.append({'index': i, 'errors': errors})
+        elif obj['rowid']:
+            changed_objects.append(obj)
+        elif obj['originClientObjectId'] is not None:
+            new_objects.append(obj)
+        else:
+            invalid_objects.append({'index': i, 'errors': {
+                'originClientObjectId': [u'Required for a new object.']}})
+
+    if invalid_objects:
+        log.debug('invalid sync up objects = %s', invalid_objects)
+        log.debug('response = invalid json object')
+        holder.response_body = ResponseBody()
+        holder.response_body.error = APIErrorCode.INVALID_JSON_OBJECT
+        holder.response_body.data = invalid_objects
+        pack_response(holder)
+        return
+
+    holder.new_objects = new_objects
+    holder.changed_objects = changed_objects
+    return True
+
+
+def write_sync_up_objects(holder):
+    """Write the sync up objects within the session data transaction.
+
+    New objects are inserted with a multi row upsert, duplicates (resent
+    objects) are matched by the uniqueObjectConstraint.
+    Changed objects are updated with a set based conditional update.
+    The transaction is left open for mark_session_committed.
+    On failure the transaction is rolled back and the session is still marked
+    as committed.
+    Return True, otherwise None."""
+
+    log.debug('write_sync_up_objects()')
+
+    sql = holder.object_class_info.sql
+    client_id = holder.auth_client.rowid
+    user_id = holder.auth_user.rowid
+    session_sc = holder.session_sc.sync_count
+
+    statements = []
+    params = []
+
+    for chunk in chunks(holder.new_objects, MAX_STATEMENT_ROWS):
+        chunk_params = []
+        for obj in chunk:
+            obj['originClientId'] = client_id
+            obj['lastUpdatedByClientId'] = client_id
+            obj['ownerUserId'] = user_id
+            obj['lastSync'] = session_sc
+            chunk_params.extend(sql.insert_item_params(obj))
+        statements.append(sql.upsert(len(chunk)))
+        params.append(tuple(chunk_params))
+
+    for chunk in chunks(holder.changed_objects, MAX_STATEMENT_ROWS):
+        chunk_params = []
+        for obj in chunk:
+            chunk_params.extend(sql.update_item_params(obj))
+        chunk_params.extend((client_id, session_sc, user_id))
+        statements.append(sql.update_by_id(len(chunk)))
+        params.append(tuple(chunk_params))
+
+    if not statements:
+        return True
+
+    sql_result = execute_statements(
+        statements=statements,
+        params=params,
+        holder=holder,
+        is_select=False,
+        commit=False)
+
+    if sql_result.errno:
+        log.error('sql_result = %s', sql_result.to_native())
+
+        try:
+            holder.cnx.rollback()
+        except mysql.connector.Error as e:
+            log.error('rollback exception = %s', e)
+
+        mark_session_committed(holder)
+
+        log.error('response = internal server error')
+        holder.response.set_data(APIErrorResponse.INTERNAL_SERVER_ERROR)
+        return
+
+    return True
+
+
+def set_sync_up_response_objects(holder):
+    """Set the response objects to the current values of the sync up objects.
+
+    Includes the server values of any objects that were not updated.
+    Return True, otherwise None."""
+
+    log.debug('set_sync_up_response_objects()')
+
+    sql = holder.object_class_info.sql
+    user_id = holder.auth_user.rowid
+
+    statements = []
+    params = []
+
+    for chunk in chunks(holder.new_objects, MAX_STATEMENT_ROWS):
+        statements.append(sql.select_by_origin(len(chunk)))
+        params.append((user_id, holder.auth_client.rowid) +
+                      tuple(obj['originClientObjectId'] for obj in chunk))
+
+    for chunk in chunks(holder.changed_objects, MAX_STATEMENT_ROWS):
+        statements.append(sql.select_by_ids(len(chunk)))
+        params.append((user_id,) + tuple(obj['rowid'] for obj in chunk))
+
+    objects = []
+
+    for i, stmt in enumerate(statements):
+        sql_result = execute_statement(
+            statement=stmt,
+            params=params[i],
+            object_class=holder.object_class,
+            holder=holder)
+
+        if sql_result.errno:
+            log.error('sql_result = %s', sql_result.to_native())
+            log.error('response = internal server error')
+            holder.response.set_data(APIErrorResponse.INTERNAL_SERVER_ERROR)
+            return
+
+        objects.extend(obj.to_primitive() for obj in sql_result.objects)
+
+    holder.response_body.objects = objects
+    return True
+
+
+def test(holder):
+    """Test request handler."""
+
+    log.debug('test()')
+
+    if not set_auth_user(holder):
+        return
+
+    log.debug('response = success')
+    holder.response.set_data(APIErrorResponse.SUCCESS)
+
+
+# Encoded base data responses (snapshots) of (etag, data, compressed) by
+# base_data_key(). compressed is a dict of the data compressed by
+# Content-Encoding, filled on demand.
+_base_data_cache = TTLCache(BASE_DATA_CACHE_SIZE, BASE_DATA_CACHE_TTL)
+
+
+def base_data_key(holder, committed_sc):
+    """Return the base data snapshot cache key of the request.
+
+    At the committed sync count, base data changes are committed with a
+    higher sync count so a commit changes the key."""
+
+    req_body = holder.request_body
+    return (holder.object_class_info.name,
+            req_body.lastSync,
+            req_body.lastObjectId,
+            holder.codec.CONTENT_TYPE,
+            committed_sc)
+
+
+def base_data_etag(key):
+    """Return the base data ETag of a snapshot key."""
+
+    parts = key + (BASE_DATA_OWNER_EMAIL,)
+    return hashlib.md5('\n'.join('%s' % p for p in parts)).hexdigest()
+
+
+def base_data_not_modified(holder, etag):
+    """Set the response ETag.
+
+    Return True and set the not modified response if the request
+    If-None-Match has the ETag."""
+
+    # Weak, the body may be compressed. Werkzeug quotes weak ETags as w/.
+    holder.response.headers['ETag'] = 'W/"%s"' % etag
+
+    if holder.request.if_none_match.contains_weak(etag):
+        log.debug('response = not modified')
+        holder.response.status_code = HTTP.NOT_MODIFIED
+        holder.response.set_data('')
+        return True
+
+
+def set_base_data_owner(holder):
+    """Set holder.auth_user to the base data owner, if any.
+
+    The base data objects of all clients are selected.
+    Return True, otherwise None."""
+
+    log.debug('set_base_data_owner()')
+
+    holder.auth_user = None
+
+    if not BASE_DATA_OWNER_EMAIL:
+        return True
+
+    owner = User()
+    owner.email = BASE_DATA_OWNER_EMAIL
+
+    sql_result = execute_statement(
+        statement=User.SELECT_BY_EMAIL,
+        params=owner.select_by_email_params(),
+        object_class=User,
+        holder=holder)
+
+    if sql_result.errno:
+        log.error('sql_result = %s', sql_result.to_native())
+        log.error('response = internal server error')
+        holder.response.set_data(APIErrorResponse.INTERNAL_SERVER_ERROR)
+        return
+
+    if not sql_result.objects:
+        log.warn('base data owner %s not found', BASE_DATA_OWNER_EMAIL)
+        return True
+
+    holder.auth_user = sql_result.objects[0]
+
+    # No client is excluded (client ids start at 1).
+    holder.auth_client = Client()
+    holder.auth_client.rowid = 0
+
+    return True
+
+
+def get_base_data_snapshot(holder, etag):
+    """Select and encode the base data objects of the request.
+
+    Return the snapshot (etag, data, compressed), otherwise None."""
+
+    log.debug('get_base_data_snapshot()')
+
+    if not set_base_data_owner(holder):
+        return
+
+    res_body = holder.response_body
+
+    if holder.auth_user is None:
+        objects = []
+        res_body.moreObjects = False
+    else:
+        if not set_sync_down_rows(holder):
+            return
+        objects = [data for primitive, data in iter_sync_down_objects(holder)]
+
+    try:
+        res_body.validate()
+        data = holder.codec.dumps_objects(res_body.to_primitive(), objects)
+    except Exception as e:
+        log.error('response body exception = %s' % e)
+        log.error('response = internal server error')
+        holder.response.set_data(APIErrorResponse.INTERNAL_SERVER_ERROR)
+        return
+
+    return etag, data, {}
+
+
+def set_base_data_response(holder, snapshot):
+    """Set the snapshot response, not modified or compressed as negotiated.
+
+    The data is compressed once per Content-Encoding and kept with the
+    snapshot."""
+
+    etag, data, compressed = snapshot
+
+    if base_data_not_modified(holder, etag):
+        return
+
+    log.debug('response = success + objects')
+
+    encoding = response_encoding(holder)
+    if not encoding or len(data) < COMPRESSION_MIN_SIZE:
+        holder.response.set_data(data)
+        return
+
+    if encoding not in compressed:
+        compressed[encoding] = ContentEncoding.compress(data, encoding,
+                                                        COMPRESSION_LEVEL)
+
+    holder.response.set_data(compressed[encoding])
+    holder.response.content_encoding = encoding
+
+
+# File name of the static base data manifest.
+STATIC_BASE_DATA_MANIFEST = 'manifest.json'
+
+# Static base data manifest and its modification time, loaded on change.
+_static_base_data = {'mtime': None, 'manifest': {}}
+
+
+def static_base_data_path(file_name=''):
+    """Return the path of a static base data file."""
+
+    return os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        STATIC_BASE_DATA_DIR, file_name)
+
+
+def get_static_base_data_manifest():
+    """Return the static base data manifest, {} if there is none.
+
+    The manifest maps the object class name to its exported file and
+    committedSyncCount. Reloaded when the manifest file changes."""
+
+    path = static_base_data_path(STATIC_BASE_DATA_MANIFEST)
+
+    try:
+        mtime = os.stat(path).st_mtime
+    except OSError:
+        return {}
+
+    if mtime != _static_base_data['mtime']:
+        try:
+            with open(path) as f:
+                manifest = JSON.load(f)
+        except (IOError, ValueError) as e:
+            log.error('static base data manifest exception = %s', e)
+            return {}
+        _static_base_data['manifest'] = manifest
+        _static_base_data['mtime'] = mtime
+
+    return _static_base_data['manifest']
+
+
+def redirect_static_base_data(holder):
+    """Redirect a base data download to the exported static file, if any.
+
+    Only initial JSON downloads (lastSync 0, without lastObjectId) are
+    redirected, the static file holds all the base data objects. An
+    incremental download would get all the objects again and the export
+    may be older than the client's lastSync.
+    Return True if redirected."""
+
+    req_body = holder.request_body
+    if not STATIC_BASE_DATA_URL or holder.codec is not JSON or \
+            req_body.lastSync != 0 or req_body.lastObjectId is not None:
+        return
+
+    entry = get_static_base_data_manifest().get(holder.object_class_info.name)
+    if not entry:
+        return
+
+    location = STATIC_BASE_DATA_URL + entry['file']
+    log.debug('response = see other %s', location)
+    holder.response.status_code = HTTP.SEE_OTHER
+    holder.response.headers['Location'] = location
+    holder.response.set_data('')
+    return True
+
+
+def base_data_down_cached(holder):
+    """Answer a base data download without the database, if possible.
+
+    Parses the request body, then redirects to the static base data or
+    answers from the snapshot cache. Called before the database connection
+    is opened (see application()).
+    The snapshot is looked up at the committed sync count of the committed
+    sync count cache, which a commit by this process clears and the next
+    read by another process revalidates (see set_committed_sc).
+    Return True if answered (including errors), otherwise None."""
+
+    log.debug('base_data_down_cached()')
+
+    # Auth User Not Required #
+
+    if not set_request_body(BaseDataDownRequestBody, holder):
+        return True
+
+    if not set_object_class(holder):
+        return True
+
+    if redirect_static_base_data(holder):
+        return True
+
+    committed_sc = _committed_sc_cache.get(holder.object_class_info.name)
+    if committed_sc is None:
+        return
+
+    snapshot = _base_data_cache.get(base_data_key(holder, committed_sc))
+    if snapshot is None:
+        return
+
+    log.debug('base data snapshot cache hit')
+    set_base_data_response(holder, snapshot)
+    return True
+
+
+def base_data_down(holder):
+    """Base Data Download request handler.
+
+    Base data is the same for every client, the encoded response is cached as
+    a snapshot of the committed sync count and sent with an ETag. A request
+    If-None-Match with the ETag gets a not modified response. Cache hits are
+    answered by base_data_down_cached(), without the database."""
+
+    log.debug('base_data_down()')
+
+    # Not yet tried by application().
+    if holder.request_body is None and base_data_down_cached(holder):
+        return
+
+    holder.response_body = ResponseBody()
+
+    if not set_committed_sc(holder):
+        return
+
+    key = base_data_key(holder, holder.response_body.committedSyncCount)
+    etag = base_data_etag(key)
+    if base_data_not_modified(holder, etag):
+        return
+
+    snapshot = _base_data_cache.get(key)
+    if snapshot is None:
+        snapshot = get_base_data_snapshot(holder, etag)
+        if not snapshot:
+            return
+        _base_data_cache.set(key, snapshot)
+
+    set_base_data_response(holder, snapshot)
+
+
+def sync_down(holder):
+    """Sync Download request handler."""
+
+    log.debug('sync_down()')
+
+    if not set_auth_user_request_body(SyncDownRequestBody, holder):
+        return
+
+    if not set_object_class(holder):
+        return
+
+    if not set_auth_client(holder):
+        return
+
+    holder.response_body = ResponseBody()
+
+    if not set_committed_sc(holder):
+        return
+
+    if full_sync_required(holder):
+        return
+
+    if not set_sync_down_rows(holder):
+        return
+
+    pack_response_stream(holder, iter_sync_down_objects(holder))
+
+
+def sync_up(holder):
+    """Sync Upload request handler."""
+
+    log.debug('sync_up()')
+
+    if not set_auth_user_request_body(SyncUpRequestBody, holder):
+        return
 
-    :type holder: Holder
-    :rtype: CryptContext
-    """
+    if not set_auth_client(holder):
+        return
 
-    if holder.password_context:
-        return holder.password_context
+    if not set_object_class(holder):
+        return
 
-    holder.password_context = CryptContext(
-        # Supported schemes.
-        schemes=["sha256_crypt"],
-        default="sha256_crypt",
+    if not set_sync_up_objects(holder):
+        return
 
-        # Vary rounds parameter randomly when creating new hashes.
-        all__vary_rounds=0.1,
+    if not set_session_sc(holder):
+        return
 
-        # Set a good starting point for rounds selection
-        sha512_crypt__min_rounds=60000,
-        sha256_crypt__min_rounds=80000,
+    holder.response_body = ResponseBody()
 
-        # If the admin user category is selected, make a much stronger hash,
-        admin__sha512_crypt__min_rounds=120000,
-        admin__sha256_crypt__min_rounds=160000)
+    if not write_sync_up_objects(holder):
+        return
 
-    return holder.password_context
+    if not mark_session_committed(holder):
+        return
 
+    if not set_committed_sc(holder):
+        return
 
-def set_auth_user(holder):
-    """Set holder.auth_user by authenticating against an existing account.
+    if not set_sync_up_response_objects(holder):
+        return
 
-    Return True, otherwise None."""
+    pack_response(holder)
 
-    log.debug('set_auth_user()')
 
-    req_args = holder.request.args
+def get_sync_batch_sections(holder):
+    """Return the validated (upload, download) sections of a sync batch.
 
-    query_user = UserClient()
-    query_user.email = req_args.get('email')
-    query_user.password = req_args.get('password')
+    Each object class may have one section of each.
+    Return the sections, otherwise None."""
 
-    try:
-        query_user.validate()
-    except ValidationError as e:
-        log.debug('query_user validation error = %s', e)
-        log.debug('response = auth fail')
-        holder.response.set_data(APIErrorResponse.AUTH_FAIL)
-        return
+    log.debug('get_sync_batch_sections()')
 
-    sql_result = execute_statement(
-        statement=UserClient.SELECT_BY_EMAIL,
-        params=query_user.select_by_email_params(),
-        object_class=UserClient,
-        holder=holder)
+    req_body = holder.request_body
+    batch = []
 
-    log.debug('sql_result = %s', sql_result.to_native())
+    for name, section_cls in (('syncUp', SyncUpSection),
+                              ('syncDown', SyncDownSection)):
+        if len(req_body[name]) > len(OBJECT_CLASSES):
+            log.debug('%s sections > object classes', name)
+            log.debug('response = malformed request')
+            holder.response.set_data(APIErrorResponse.MALFORMED_REQUEST)
+            return
 
-    if sql_result.errno:
-        log.error('response = internal server error')
-        holder.response.set_data(APIErrorResponse.INTERNAL_SERVER_ERROR)
-        return
+        validator = compiled_validator(section_cls)
+        sections = []
+        object_classes = set()
 
-    if not sql_result.objects:
-        log.debug('response = auth fail')
-        holder.response.set_data(APIErrorResponse.AUTH_FAIL)
-        return
+        for jo in req_body[name]:
+            section, errors = validator(jo)
+            if errors:
+                log.debug('%s section validation errors = %s', name, errors)
+                log.debug('response = invalid json object')
+                holder.response.set_data(APIErrorResponse.INVALID_JSON_OBJECT)
+                return
 
-    user_client = sql_result.objects[0]
+            if section['objectClass'] in object_classes:
+                log.debug('%s duplicate section = %s', name,
+                          section['objectClass'])
+                log.debug('response = invalid json object')
+                holder.response.set_data(APIErrorResponse.INVALID_JSON_OBJECT)
+                return
+            object_classes.add(section['objectClass'])
 
-    auth_user = User()
-    auth_user.rowid = user_client.rowid
-    auth_user.email = user_client.email
-    auth_user.password = user_client.password
+            section['clientUUID'] = req_body.clientUUID
+            sections.append(ValidatedObject(section))
 
-    log.debug('auth_user.email = %s', auth_user.email)
-    log.debug('auth_user.password = %s', auth_user.password)
+        batch.append(sections)
 
-    if not password_context(holder).verify(query_user.password,
-                                           auth_user.password):
-        log.debug('response = auth fail')
-        holder.response.set_data(APIErrorResponse.AUTH_FAIL)
-        return
+    return batch
 
-    # Append Clients #
-    for uc in sql_result.objects:
-        client = Client()
-        client.rowid = uc.client_rowid
-        client.UUID = uc.UUID
-        auth_user.clients.append(client)
 
-    # Success.
-    log.debug('user authenticated')
-    holder.auth_user = auth_user
-    return True
+def get_section_holder(holder, request_body):
+    """Return the holder of an object class section of a multi class request.
 
+    Shares the request, database connection and authentication of holder.
+    The section response is JSON."""
 
-def set_auth_client(holder):
-    """Set holder.auth_client from existing or by inserting a new client.
+    section = Holder()
+    section.request = holder.request
+    section.response = Response()
+    section.cursor = holder.cursor
+    section.cnx = holder.cnx
+    section.auth_user = holder.auth_user
+    section.auth_client = holder.auth_client
+    section.request_body = request_body
+    return section
 
-    Return True, otherwise None."""
 
-    log.debug('set_auth_client()')
+def get_section_result(section, ok):
+    """Return the result (primitive response body) of an object class section.
 
-    for c in holder.auth_user.clients:
-        if c.UUID == holder.request_body.clientUUID:
-            holder.auth_client = c
-            return True
+    The result of a failed section is its error response."""
 
-    # Otherwise insert new client.
-    new_client = Client()
-    new_client.UUID = holder.request_body.clientUUID
-    new_client.userId = holder.auth_user.rowid
+    if ok:
+        result = section.response_body.to_primitive()
+    else:
+        result = JSON.loads(section.response.get_data())
 
-    try:
-        new_client.validate()
-    except ValidationError as e:
-        log.debug('new_client validation error = %s' % e)
-        log.debug('response = malformed request')
-        holder.response.set_data(APIErrorResponse.MALFORMED_REQUEST)
+    result['objectClass'] = section.request_body.objectClass
+    return result
 
-    sql_result = execute_statement(
-        statement=Client.INSERT,
-        params=new_client.insert_params(),
-        holder=holder,
-        is_select=False)
 
-    error_response = handle_user_sql_result_error(sql_result)
-    if error_response:
-        holder.response.set_data(error_response)
-        return
+def sync_up_section(section):
+    """Sync upload the objects of a sync batch section.
 
-    new_client.rowid = sql_result.lastrowid
-    holder.auth_client = new_client
-    return True
+    Return True, otherwise None."""
 
+    log.debug('sync_up_section()')
 
-def mark_expired_sessions_committed(holder):
-    """Mark expired sessions as committed. Return True, otherwise None."""
+    if not set_object_class(section):
+        return
 
-    log.debug('mark_expired_sessions_committed()')
+    if not set_sync_up_objects(section):
+        return
 
-    sc = SyncCount()
-    sc.object_class = holder.object_class.__name__
+    if not set_session_sc(section):
+        return
 
-    sql_result = execute_statement(
-        statement=SyncCount.UPDATE_SET_IS_COMMITTED_EXPIRED,
-        params=sc.update_set_is_committed_expired_params(),
-        holder=holder,
-        is_select=False)
+    section.response_body = ResponseBody()
 
-    log.debug('sql_result = %s', sql_result.to_native())
+    if not write_sync_up_objects(section):
+        return
 
-    if sql_result.errno:
-        log.error('response = internal server error')
-        holder.response.set_data(APIErrorResponse.INTERNAL_SERVER_ERROR)
+    if not mark_session_committed(section):
         return
 
-    if sql_result.rowcount:
-        log.warn(SyncCount.WARN_EXPIRED_SESSIONS_COMMITTED,
-                 sql_result.rowcount)
+    if not set_committed_sc(section):
+        return
 
-    return True
+    return set_sync_up_response_objects(section)
 
 
-def set_session_sc(holder):
-    """Set session sync count. Return True, otherwise None."""
+def sync_down_section(section):
+    """Sync download the objects of a sync batch section.
 
-    log.debug('set_session_sc()')
+    Return True, otherwise None."""
 
-    sc = SyncCount()
-    sc.object_class = holder.object_class.__name__
+    log.debug('sync_down_section()')
 
-    sql_result = execute_statements(
-        statements=SyncCount.SELECT_SESSION_SC,
-        params=sc.select_session_sc_params(),
-        object_class=SyncCount,
-        holder=holder)
+    if not set_object_class(section):
+        return
 
-    log.debug('sql_result = %s', sql_result.to_native())
+    section.response_body = ResponseBody()
 
-    if sql_result.errno:
-        log.error('response = internal server error')
-        holder.response.set_data(APIErrorResponse.INTERNAL_SERVER_ERROR)
+    if not set_committed_sc(section):
         return
 
-    if not sql_result.objects:
-        log.error('response = internal server error')
-        holder.response.set_data(APIErrorResponse.INTERNAL_SERVER_ERROR)
+    if full_sync_required(section):
         return
 
-    holder.session_sc = sql_result.objects[0]
-    return True
+    return set_sync_down_objects(section)
 
 
-def mark_session_committed(holder):
-    """Mark session as committed. Return True, otherwise None."""
+def sync_batch(holder):
+    """Sync Batch request handler.
 
-    log.debug('mark_session_committed()')
+    Syncs several object classes with one authentication and database
+    connection. The upload sections are synced before the download sections.
+    Each section has its own error and committedSyncCount.
+    The download sections share SYNC_BATCH_MAX_BYTES, once used up the
+    following sections have moreObjects set."""
 
-    sql_result = execute_statement(
-        statement=SyncCount.UPDATE_SET_IS_COMMITTED,
-        params=holder.session_sc.update_set_is_committed_params(),
-        holder=holder,
-        is_select=False)
+    log.debug('sync_batch()')
 
-    log.debug('sql_result = %s', sql_result.to_native())
+    if not set_auth_user_request_body(SyncBatchRequestBody, holder):
+        return
 
-    if sql_result.errno:
-        log.error('response = internal server error')
-        holder.response.set_data(APIErrorResponse.INTERNAL_SERVER_ERROR)
+    batch = get_sync_batch_sections(holder)
+    if batch is None:
         return
 
-    return True
+    if not set_auth_client(holder):
+        return
 
+    up_sections, down_sections = batch
+    holder.response_body = SyncBatchResponseBody()
+
+    results = []
+    for request_body in up_sections:
+        section = get_section_holder(holder, request_body)
+        results.append(get_section_result(section, sync_up_section(section)))
+    holder.response_body.syncUp = results
+
+    results = []
+    sync_bytes = 0
+    for request_body in down_sections:
+        section = get_section_holder(holder, request_body)
+        section.max_bytes = SYNC_BATCH_MAX_BYTES
+        section.sync_bytes = sync_bytes
+        results.append(get_section_result(section,
+                                          sync_down_section(section)))
+        sync_bytes = section.sync_bytes
+    holder.response_body.syncDown = results
 
-def set_committed_sc(holder):
-    """Set committed sync count. Return True, otherwise None."""
+    pack_response(holder)
 
-    log.debug('set_committed_sc()')
 
-    sc = SyncCount()
-    sc.object_class = holder.object_class.__name__
+def set_user_last_sync(holder):
+    """Set the highest lastSync of the user's objects of the object class.
 
-    sql_result = execute_statement(
-        statement=SyncCount.SELECT_COMMITTED_SC,
-        params=sc.select_committed_sc_params(),
-        object_class=SyncCount,
-        holder=holder)
+    Objects of sessions not yet committed and objects last updated by the
+    requesting client are excluded, as in a sync download.
+    Return True, otherwise None."""
 
-    log.debug('sql_result = %s', sql_result.to_native())
+    log.debug('set_user_last_sync()')
 
-    if sql_result.errno:
+    res_body = holder.response_body
+
+    statement = holder.object_class_info.sql.select_max_last_sync
+    params = (holder.auth_user.rowid,
+              res_body.committedSyncCount,
+              holder.auth_client.rowid)
+
+    # A single scalar, read from the cursor row.
+    try:
+        holder.cursor.execute(statement, params)
+        rows = holder.cursor.fetchall()
+    except mysql.connector.Error as e:
+        log.error('MySQL error no = %s', e.errno)
+        log.error('MySQL error msg = %s', e.msg)
         log.error('response = internal server error')
         holder.response.set_data(APIErrorResponse.INTERNAL_SERVER_ERROR)
         return
 
-    if not sql_result.objects:
+    if not rows:
         log.error('response = internal server error')
         holder.response.set_data(APIErrorResponse.INTERNAL_SERVER_ERROR)
         return
 
-    holder.response_body.committedSyncCount = sql_result.objects[0].sync_count
+    res_body.lastSync = rows[0]['lastSync']
     return True
 
 
-def test(holder):
-    """Test request handler."""
-
-    log.debug('test()')
-
-    if not set_auth_user(holder):
-        return
-
-    log.debug('response = success')
-    holder.response.set_data(APIErrorResponse.SUCCESS)
-
-
-def base_data_down(holder):
-    """Base Data Download request handler."""
+def probe_section(section):
+    """Probe the committed sync count and user last sync of an object class.
 
-    log.debug('base_data_down()')
+    Return True, otherwise None."""
 
-    # Auth User Not Required #
+    log.debug('probe_section()')
 
-    if not set_request_body(BaseDataDownRequestBody, holder):
+    if not set_object_class(section):
         return
 
-    if not set_object_class(holder):
+    section.response_body = ResponseBody()
+
+    if not set_committed_sc(section):
         return
 
-    holder.response_body = ResponseBody()
-    holder.response_body.objects = []
+    return set_user_last_sync(section)
 
-    pack_response(holder)
 
+def sync_probe(holder):
+    """Sync Probe request handler.
 
-def sync_down(holder):
-    """Sync Download request handler."""
+    Returns the committedSyncCount and the user's lastSync of each requested
+    object class, without selecting objects. A client need not sync down a
+    class when the user's lastSync is not past its own last sync."""
 
-    log.debug('sync_down()')
+    log.debug('sync_probe()')
 
-    if not set_auth_user(holder):
+    if not set_auth_user_request_body(SyncProbeRequestBody, holder):
         return
 
-    if not set_request_body(SyncDownRequestBody, holder):
-        return
+    names = holder.request_body.objectClasses
 
-    if not set_object_class(holder):
+    if len(names) > len(OBJECT_CLASSES):
+        log.debug('object classes = %s > object classes', len(names))
+        log.debug('response = malformed request')
+        holder.response.set_data(APIErrorResponse.MALFORMED_REQUEST)
         return
 
     if not set_auth_client(holder):
         return
 
-    holder.response_body = ResponseBody()
-    holder.response_body.objects = []
-
-    pack_response(holder)
+    results = []
+    for name in names:
+        section = get_section_holder(holder, ValidatedObject(objectClass=name))
+        results.append(get_section_result(section, probe_section(section)))
 
+    holder.response_body = SyncProbeResponseBody()
+    holder.response_body.objectClasses = results
 
-def sync_up(holder):
-    """Sync Upload request handler."""
+    pack_response(holder)
 
-    log.debug('sync_up()')
 
-    if not set_auth_user(holder):
-        return
+def session_open(holder):
+    """Session Open request handler.
 
-    if not set_request_body(SyncUpRequestBody, holder):
-        return
+    Authenticates by email and password and returns a session token of the
+    client, accepted instead of the email and password until it expires."""
 
-    if not set_auth_client(holder):
-        return
+    log.debug('session_open()')
 
-    if not set_object_class(holder):
+    if not AUTH_TOKEN_SECRET:
+        log.debug('session tokens are disabled')
+        log.debug('response = request type unsupported')
+        holder.response.set_data(APIErrorResponse.REQUEST_TYPE_UNSUPPORTED)
         return
 
-    if not mark_expired_sessions_committed(holder):
+    if not set_auth_user_request_body(SessionOpenRequestBody, holder):
         return
 
-    if not set_session_sc(holder):
+    if not set_auth_client(holder):
         return
 
-    holder.response_body = ResponseBody()
-    holder.response_body.objects = []
-
-    if not mark_session_committed(holder):
-        return
+    expires = long(time()) + AUTH_TOKEN_TTL
 
-    if not set_committed_sc(holder):
-        return
+    holder.response_body = SessionOpenResponseBody()
+    holder.response_body.token = get_session_token(holder.auth_user,
+                                                   holder.auth_client,
+                                                   expires)
+    holder.response_body.expires = expires
 
     pack_response(holder)
 
@@ -757,7 +2464,8 @@ def account_open(holder):
             return
 
     # Hash password before database insertion.
-    new_user.password = password_context(holder).encrypt(new_user.password)
+    if not set_password_hash(holder, new_user):
+        return
 
     if not set_request_body(AccountOpenRequestBody, holder):
         return
@@ -810,6 +2518,8 @@ def account_close(holder):
         holder.response.set_data(error_response)
         return
 
+    invalidate_auth_cache(holder)
+
     log.debug('response = success')
     holder.response.set_data(APIErrorResponse.SUCCESS)
 
@@ -847,7 +2557,8 @@ def account_modify(holder):
             return
 
     # Hash password before database insertion.
-    mod_user.password = password_context(holder).encrypt(mod_user.password)
+    if not set_password_hash(holder, mod_user):
+        return
 
     log.debug('mod_user.email = %s' % mod_user.email)
     log.debug('mod_user.password = %s' % mod_user.password)
@@ -863,6 +2574,8 @@ def account_modify(holder):
         holder.response.set_data(error_response)
         return
 
+    invalidate_auth_cache(holder)
+
     log.debug('response = success')
     holder.response.set_data(APIErrorResponse.SUCCESS)
 
@@ -886,6 +2599,12 @@ def route_request(holder):
         sync_down(holder)
     elif t == APIRequestType.SYNC_UP:
         sync_up(holder)
+    elif t == APIRequestType.SYNC_BATCH:
+        sync_batch(holder)
+    elif t == APIRequestType.SYNC_PROBE:
+        sync_probe(holder)
+    elif t == APIRequestType.SESSION_OPEN:
+        session_open(holder)
     elif t == APIRequestType.ACCOUNT_OPEN:
         account_open(holder)
     elif t == APIRequestType.ACCOUNT_CLOSE:
@@ -898,6 +2617,57 @@ def route_request(holder):
         holder.response.set_data(APIErrorResponse.MALFORMED_REQUEST)
 
 
+# Process id of the process running the janitor thread.
+_janitor_pid = None
+_janitor_lock = threading.Lock()
+
+
+def start_janitor():
+    """Start the janitor thread once per (forked) process.
+
+    Called by the long running entry points (prefork.py workers, FastCGI,
+    mod_wsgi and the development server), not per request. A CGI process
+    exits before the first sweep, it sweeps in the request path instead
+    (see sweep_sessions) unless ./janitor.py runs from cron."""
+
+    global _janitor_pid
+
+    if not JANITOR_INTERVAL or _janitor_pid == os.getpid():
+        return
+
+    with _janitor_lock:
+        if _janitor_pid == os.getpid():
+            return
+        _janitor_pid = os.getpid()
+
+    from janitor import JanitorThread
+
+    log.debug('starting janitor, interval = %s', JANITOR_INTERVAL)
+    JanitorThread(JANITOR_INTERVAL).start()
+
+
+# Request body classes, their validators are compiled on first use.
+REQUEST_BODY_CLASSES = (BaseDataDownRequestBody, SyncDownRequestBody,
+                        SyncUpRequestBody, SyncBatchRequestBody,
+                        SyncProbeRequestBody, SessionOpenRequestBody,
+                        AccountOpenRequestBody, AccountModifyRequestBody)
+
+
+def warm_up():
+    """Create the resources otherwise created on demand by the first request.
+
+    Called by a pre-forking server before forking (see prefork.py), so the
+    workers share them. The object class registry is built on import.
+    Database connections are per process, not opened here."""
+
+    log.debug('warm_up()')
+
+    password_context()
+
+    for req_body_cls in REQUEST_BODY_CLASSES:
+        compiled_validator(req_body_cls)
+
+
 @Request.application
 def application(request):
     """Application entry point. Return a WSGI application callable.
@@ -913,24 +2683,44 @@ def application(request):
 
     response = Response()
 
-    # From here on all response data is JSON.
-    response.content_type = CONTENT_TYPE_APP_JSON
+    # From here on all response data is encoded by the negotiated codec.
+    codec = response_codec(request)
+    response.content_type = codec.CONTENT_TYPE
 
     if application_key_fails(request, response):
+        encode_error_response(response, codec)
         return response
 
     holder = Holder()
     holder.request = request
     holder.response = response
+    holder.codec = codec
+
+    # Base data cache hits are answered without the database.
+    if request.args.get('type') == APIRequestType.BASE_DATA_DOWN and \
+            base_data_down_cached(holder):
+        encode_error_response(response, codec)
+        compress_response(holder)
+        return response
 
     holder.cursor, holder.cnx, errno = open_db()
     if errno:
         log.debug('response = internal server error')
         response.set_data(APIErrorResponse.INTERNAL_SERVER_ERROR)
+        encode_error_response(response, codec)
         return response
 
-    route_request(holder)
-    close_db(holder.cursor, holder.cnx)
+    try:
+        route_request(holder)
+        encode_error_response(response, codec)
+        compress_response(holder)
+    finally:
+        if holder.streaming:
+            # Released once the streamed body has been sent.
+            response.call_on_close(lambda: close_holder(holder))
+        else:
+            close_holder(holder)
+
     return response
 
 
@@ -944,8 +2734,16 @@ def main():
 
     from werkzeug.serving import run_simple
 
+    # Serve the static base data as the web server would.
+    static_files = {'/' + STATIC_BASE_DATA_DIR: static_base_data_path()}
+
+    # Before any thread is started.
+    start_hash_pool()
+    start_janitor()
+
     run_simple('localhost', 8080, application,
-               use_debugger=True, use_reloader=True)
+               use_debugger=True, use_reloader=True,
+               static_files=static_files)
 
 
 # Run main when commands read either from standard input,
@@ -44,6 +44,7 @@ import pytest
 from time import sleep, time
 from uuid import uuid4
 
+import janitor
 from tests import main
 from server import open_db, close_db
 from common import SyncCount
@@ -73,9 +74,9 @@ def new_client_id():
     assert 1 == cursor.rowcount
 
     statement = """INSERT INTO Client (userId, UUID)
-                   VALUES (LAST_INSERT_ID(), %s)"""
+                   VALUES (LAST_INSERT_ID(), UNHEX(%s))"""
 
-    params = (str(uuid4()),)
+    params = (uuid4().hex,)
 
     cursor.execute(statement, params)
     assert 1 == cursor.rowcount
@@ -153,6 +154,68 @@ def get_session_sc_x(object_class, insert_commit=True):
     return session_sc
 
 
+def get_session_sc_insert_x(object_class):
+    """Get session sync count for object class by the insert allocator."""
+
+    cursor, cnx, errno = open_db()
+    assert None == errno
+
+    session_sc = SyncCount()
+    session_sc.object_class = object_class.__name__
+
+    cursor.execute(SyncCount.INSERT, session_sc.insert_params())
+
+    assert 1 == cursor.rowcount
+    session_sc.sync_count = cursor.lastrowid
+    assert 0 < session_sc.sync_count
+
+    cnx.commit()
+
+    close_db(cursor, cnx)
+
+    return session_sc
+
+
+def delete_trailing_committed_below_max_x(object_class):
+    """Delete trailing committed sessions by executing the janitor statement.
+
+    Return rowcount."""
+
+    cursor, cnx, errno = open_db()
+    assert None == errno
+
+    sc = SyncCount()
+    sc.object_class = object_class.__name__
+
+    cursor.execute(SyncCount.DELETE_TRAILING_COMMITTED_BELOW_MAX,
+                   sc.delete_trailing_committed_below_max_params())
+
+    rowcount = cursor.rowcount
+    cnx.commit()
+
+    close_db(cursor, cnx)
+
+    return rowcount
+
+
+def select_sessions_x():
+    """Select all session rows in sync count order."""
+
+    cursor, cnx, errno = open_db()
+    assert None == errno
+
+    statement = """SELECT syncCount, objectClass, isCommitted
+                   FROM SyncCount
+                   ORDER BY syncCount"""
+
+    cursor.execute(statement)
+    rows = cursor.fetchall()
+
+    close_db(cursor, cnx)
+
+    return rows
+
+
 def mark_session_committed_x(session_sync_count):
     """Mark session as committed by executing the statements."""
 
@@ -887,6 +950,47 @@ def test_mark_expired_sessions_committed():
             {'syncCount': 7, 'isCommitted': 0}] == rows
 
 
+@use_fixtures('before_test_drop_create_tables')
+@use_fixtures('session_fin_drop_create_tables')
+def test_run_janitor():
+    """Test the janitor marks expired sessions and deletes trailing sessions.
+
+    The uncommitted current sessions and committed sync count remain."""
+
+    insert_expired_and_current_sessions()
+
+    assert 4 == janitor.run_janitor()
+
+    # Assert Results #
+    assert [{'syncCount': 3, 'objectClass': Product.__name__,
+             'isCommitted': 0},
+            {'syncCount': 6, 'objectClass': Product.__name__,
+             'isCommitted': 0},
+            {'syncCount': 7, 'objectClass': Product.__name__,
+             'isCommitted': 0}] == select_sessions_x()
+    assert 2 == get_committed_sc_x(Product).sync_count
+
+
+@use_fixtures('before_test_drop_create_tables')
+@use_fixtures('session_fin_drop_create_tables')
+def test_run_janitor_lock_taken():
+    """Test the janitor skips the sweep while another janitor has the lock."""
+
+    insert_expired_and_current_sessions()
+
+    cursor, cnx, errno = open_db()
+    assert None == errno
+    assert janitor.get_lock(cursor)
+
+    assert None == janitor.run_janitor()
+    assert 7 == len(select_sessions_x())
+
+    janitor.release_lock(cursor)
+    close_db(cursor, cnx)
+
+    assert 4 == janitor.run_janitor()
+
+
 ##################
 # Test Sequences #
 ##################
@@ -962,6 +1066,89 @@ def test_session_sequence_mixed_object_class():
                      'isCommitted': 1}]
 
 
+###################################
+# Test Insert Allocator & Janitor #
+###################################
+
+
+@use_fixtures('before_test_drop_create_tables')
+@use_fixtures('session_fin_drop_create_tables')
+def test_insert_allocator_session_sequence_repeating():
+    """Test the insert allocator session sequence, repeating.
+
+    Trailing committed sessions remain until deleted by the janitor."""
+
+    for i in range(5):
+        compare_sc = get_committed_sc_x(Product)
+
+        session_sc = get_session_sc_insert_x(Product)
+        mark_session_committed_x(session_sc)
+        committed_sc = get_committed_sc_x(Product)
+
+        # Assert Result #
+        assert compare_sc.sync_count + 1 == session_sc.sync_count
+        assert committed_sc.sync_count == session_sc.sync_count
+
+    assert 5 == len(select_sessions_x())
+
+    assert 4 == delete_trailing_committed_below_max_x(Product)
+
+    # Assert Result #
+    assert select_sessions_x() == [{'syncCount': 5,
+                                    'objectClass': Product.__name__,
+                                    'isCommitted': 1}]
+    assert 5 == get_committed_sc_x(Product).sync_count
+
+
+@use_fixtures('before_test_drop_create_tables')
+@use_fixtures('session_fin_drop_create_tables')
+def test_delete_trailing_committed_below_max_mixed_object_class():
+    """Test the janitor delete keeps the committed sync count unchanged.
+
+    Only committed sessions below the highest of the same class are deleted."""
+
+    # Insert Committed and UnCommitted Session Rows #
+    cursor, cnx, errno = open_db()
+    assert None == errno
+
+    statement = """INSERT INTO SyncCount (objectClass, isCommitted)
+                   VALUES (%s, %s)"""
+
+    seq_of_params = ((Product.__name__, 1),
+                     (Product.__name__, 1),
+                     (Product.__name__, 0),
+                     (Product.__name__, 1),
+                     (Setting.__name__, 1),
+                     (Setting.__name__, 1),
+                     (Product.__name__, 1))
+
+    cursor.executemany(statement, seq_of_params)
+    assert 7 == cursor.rowcount
+    cnx.commit()
+
+    close_db(cursor, cnx)
+
+    assert 2 == get_committed_sc_x(Product).sync_count
+    assert 6 == get_committed_sc_x(Setting).sync_count
+
+    assert 3 == delete_trailing_committed_below_max_x(Product)
+    assert 1 == delete_trailing_committed_below_max_x(Setting)
+
+    # Assert Result #
+    assert 2 == get_committed_sc_x(Product).sync_count
+    assert 6 == get_committed_sc_x(Setting).sync_count
+
+    assert [{'syncCount': 3,
+             'objectClass': Product.__name__,
+             'isCommitted': 0},
+            {'syncCount': 6,
+             'objectClass': Setting.__name__,
+             'isCommitted': 1},
+            {'syncCount': 7,
+             'objectClass': Product.__name__,
+             'isCommitted': 1}] == select_sessions_x()
+
+
 @use_fixtures('before_test_drop_create_tables')
 @use_fixtures('session_fin_drop_create_tables')
 def test_get_session_sc_parallel_long_data_transaction():
@@ -45,9 +45,13 @@ Copyright:
 """
 
 import argparse
+import os
 import pytest
 import requests
+import threading
 import uuid
+import zlib
+from time import time
 from flexmock import flexmock
 from requests.exceptions import ConnectionError
 from werkzeug.exceptions import MethodNotAllowed, NotImplemented, BadRequest
@@ -55,9 +59,13 @@ from werkzeug.exceptions import MethodNotAllowed, NotImplemented, BadRequest
 import client
 import server
 import app_model
+from base_model import compiled_validator, ValidatedObject, NOT_AN_OBJECT
+from cache import TTLCache
 from common import APIRequestType, HTTP, JSON, APIRequest, APIErrorResponse, \
     JSONKey, APIErrorCode, SyncDownRequestBody, AccountOpenRequestBody, \
-    SyncUpRequestBody, SyncCount
+    SyncUpRequestBody, SyncCount, ResponseBody, ContentEncoding, MsgPack, \
+    CODECS, error_responses, msgpack, JSON_PROBE, json_dumps_compatible, \
+    json_loads_compatible, SyncBatchRequestBody
 from app_config import APP_KEYS
 
 fixture = pytest.fixture
@@ -74,6 +82,248 @@ class TestCommon(object):
         assert '{"error":1}' == APIErrorResponse.INTERNAL_SERVER_ERROR
         assert '{"error":2}' == APIErrorResponse.MALFORMED_REQUEST
 
+    @pytest.mark.parametrize('encoding', ContentEncoding.SUPPORTED)
+    def test_content_encoding(self, encoding):
+        data = JSON.dumps([dict(name='name', value=i) for i in xrange(100)])
+
+        compressed = ContentEncoding.compress(data, encoding)
+        assert len(compressed) < len(data)
+        assert data == ContentEncoding.decompress(compressed, encoding,
+                                                  len(data))
+
+        streamed = ''.join(ContentEncoding.compress_iter(
+            (data[:100], data[100:]), encoding))
+        assert data == ContentEncoding.decompress(streamed, encoding,
+                                                  len(data))
+
+        with pytest.raises(ValueError):
+            ContentEncoding.decompress(compressed, encoding, len(data) - 1)
+
+    def test_json_backend(self):
+        import json
+
+        assert JSON.dumps(JSON_PROBE) == json.dumps(
+            JSON_PROBE, separators=JSON.COMPACT_SEPARATORS)
+        assert JSON.loads(JSON.dumps(JSON_PROBE)) == JSON_PROBE
+
+        # Default separators are not compatible.
+        assert not json_dumps_compatible(json.dumps)
+        assert json_dumps_compatible(JSON.dumps)
+        assert json_loads_compatible(JSON.loads)
+
+    def test_select_json_backend(self, monkeypatch):
+        """Test the fastest compatible backend is selected."""
+
+        import common
+
+        # Distinct functions of each (fake) backend.
+        functions = dict((name, (lambda obj: JSON.dumps(obj),
+                                 lambda s: JSON.loads(s)))
+                         for name in ('json', 'slow', 'fast'))
+        seconds = {}
+        for name, (dumps, loads) in functions.items():
+            seconds[dumps] = seconds[loads] = dict(slow=2, fast=0).get(name, 1)
+
+        monkeypatch.setattr(common, 'json_backend_functions',
+                            lambda name: functions[name])
+        monkeypatch.setattr(common, 'json_time',
+                            lambda func, arg: seconds[func])
+
+        assert ('json', 'json') == common.select_json_backend(
+            ('slow', 'json'))[::2]
+        assert ('fast', 'fast') == common.select_json_backend(
+            ('slow', 'fast', 'json'))[::2]
+
+    @pytest.mark.parametrize('codec', CODECS.values())
+    def test_codec_dumps_objects(self, codec):
+        objects = [dict(id=i, name=u'n\xe9%s' % i) for i in xrange(3)]
+        envelope = dict(error=0, committedSyncCount=3, moreObjects=False)
+
+        data = codec.dumps_objects(envelope,
+                                   [codec.dumps(o) for o in objects])
+
+        assert dict(envelope, objects=objects) == codec.loads(data)
+
+    @pytest.mark.skipif('msgpack is None')
+    def test_msgpack_error_responses(self):
+        responses = error_responses(MsgPack)
+        encoded = responses[APIErrorResponse.MALFORMED_REQUEST]
+        assert dict(error=APIErrorCode.MALFORMED_REQUEST) == \
+            MsgPack.loads(encoded)
+
+    def test_client_uuid_params(self):
+        """Test the client UUID is passed and selected as hex."""
+
+        from common import Client, UserClient
+
+        client_uuid = uuid.uuid4()
+        client = Client(dict(userId=1, clientUUID=client_uuid))
+        assert (1, client_uuid.hex) == client.insert_params()
+        assert (client_uuid.hex,) == client.insert_by_last_insert_id_params()
+
+        # HEX() selects uppercase hex.
+        user_client = UserClient(dict(UUID=client_uuid.hex.upper()))
+        assert client_uuid == user_client.UUID
+
+    def test_content_encoding_raw_deflate(self):
+        data = 'x' * 100
+        c = zlib.compressobj(6, zlib.DEFLATED, -zlib.MAX_WBITS)
+        raw = c.compress(data) + c.flush()
+        assert data == ContentEncoding.decompress(
+            raw, ContentEncoding.DEFLATE, 100)
+
+
+class TestBaseModel(object):
+    """Base model unit tests."""
+
+    def test_object_class_registry(self):
+        assert set(['Product', 'Setting']) == set(server.OBJECT_CLASSES)
+
+        info = server.OBJECT_CLASSES['Product']
+        assert app_model.Product is info.model_class
+        assert 'Product' == info.table
+        assert 'id' == info.columns[0]
+        assert 'name' in info.columns
+        assert 0 < info.max_objects
+
+    def test_compiled_once_per_class(self):
+        compiled = app_model.Product.compiled()
+        assert compiled is app_model.Product.compiled()
+        assert compiled is not app_model.Setting.compiled()
+        assert compiled.upsert(2) is compiled.upsert(2)
+
+    def test_insert_params(self):
+        product = app_model.Product({'name': 'n', 'lastSync': 3})
+        params = product.insert_params()
+        assert len(product.compiled().insert_fields) == len(params)
+        assert 'n' == params[-1]
+        assert 3 == params[4]
+
+    def test_create_table(self):
+        compiled = app_model.Setting.compiled()
+        for column in compiled.columns:
+            assert '\n  %s ' % column in compiled.create_table
+        assert 'INDEX `syncDown` (`ownerUserId`,`lastSync`,`id`)' in \
+            compiled.create_table
+
+    def test_create_table_lazy(self):
+        """Test a field without a column type only fails the DDL."""
+
+        from schematics.types import IntType
+        from schematics.types.compound import ListType
+        from base_model import BaseAppModel
+
+        class Tagged(BaseAppModel):
+            tags = ListType(IntType())
+
+        compiled = Tagged.compiled()
+        assert 'tags' in compiled.insert_fields
+        with pytest.raises(ValueError):
+            compiled.create_table
+
+    def test_row_primitive(self):
+        product = app_model.Product({'rowid': 1, 'lastSync': 2,
+                                     'deleted': True, 'name': u'n'})
+        row = dict(product.to_native(), deleted=1)
+        compiled = app_model.Product.compiled()
+        assert product.to_primitive() == compiled.row_primitive(row)
+
+    def test_multi_row_statements(self):
+        compiled = app_model.Product.compiled()
+        assert 2 == compiled.upsert(2).count(compiled.values_row)
+        assert 2 == compiled.update_by_id(3).count('UNION ALL')
+
+    def test_compiled_validator(self):
+        validator = server.OBJECT_CLASSES['Product'].validator
+        assert validator is compiled_validator(app_model.Product)
+
+        obj, errors = validator({'originClientObjectId': 1, 'name': 'n'})
+        assert None is errors
+        assert u'n' == obj['name']
+        assert 0 == obj['deleted']
+        assert None is obj['rowid']
+        assert len(app_model.Product.compiled().insert_fields) == \
+            len(app_model.Product.compiled().insert_item_params(obj))
+
+        obj, errors = validator({'rowid': '1', 'deleted': 2, 'name': 3,
+                                 'lastSync': True, 'unknown': 1})
+        assert set(['rowid', 'deleted', 'name', 'lastSync', 'unknown']) == \
+            set(errors)
+
+        obj, errors = validator([])
+        assert None is obj
+        assert NOT_AN_OBJECT in errors
+
+    def test_compiled_validator_request_body(self):
+        validator = compiled_validator(SyncDownRequestBody)
+        client_uuid = uuid.uuid4()
+
+        obj, errors = validator({'objectClass': 'Product',
+                                 'clientUUID': str(client_uuid),
+                                 'lastSync': 0})
+        assert None is errors
+        assert client_uuid == obj['clientUUID']
+        assert None is obj['lastObjectId']
+        assert 'Product' == ValidatedObject(obj).objectClass
+
+        obj, errors = validator({'clientUUID': 'x', 'lastSync': 0})
+        assert set(['objectClass', 'clientUUID']) == set(errors)
+
+        # Mutable defaults are not shared between objects.
+        validator = compiled_validator(SyncBatchRequestBody)
+        batch = {'clientUUID': str(client_uuid)}
+        obj, errors = validator(batch)
+        obj['syncUp'].append({})
+        assert [] == validator(batch)[0]['syncUp']
+
+        obj, errors = compiled_validator(SyncUpRequestBody)(
+            {'objectClass': 'Product', 'clientUUID': str(client_uuid),
+             'objects': {}})
+        assert ['objects'] == list(errors)
+
+
+class TestCache(object):
+    """Cache unit tests."""
+
+    def test_set_get(self):
+        cache = TTLCache(2, 60)
+        cache.set('a', 1)
+        assert 1 == cache.get('a')
+        assert None is cache.get('b')
+
+    def test_expired(self):
+        cache = TTLCache(2, -1)
+        cache.set('a', 1)
+        assert None is cache.get('a')
+        assert 0 == len(cache)
+
+    def test_evicts_least_recently_used(self):
+        cache = TTLCache(2, 60)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+        assert 1 == cache.get('a')
+        assert None is cache.get('b')
+        assert 3 == cache.get('c')
+
+    def test_pop(self):
+        cache = TTLCache(2, 60)
+        cache.set('a', 1)
+        assert 1 == cache.pop('a')
+        assert None is cache.get('a')
+
+    def test_disabled(self):
+        cache = TTLCache(0, 60)
+        cache.set('a', 1)
+        assert None is cache.get('a')
+
+    def test_auth_cache_key_includes_password_hash(self):
+        key = server.auth_cache_key(u'user@example.com', u'secret78901234',
+                                    u'$5$hash1')
+        assert key != server.auth_cache_key(u'user@example.com',
+                                            u'secret78901234', u'$5$hash2')
+
 
 @use_fixtures('session_fin_drop_create_tables')
 class TestServerUnit(object):
@@ -94,6 +344,548 @@ class TestServerUnit(object):
         # finalization
         server.close_db(holder.cursor, holder.cnx)
 
+    def test_pooled_connection_reused(self):
+        """Test a closed connection is returned to and reused from the pool."""
+
+        cursor, cnx, errno = server.open_db()
+        assert not errno
+        server.close_db(cursor, cnx)
+
+        cursor, reused_cnx, errno = server.open_db()
+        assert not errno
+        server.close_db(cursor, reused_cnx)
+
+        assert cnx is reused_cnx
+
+    def test_pool_max_connections(self):
+        """Test checkouts beyond max_connections fail until one is put."""
+
+        class Connection(object):
+            def rollback(self):
+                pass
+
+            def is_connected(self):
+                return True
+
+            def close(self):
+                pass
+
+        pool = server.ConnectionPool(0, {}, max_connections=1, timeout=0)
+        pool.connect = Connection
+
+        cnx = pool.get()
+        with pytest.raises(server.mysql.connector.errors.PoolError) as e:
+            pool.get()
+        assert server.errorcode.ER_CON_COUNT_ERROR == e.value.errno
+
+        # Closed (pool size 0), a new connection may be opened.
+        pool.put(cnx)
+        assert pool.get() is not cnx
+
+    def test_pack_response_stream(self):
+        """Test the streamed response body is the same JSON as packed."""
+
+        holder = server.Holder()
+        holder.response = server.Response()
+        holder.response_body = ResponseBody(dict(committedSyncCount=3))
+
+        def objects():
+            for i in xrange(3):
+                primitive = dict(id=i, name=u'n%s' % i)
+                yield primitive, JSON.dumps(primitive)
+            holder.response_body.moreObjects = True
+
+        server.pack_response_stream(holder, objects())
+        assert holder.streaming
+
+        jo = JSON.loads(holder.response.get_data())
+        assert jo == dict(error=0,
+                          committedSyncCount=3,
+                          objects=[dict(id=i, name=u'n%s' % i)
+                                   for i in xrange(3)],
+                          moreObjects=True)
+
+    @pytest.mark.parametrize('accept_encoding, size, encoding', [
+        ('gzip, deflate', 2048, 'gzip'),
+        ('deflate', 2048, 'deflate'),
+        ('gzip', 10, None),
+        (None, 2048, None)])
+    def test_compress_response(self, accept_encoding, size, encoding):
+        """Test the response is compressed as negotiated."""
+
+        from werkzeug.test import EnvironBuilder
+
+        headers = {}
+        if accept_encoding:
+            headers['Accept-Encoding'] = accept_encoding
+
+        holder = server.Holder()
+        holder.request = server.Request(
+            EnvironBuilder(method='POST', headers=headers).get_environ())
+        holder.response = server.Response()
+        data = '{"error":0,"objects":[%s]}' % ('0,' * size)
+        holder.response.set_data(data)
+
+        server.compress_response(holder)
+
+        assert encoding == holder.response.content_encoding
+        assert 'Accept-Encoding' in holder.response.vary
+        body = holder.response.get_data()
+        if encoding:
+            body = ContentEncoding.decompress(body, encoding, len(data))
+        assert data == body
+
+    @pytest.mark.parametrize('accept, content_type', [
+        (None, 'application/json'),
+        ('*/*', 'application/json'),
+        ('application/json', 'application/json'),
+        ('application/x-msgpack', 'application/x-msgpack'),
+        ('application/x-msgpack, application/json;q=0.5',
+         'application/x-msgpack')])
+    def test_response_codec(self, accept, content_type):
+        """Test the response codec is negotiated by Accept."""
+
+        from werkzeug.test import EnvironBuilder
+
+        if content_type not in CODECS:
+            pytest.skip('codec not installed')
+
+        headers = {}
+        if accept:
+            headers['Accept'] = accept
+
+        request = server.Request(
+            EnvironBuilder(method='POST', headers=headers).get_environ())
+
+        assert content_type == server.response_codec(request).CONTENT_TYPE
+
+    def test_session_token(self, monkeypatch):
+        """Test a session token is verified by its signature and expiry."""
+
+        monkeypatch.setattr(server, 'AUTH_TOKEN_SECRET', 'secret')
+
+        user = server.User(dict(rowid=1, email='user@example.com',
+                                password='$hash'))
+        client = server.Client()
+        client.rowid = 2
+        client.UUID = uuid.uuid4()
+        expires = int(time()) + 60
+
+        token = server.get_session_token(user, client, expires)
+        msg, signature, token_client = server.parse_session_token(token)
+        assert server.verify_session_token(msg, signature, user)
+        assert 1 == token_client.userId
+        assert 2 == token_client.rowid
+        assert client.UUID == token_client.UUID
+
+        # Tampered, expired or malformed.
+        msg, signature, token_client = server.parse_session_token(
+            token.replace('1.2.', '1.3.', 1))
+        assert None is server.verify_session_token(msg, signature, user)
+        assert None is server.parse_session_token(
+            server.get_session_token(user, client, int(time()) - 1))
+        assert None is server.parse_session_token('1.2.x')
+
+        # Revoked by an account modify (or close).
+        msg, signature, token_client = server.parse_session_token(token)
+        modified = server.User(dict(user.to_native(), password='$new'))
+        assert None is server.verify_session_token(msg, signature, modified)
+
+        # Signed by another secret.
+        monkeypatch.setattr(server, 'AUTH_TOKEN_SECRET', 'other')
+        assert None is server.verify_session_token(msg, signature, user)
+
+    def test_set_token_auth_user(self, monkeypatch):
+        """Test the session token user is cached until invalidated."""
+
+        from werkzeug.test import EnvironBuilder
+
+        monkeypatch.setattr(server, 'AUTH_TOKEN_SECRET', 'secret')
+        monkeypatch.setattr(server, '_auth_cache', TTLCache(10, 60))
+
+        user = server.User(dict(rowid=1, email='user@example.com',
+                                password='$hash'))
+        client = server.Client(dict(rowid=2, UUID=uuid.uuid4()))
+        token = server.get_session_token(user, client, int(time()) + 60)
+        statements = []
+
+        def execute_statement(statement, params, object_class, holder):
+            statements.append(statement)
+            return server.SQLResult(dict(objects=[server.User(user)]))
+
+        monkeypatch.setattr(server, 'execute_statement', execute_statement)
+
+        def token_auth():
+            holder = server.Holder()
+            holder.response = server.Response()
+            holder.request = server.Request(EnvironBuilder().get_environ())
+            assert server.set_token_auth_user(holder, token)
+            return holder
+
+        token_auth()
+        holder = token_auth()
+        assert [server.User.SELECT_BY_ID] == statements
+        assert 2 == holder.auth_user.clients[0].rowid
+
+        # Invalidated by an account modify or close.
+        server.invalidate_auth_cache(holder)
+        token_auth()
+        assert 2 == len(statements)
+
+    def test_set_auth_user_client(self, monkeypatch):
+        """Test the user is selected with only the request body client."""
+
+        from werkzeug.test import EnvironBuilder
+
+        client_uuid = uuid.uuid4()
+        statements = []
+
+        def execute_statement(statement, params, object_class, holder):
+            statements.append((statement, params))
+            user_client = server.UserClient()
+            user_client.rowid = 1
+            user_client.email = 'user@example.com'
+            user_client.password = 'hash'
+            user_client.client_rowid = 2
+            user_client.UUID = client_uuid
+            return server.SQLResult(dict(objects=[user_client]))
+
+        monkeypatch.setattr(server, 'execute_statement', execute_statement)
+        monkeypatch.setattr(server, 'verify_password', lambda *args: True)
+
+        holder = server.Holder()
+        holder.response = server.Response()
+        holder.request = server.Request(EnvironBuilder(
+            query_string='email=user@example.com&password=secret-password'
+        ).get_environ())
+        holder.request_body = ValidatedObject(clientUUID=client_uuid)
+
+        assert server.set_auth_user(holder)
+        assert server.set_auth_client(holder)
+        assert 2 == holder.auth_client.rowid
+        assert 1 == holder.auth_client.userId
+
+        assert [(server.UserClient.SELECT_BY_EMAIL_CLIENT_UUID,
+                 (client_uuid.hex, 'user@example.com'))] == statements
+
+    def test_set_auth_user_request_body(self, monkeypatch):
+        """Test a request body error is responded only once authenticated."""
+
+        from werkzeug.test import EnvironBuilder
+
+        def execute_statement(statement, params, object_class, holder):
+            user_client = server.UserClient()
+            user_client.rowid = 1
+            user_client.email = 'user@example.com'
+            user_client.password = 'hash'
+            return server.SQLResult(dict(objects=[user_client]))
+
+        verified = []
+        monkeypatch.setattr(server, 'execute_statement', execute_statement)
+        monkeypatch.setattr(server, 'verify_password',
+                            lambda *args: bool(verified))
+
+        def response_data():
+            holder = server.Holder()
+            holder.response = server.Response()
+            holder.request = server.Request(EnvironBuilder(
+                method='POST', data='{"objectClass":1}',
+                content_type='application/json',
+                query_string='email=user@example.com&password=secret-password'
+            ).get_environ())
+            assert None is server.set_auth_user_request_body(
+                server.SyncDownRequestBody, holder)
+            return holder.response.get_data()
+
+        assert APIErrorResponse.AUTH_FAIL == response_data()
+        verified.append(True)
+        assert APIErrorResponse.INVALID_JSON_OBJECT == response_data()
+
+    def test_sync_batch_duplicate_sections(self):
+        """Test an object class may have one section of each."""
+
+        def sections(sync_down):
+            holder = server.Holder()
+            holder.response = server.Response()
+            holder.request_body = ValidatedObject(compiled_validator(
+                SyncBatchRequestBody)({'clientUUID': str(uuid.uuid4()),
+                                       'syncDown': sync_down})[0])
+            return server.get_sync_batch_sections(holder), holder
+
+        down = {'objectClass': 'Product', 'lastSync': 0}
+        batch, holder = sections([down])
+        assert 1 == len(batch[1])
+
+        batch, holder = sections([down, dict(down, lastSync=1)])
+        assert None is batch
+        assert APIErrorResponse.INVALID_JSON_OBJECT == \
+            holder.response.get_data()
+
+    def test_iter_sync_down_objects_max_bytes(self):
+        """Test the sync batch sections share the byte limit."""
+
+        class Rows(list):
+            def close(self):
+                pass
+
+        def section(sync_bytes):
+            holder = server.Holder()
+            holder.object_class_info = server.OBJECT_CLASSES['Product']
+            holder.response_body = server.ResponseBody()
+            holder.rows = Rows(dict(rowid=i, lastSync=1, deleted=0,
+                                    name=u'n' * 100) for i in xrange(3))
+            holder.max_bytes = 400
+            holder.sync_bytes = sync_bytes
+            objects = list(server.iter_sync_down_objects(holder))
+            return holder, objects
+
+        holder, objects = section(0)
+        assert 2 == len(objects)
+        assert holder.response_body.moreObjects
+        sync_bytes = holder.sync_bytes
+        assert sum(len(data) + 1 for primitive, data in objects) == sync_bytes
+
+        holder, objects = section(sync_bytes)
+        assert [] == objects
+        assert holder.response_body.moreObjects
+        assert sync_bytes == holder.sync_bytes
+
+    def test_set_user_last_sync(self):
+        """Test the user last sync excludes the requesting client."""
+
+        class Cursor(object):
+            def execute(self, statement, params):
+                self.statement = statement
+                self.params = params
+
+            def fetchall(self):
+                return [{'lastSync': 7}]
+
+        holder = server.Holder()
+        holder.cursor = Cursor()
+        holder.object_class_info = server.OBJECT_CLASSES['Product']
+        holder.auth_user = server.User(dict(rowid=1))
+        holder.auth_client = server.Client(dict(rowid=2))
+        holder.response_body = server.ResponseBody()
+        holder.response_body.committedSyncCount = 9
+
+        assert server.set_user_last_sync(holder)
+        assert 7 == holder.response_body.lastSync
+        assert 'lastUpdatedByClientId != %s' in holder.cursor.statement
+        assert (1, 9, 2) == holder.cursor.params
+
+    def test_sweep_sessions(self, monkeypatch):
+        """Test the request path sweep runs once per interval and class."""
+
+        import janitor
+
+        swept = []
+        monkeypatch.setattr(janitor, 'mark_expired_sessions_committed',
+                            lambda holder, name: swept.append(name))
+        monkeypatch.setattr(server, '_sweep_times', {})
+        monkeypatch.setattr(server, '_janitor_pid', None)
+
+        holder = server.Holder()
+        holder.object_class = app_model.Product
+        server.sweep_sessions(holder)
+        server.sweep_sessions(holder)
+        assert ['Product'] == swept
+
+        # Not swept by a process running the janitor thread.
+        monkeypatch.setattr(server, '_sweep_times', {})
+        monkeypatch.setattr(server, '_janitor_pid', os.getpid())
+        server.sweep_sessions(holder)
+        assert ['Product'] == swept
+
+    def test_run_hash(self, monkeypatch):
+        """Test password hashing inline, in the hash pool and when busy."""
+
+        password_hash = server.run_hash(server.hash_password, 'secret')
+        assert server.run_hash(server.check_password, 'secret', password_hash)
+
+        # Inline until the pool is started.
+        monkeypatch.setattr(server, 'HASH_POOL_SIZE', 1)
+        monkeypatch.setattr(server, '_hash_pool', None)
+        monkeypatch.setattr(server, '_hash_pool_pid', None)
+        assert server.run_hash(server.check_password, 'secret', password_hash)
+        assert None is server._hash_pool
+
+        # A pool of this test, reset by monkeypatch when done.
+        server.start_hash_pool()
+        try:
+            assert server.run_hash(server.check_password, 'secret',
+                                   password_hash)
+            assert not server.run_hash(server.check_password, 'other',
+                                       password_hash)
+
+            slots = threading.BoundedSemaphore(1)
+            slots.acquire()
+            monkeypatch.setattr(server, '_hash_pool_slots', slots)
+            with pytest.raises(server.HashPoolBusy):
+                server.run_hash(server.hash_password, 'secret')
+        finally:
+            if server._hash_pool is not None:
+                server._hash_pool.terminate()
+                server._hash_pool.join()
+
+    def test_prefork_wsgi_server(self):
+        """Test a worker server serves the master's listening socket."""
+
+        import socket
+        from prefork import PreforkWSGIServer
+
+        listen_socket = socket.socket()
+        listen_socket.bind(('localhost', 0))
+        listen_socket.listen(1)
+
+        server.warm_up()
+        httpd = PreforkWSGIServer(listen_socket, server.application)
+        assert listen_socket is httpd.socket
+
+        thread = threading.Thread(target=httpd.handle_request)
+        thread.start()
+        response = requests.get('http://localhost:%s/' % httpd.server_port)
+        thread.join()
+        listen_socket.close()
+
+        assert MethodNotAllowed.code == response.status_code
+
+    def test_base_data_down_cached(self, monkeypatch):
+        """Test a base data cache hit is answered without the database."""
+
+        from werkzeug.test import Client
+        from werkzeug.wrappers import BaseResponse
+
+        def open_db():
+            raise AssertionError('database opened')
+
+        monkeypatch.setattr(server, 'open_db', open_db)
+        monkeypatch.setattr(server, '_base_data_cache', TTLCache(1, 60))
+        monkeypatch.setattr(server, '_committed_sc_cache', TTLCache(1, 60))
+        server._committed_sc_cache.set('Product', 5)
+
+        body = {'objectClass': 'Product', 'clientUUID': str(uuid.uuid4()),
+                'lastSync': 0}
+        holder = server.Holder()
+        holder.codec = JSON
+        holder.object_class_info = server.OBJECT_CLASSES['Product']
+        holder.request_body = ValidatedObject(
+            compiled_validator(server.BaseDataDownRequestBody)(body)[0])
+        data = '{"error":0,"objects":[%s]}' % ','.join(['{}'] * 1000)
+        snapshot = ('etag', data, {})
+        server._base_data_cache.set(server.base_data_key(holder, 5), snapshot)
+
+        response = Client(server.application, BaseResponse).post(
+            query_string={'type': APIRequestType.BASE_DATA_DOWN,
+                          'key': APP_KEYS[1]},
+            data=JSON.dumps(body),
+            headers={'Content-Type': JSON.CONTENT_TYPE,
+                     'Accept-Encoding': ContentEncoding.GZIP})
+
+        assert HTTP.OK == response.status_code
+        assert ContentEncoding.GZIP == response.headers['Content-Encoding']
+        assert data == ContentEncoding.decompress(
+            response.get_data(), ContentEncoding.GZIP, len(data))
+
+        # Compressed once, kept with the snapshot.
+        assert response.get_data() == snapshot[2][ContentEncoding.GZIP]
+
+        # Not answered once a commit moves the committed sync count on.
+        from werkzeug.test import EnvironBuilder
+
+        server._committed_sc_cache.set('Product', 6)
+        holder = server.Holder()
+        holder.response = server.Response()
+        holder.request = server.Request(EnvironBuilder(
+            method='POST', data=JSON.dumps(body),
+            content_type=JSON.CONTENT_TYPE).get_environ())
+        assert None is server.base_data_down_cached(holder)
+
+    def test_redirect_static_base_data(self, monkeypatch, tmpdir):
+        """Test base data downloads are redirected to the exported file."""
+
+        tmpdir.join(server.STATIC_BASE_DATA_MANIFEST).write(
+            '{"Product":{"file":"Product.7.json","committedSyncCount":7}}')
+        monkeypatch.setattr(server, 'static_base_data_path',
+                            lambda file_name='': str(tmpdir.join(file_name)))
+        monkeypatch.setattr(server, 'STATIC_BASE_DATA_URL', '/base_data/')
+
+        holder = server.Holder()
+        holder.response = server.Response()
+        holder.object_class_info = server.OBJECT_CLASSES['Product']
+        holder.request_body = ValidatedObject(lastSync=0, lastObjectId=None)
+
+        assert server.redirect_static_base_data(holder)
+        assert HTTP.SEE_OTHER == holder.response.status_code
+        assert '/base_data/Product.7.json' == \
+            holder.response.headers['Location']
+
+        # Incremental and continued downloads and classes without base data
+        # are not.
+        holder.request_body = ValidatedObject(lastSync=3, lastObjectId=None)
+        assert not server.redirect_static_base_data(holder)
+        holder.request_body = ValidatedObject(lastSync=7, lastObjectId=1)
+        assert not server.redirect_static_base_data(holder)
+        holder.object_class_info = server.OBJECT_CLASSES['Setting']
+        holder.request_body = ValidatedObject(lastSync=0, lastObjectId=None)
+        assert not server.redirect_static_base_data(holder)
+
+    @pytest.mark.skipif('msgpack is None')
+    def test_pack_response_msgpack(self):
+        """Test the sync down objects packed with the MessagePack codec."""
+
+        holder = server.Holder()
+        holder.codec = MsgPack
+        holder.response = server.Response()
+        holder.response_body = ResponseBody(dict(committedSyncCount=3))
+
+        def objects():
+            for i in xrange(3):
+                primitive = dict(id=i)
+                yield primitive, MsgPack.dumps(primitive)
+            holder.response_body.moreObjects = False
+
+        server.pack_response_stream(holder, objects())
+        assert not holder.streaming
+
+        jo = MsgPack.loads(holder.response.get_data())
+        assert jo == dict(error=0,
+                          committedSyncCount=3,
+                          objects=[dict(id=i) for i in xrange(3)],
+                          moreObjects=False)
+
+    @use_fixtures('before_test_drop_create_tables')
+    def test_committed_sc_cache(self, holder):
+        """Test the cached committed sync count follows other processes."""
+
+        server._committed_sc_cache.clear()
+        holder.response_body = ResponseBody()
+
+        def committed_sc():
+            assert server.set_committed_sc(holder)
+            return holder.response_body.committedSyncCount
+
+        def execute(statement):
+            holder.cursor.execute(statement)
+            holder.cnx.commit()
+
+        execute("""INSERT INTO SyncCount (objectClass, isCommitted)
+                   VALUES ('Product', 1)""")
+        assert 1 == committed_sc()
+        assert 1 == server._committed_sc_cache.get('Product')
+        assert 1 == committed_sc()
+
+        # Uncommitted session issued by another process.
+        execute("""INSERT INTO SyncCount (objectClass)
+                   VALUES ('Product')""")
+        assert 1 == committed_sc()
+
+        # Committed by another process.
+        execute("""UPDATE SyncCount SET isCommitted = 1
+                   WHERE syncCount = 2""")
+        assert 2 == committed_sc()
+        assert 2 == server._committed_sc_cache.get('Product')
+
     @use_fixtures('before_test_drop_create_tables')
     def test_warn_expired_sessions_committed(self, holder, caplog):
         """Test logged warning when expired sessions are committed."""
@@ -101,7 +893,8 @@ class TestServerUnit(object):
         from test_sync_count import insert_expired_and_current_sessions
         insert_expired_and_current_sessions()
 
-        server.mark_expired_sessions_committed(holder)
+        import janitor
+        assert 4 == janitor.mark_expired_sessions_committed(holder, 'Product')
 
         logged_msg = SyncCount.WARN_EXPIRED_SESSIONS_COMMITTED % 4
 
@@ -290,6 +1083,28 @@ class TestServer(object):
         assert HTTP.OK == response.status_code
         assert APIErrorResponse.INVALID_KEY == response.content
 
+    def test_base_data_down_not_modified(self, req, sync_down_request_body):
+        """Test server 'baseDataDown' function with If-None-Match."""
+
+        req.type = APIRequestType.BASE_DATA_DOWN
+        req.body = JSON.dumps(sync_down_request_body.to_primitive())
+        response = requests.post(req.base_url, req.body,
+                                 params=req.params, headers=req.headers)
+        assert HTTP.OK == response.status_code
+        jo = response.json()
+        assert APIErrorCode.SUCCESS == jo[JSONKey.ERROR]
+        assert isinstance(jo[JSONKey.OBJECTS], list)
+        etag = response.headers['ETag']
+        assert etag
+
+        headers = dict(req.headers)
+        headers['If-None-Match'] = etag
+        response = requests.post(req.base_url, req.body,
+                                 params=req.params, headers=headers)
+        assert HTTP.NOT_MODIFIED == response.status_code
+        assert '' == response.content
+        assert etag == response.headers['ETag']
+
     def test_sync_down(self, req, sync_down_request_body):
         """Test server 'syncDown' function."""
 
@@ -301,6 +1116,34 @@ class TestServer(object):
         jo = response.json()
         assert APIErrorCode.SUCCESS == jo[JSONKey.ERROR]
         assert isinstance(jo[JSONKey.OBJECTS], list)
+        assert 0 <= jo['committedSyncCount']
+        assert False == jo['moreObjects']
+
+    def test_sync_down_full_sync_required(self, req, sync_down_request_body):
+        """Test server 'syncDown' function with lastSync > committed."""
+
+        req.type = APIRequestType.SYNC_DOWN
+        rb = SyncDownRequestBody(sync_down_request_body.to_primitive())
+        rb.lastSync = 2 ** 62
+        req.body = JSON.dumps(rb.to_primitive())
+        response = requests.post(req.base_url, req.body,
+                                 params=req.params, headers=req.headers)
+        assert HTTP.OK == response.status_code
+        assert APIErrorResponse.FULL_SYNC_REQUIRED == response.content
+
+    def test_sync_down_compressed(self, req, sync_down_request_body):
+        """Test server 'syncDown' function with a gzip request body."""
+
+        req.type = APIRequestType.SYNC_DOWN
+        req.body = JSON.dumps(sync_down_request_body.to_primitive())
+        req.content_encoding = ContentEncoding.GZIP
+        body = ContentEncoding.compress(req.body.encode('utf-8'),
+                                        ContentEncoding.GZIP)
+        response = requests.post(req.base_url, body,
+                                 params=req.params, headers=req.headers)
+        assert HTTP.OK == response.status_code
+        jo = response.json()
+        assert APIErrorCode.SUCCESS == jo[JSONKey.ERROR]
 
     def test_sync_down_without_content_header(self, req):
         """Test server 'syncDown' function."""
@@ -323,6 +1166,103 @@ class TestServer(object):
         assert APIErrorCode.SUCCESS == jo[JSONKey.ERROR]
         assert isinstance(jo[JSONKey.OBJECTS], list)
 
+    def test_sync_up_new_objects_resent(self, req, sync_up_request_body):
+        """Test server 'syncUp' function with new objects.
+
+        Resending the same new objects must not duplicate them."""
+
+        req.type = APIRequestType.SYNC_UP
+        rb = SyncUpRequestBody(sync_up_request_body.to_primitive())
+        rb.objects = [{'originClientObjectId': 1, 'name': 'a'},
+                      {'originClientObjectId': 2, 'name': 'b'}]
+        req.body = JSON.dumps(rb.to_primitive())
+
+        rowids = []
+        for x in xrange(2):
+            response = requests.post(req.base_url, req.body,
+                                     params=req.params, headers=req.headers)
+            assert HTTP.OK == response.status_code
+            jo = response.json()
+            assert APIErrorCode.SUCCESS == jo[JSONKey.ERROR]
+            objects = jo[JSONKey.OBJECTS]
+            assert 2 == len(objects)
+            for o in objects:
+                assert 0 < o['lastSync']
+            rowids.append(sorted(o['rowid'] for o in objects))
+
+        assert rowids[0] == rowids[1]
+
+    def test_sync_up_invalid_objects(self, req, sync_up_request_body):
+        """Test server 'syncUp' function with invalid objects.
+
+        The errors of each invalid object are returned by object index."""
+
+        req.type = APIRequestType.SYNC_UP
+        rb = SyncUpRequestBody(sync_up_request_body.to_primitive())
+        rb.objects = [{'originClientObjectId': 1, 'name': 'a'},
+                      {'originClientObjectId': 'x', 'name': 'b'},
+                      {'name': 'c'}]
+        req.body = JSON.dumps(rb.to_primitive())
+
+        response = requests.post(req.base_url, req.body,
+                                 params=req.params, headers=req.headers)
+        assert HTTP.OK == response.status_code
+        jo = response.json()
+        assert APIErrorCode.INVALID_JSON_OBJECT == jo[JSONKey.ERROR]
+        assert [1, 2] == [o['index'] for o in jo[JSONKey.DATA]]
+        assert ['originClientObjectId'] == list(jo[JSONKey.DATA][0]['errors'])
+
+    def test_sync_batch(self, req, sync_down_request_body):
+        """Test server 'syncBatch' function with several object classes.
+
+        Each object class section has its own result."""
+
+        req.type = APIRequestType.SYNC_BATCH
+        jo = {'clientUUID': str(sync_down_request_body.clientUUID),
+              'syncUp': [{'objectClass': 'Product',
+                          'objects': [{'originClientObjectId': 1,
+                                       'name': 'a'}]}],
+              'syncDown': [{'objectClass': 'Product', 'lastSync': 0},
+                           {'objectClass': 'Setting', 'lastSync': 2 ** 62}]}
+        req.body = JSON.dumps(jo)
+        response = requests.post(req.base_url, req.body,
+                                 params=req.params, headers=req.headers)
+        assert HTTP.OK == response.status_code
+        jo = response.json()
+        assert APIErrorCode.SUCCESS == jo[JSONKey.ERROR]
+
+        up = jo['syncUp'][0]
+        assert 'Product' == up['objectClass']
+        assert APIErrorCode.SUCCESS == up[JSONKey.ERROR]
+        assert 1 == len(up[JSONKey.OBJECTS])
+        assert 0 < up['committedSyncCount']
+
+        product, setting = jo['syncDown']
+        assert APIErrorCode.SUCCESS == product[JSONKey.ERROR]
+        assert isinstance(product[JSONKey.OBJECTS], list)
+        assert 'Setting' == setting['objectClass']
+        assert APIErrorCode.FULL_SYNC_REQUIRED == setting[JSONKey.ERROR]
+
+    def test_sync_probe(self, req, sync_down_request_body):
+        """Test server 'syncProbe' function."""
+
+        req.type = APIRequestType.SYNC_PROBE
+        req.body = JSON.dumps({'clientUUID':
+                               str(sync_down_request_body.clientUUID),
+                               'objectClasses': ['Product', 'Nope']})
+        response = requests.post(req.base_url, req.body,
+                                 params=req.params, headers=req.headers)
+        assert HTTP.OK == response.status_code
+        jo = response.json()
+        assert APIErrorCode.SUCCESS == jo[JSONKey.ERROR]
+
+        product, nope = jo['objectClasses']
+        assert 'Product' == product['objectClass']
+        assert APIErrorCode.SUCCESS == product[JSONKey.ERROR]
+        assert 0 <= product['lastSync'] <= product['committedSyncCount']
+        assert JSONKey.OBJECTS not in product
+        assert APIErrorCode.MALFORMED_REQUEST == nope[JSONKey.ERROR]
+
     def test_sync_up_without_content_header(self, req):
         """Test server 'syncUp' function."""
 
@@ -426,6 +1366,13 @@ class TestClient(object):
         jo = client_a.get_json_object(mock_response)
         assert mock_response.content == JSON.dumps(jo)
 
+    @pytest.mark.skipif('msgpack is None')
+    def test_get_msgpack(self, client_a, mock_response):
+        mock_response.headers = {'Content-Type': MsgPack.CONTENT_TYPE}
+        mock_response.content = MsgPack.dumps(dict(error=0))
+        jo = client_a.get_json_object(mock_response)
+        assert dict(error=0) == jo
+
     def test_get_json_non_ok_status_code(self, client_a, mock_response):
         mock_response.status_code = 401
         with pytest.raises(Exception):
@@ -443,6 +1390,35 @@ class TestClient(object):
         with pytest.raises(Exception):
             client_a.get_json_object(mock_response)
 
+    @parametrize('error', (APIErrorCode.AUTH_FAIL,
+                           APIErrorCode.REQUEST_TYPE_UNSUPPORTED))
+    def test_session_open_failed_not_retried(self, base_url, error):
+        """Test a failed session open is retried once credentials change."""
+
+        c = client.Client(base_url, APP_KEYS[1],
+                          'user@example.com', 'secret78901234')
+        sent = []
+
+        def send_request(api_request_type, data=None, token=None):
+            sent.append(api_request_type)
+            if api_request_type == APIRequestType.SESSION_OPEN:
+                return {JSONKey.ERROR: error}
+            return {JSONKey.ERROR: APIErrorCode.SUCCESS}
+
+        c.send_request = send_request
+        c.post_request(APIRequestType.TEST)
+        c.post_request(APIRequestType.TEST)
+        assert [APIRequestType.SESSION_OPEN, APIRequestType.TEST,
+                APIRequestType.TEST] == sent
+
+        del sent[:]
+        c.password = 'secret78901235'
+        c.post_request(APIRequestType.TEST)
+        if error == APIErrorCode.REQUEST_TYPE_UNSUPPORTED:
+            assert [APIRequestType.TEST] == sent
+        else:
+            assert [APIRequestType.SESSION_OPEN, APIRequestType.TEST] == sent
+
 
 @use_fixtures("session_fin_drop_create_tables")
 class TestIntegration(object):
@@ -486,6 +1462,20 @@ class TestIntegration(object):
         result = client_a.check_authentication()
         assert True == result
 
+    def test_session_token(self, client_a):
+        """Test the client authenticates by a session token."""
+
+        client_a.token = None
+        result = client_a.check_authentication()
+        assert True == result
+        assert client_a.token
+
+        # An invalid token is replaced by a new session.
+        client_a.token = 'x'
+        result = client_a.check_authentication()
+        assert True == result
+        assert 'x' != client_a.token
+
     def test_account_authentication_wrong_password(self, client_a):
         """Test authentication of the account created above.
 
@@ -611,9 +1601,16 @@ class TestIntegration(object):
     def test_account_close(self, client_a):
         """Test closing an account."""
 
+        assert True == client_a.session_open()
+        token = client_a.token
+
         result = client_a.account_close()
         assert True == result
 
+        # The session token is revoked with the account.
+        jo = client_a.send_request(APIRequestType.TEST, token=token)
+        assert APIErrorCode.AUTH_FAIL == jo[JSONKey.ERROR]
+
     def test_account_authentication_closed_account(self, client_a):
         """Test authentication of the account closed above."""
 